@@ -24,7 +24,6 @@ __copyright__ = "Copyright 2011-2021, Damon Lynch"
 import pickle
 import os
 import errno
-import hashlib
 from datetime import datetime
 import shutil
 import logging
@@ -36,21 +35,21 @@ try:
 except locale.Error:
     pass
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Dict, List
 
 
 from raphodo.interprocess import (
     BackupFileData,
     BackupResults,
-    BackupArguments,
+    BackupDestination,
     WorkerInPublishPullPipeline,
 )
 from raphodo.copyfiles import FileCopy
 from raphodo.constants import FileType, DownloadStatus, BackupStatus
-from raphodo.rpdfile import RPDFile
+from raphodo.rpdfile import RPDFile, RPDFileChanges
 from raphodo.cache import FdoCacheNormal, FdoCacheLarge
 
-from raphodo.copyfiles import copy_file_metadata
+from raphodo.copyfiles import copy_file_metadata, file_checksum
 from raphodo.problemnotification import (
     BackingUpProblems,
     BackupSubfolderCreationProblem,
@@ -58,34 +57,89 @@ from raphodo.problemnotification import (
     BackupOverwrittenProblem,
     BackupAlreadyExistsProblem,
     FileWriteProblem,
+    FileCopyProblem,
 )
 from raphodo.storage.storage import get_uri
 
 
+class BackupDeviceState:
+    """
+    Track backing up to one backup device
+    """
+
+    def __init__(self, destination: BackupDestination) -> None:
+        self.device_id = destination.device_id
+        self.path = destination.path
+        self.device_name = destination.device_name
+        self.uri = get_uri(path=self.path)
+        self.problems = BackingUpProblems(name=self.device_name, uri=self.uri)
+        # Bytes backed up to the device since the start of the download
+        self.total_downloaded = 0
+        # Bytes of the current file backed up, and how many of them have been
+        # reported
+        self.amount_downloaded = 0
+        self.bytes_downloaded = 0
+
+    def reset_problems(self) -> None:
+        self.problems = BackingUpProblems(name=self.device_name, uri=self.uri)
+
+
 class BackupFilesWorker(WorkerInPublishPullPipeline, FileCopy):
+    """
+    Back up files to every backup device. Each file is read once, and if it is
+    being backed up to more than one device, it is written to each device at the
+    same time.
+    """
+
     def __init__(self):
+        # Key is device id
+        self.devices = {}  # type: Dict[int, BackupDeviceState]
+        # The device a file is being copied to, when it is copied to only one
+        self.device = None  # type: Optional[BackupDeviceState]
+        # The devices a file is being copied to, when it is copied to several
+        self.copying_to = []  # type: List[BackupDeviceState]
         self.problems = BackingUpProblems()
+        # How many times to back up a file again if its backup does not match it
+        self.verification_retries = 2
+        # Send back only what changed in the files received from the main process
+        RPDFile.track_changes = True
         super().__init__("BackupFiles")
 
-    def update_progress(self, amount_downloaded, total):
-        self.amount_downloaded = amount_downloaded
-        chunk_downloaded = amount_downloaded - self.bytes_downloaded
-        if (chunk_downloaded > self.batch_size_bytes) or (amount_downloaded == total):
-            self.bytes_downloaded = amount_downloaded
+    def backup_device(self, destination: BackupDestination) -> BackupDeviceState:
+        device = self.devices.get(destination.device_id)
+        if device is None:
+            device = BackupDeviceState(destination)
+            self.devices[destination.device_id] = device
+        return device
+
+    def update_progress(self, amount_downloaded: int, total: int) -> None:
+        self.report_progress(self.device, amount_downloaded, total)
+
+    def update_destination_progress(
+        self, index: int, amount_downloaded: int, total: int
+    ) -> None:
+        self.report_progress(self.copying_to[index], amount_downloaded, total)
+
+    def report_progress(
+        self, device: BackupDeviceState, amount_downloaded: int, total: int
+    ) -> None:
+        device.amount_downloaded = amount_downloaded
+        chunk_downloaded = amount_downloaded - device.bytes_downloaded
+        if chunk_downloaded > self.batch_size_bytes or (
+            amount_downloaded == total and chunk_downloaded
+        ):
+            device.bytes_downloaded = amount_downloaded
             self.content = pickle.dumps(
                 BackupResults(
                     scan_id=self.scan_id,
-                    device_id=self.device_id,
-                    total_downloaded=self.total_downloaded + amount_downloaded,
+                    device_id=device.device_id,
+                    total_downloaded=device.total_downloaded + amount_downloaded,
                     chunk_downloaded=chunk_downloaded,
                 ),
                 pickle.HIGHEST_PROTOCOL,
             )
             self.send_message_to_sink()
 
-            # if amount_downloaded == total:
-            #     self.bytes_downloaded = 0
-
     def backup_associate_file(self, dest_dir: str, full_file_name: str) -> None:
         """
         Backs up small files like XMP or THM files
@@ -107,145 +161,275 @@ class BackupFilesWorker(WorkerInPublishPullPipeline, FileCopy):
             # ignore any metadata copying errors
             copy_file_metadata(full_file_name, full_dest_name)
 
-    def do_backup(self, data: BackupFileData) -> None:
-        rpd_file = data.rpd_file
-        backup_succeeded = False
-        self.scan_id = rpd_file.scan_id
-        self.verify_file = data.verify_file
-
-        mdata_exceptions = None
-
-        if not (data.move_succeeded and data.do_backup):
-            backup_full_file_name = ""
-        else:
-            self.total_reached = False
+    def prepare_backup(
+        self, device: BackupDeviceState, data: BackupFileData
+    ) -> Tuple[str, str, bool]:
+        """
+        Create the subfolder on the backup device the file is to be backed up to,
+        and check if the file has already been backed up there.
 
-            if data.path_suffix is None:
-                dest_base_dir = self.path
-            else:
-                dest_base_dir = os.path.join(self.path, data.path_suffix)
+        :param device: device to back up to
+        :param data: the file to back up
+        :return: the subfolder, the full file name of the backup, and whether the
+         file should be copied to the device
+        """
 
-            dest_dir = os.path.join(dest_base_dir, rpd_file.download_subfolder)
-            backup_full_file_name = os.path.join(dest_dir, rpd_file.download_name)
+        rpd_file = data.rpd_file
 
-            if not os.path.isdir(dest_dir):
-                # create the subfolders on the backup path
-                try:
-                    logging.debug(
-                        "Creating subfolder %s on backup device %s...",
-                        dest_dir,
-                        self.device_name,
-                    )
-                    os.makedirs(dest_dir)
-                    logging.debug("...backup subfolder created")
-                except (OSError, PermissionError, FileNotFoundError) as inst:
-                    # There is a minuscule chance directory may have been
-                    # created by another process between the time it
-                    # takes to query and the time it takes to create a
-                    # new directory. Ignore that error.
-                    if inst.errno != errno.EEXIST:
-                        logging.error(
-                            "Failed to create backup subfolder: %s",
-                            rpd_file.download_path,
-                        )
-                        logging.error(inst)
-
-                        self.problems.append(
-                            BackupSubfolderCreationProblem(
-                                folder=make_href(
-                                    name=rpd_file.download_subfolder,
-                                    uri=get_uri(path=dest_dir),
-                                ),
-                                exception=inst,
-                            )
-                        )
+        if data.path_suffix is None:
+            dest_base_dir = device.path
+        else:
+            dest_base_dir = os.path.join(device.path, data.path_suffix)
 
-            backup_already_exists = os.path.exists(backup_full_file_name)
+        dest_dir = os.path.join(dest_base_dir, rpd_file.download_subfolder)
+        backup_full_file_name = os.path.join(dest_dir, rpd_file.download_name)
 
-            if backup_already_exists:
-                try:
-                    modification_time = os.path.getmtime(backup_full_file_name)
-                    dt = datetime.fromtimestamp(modification_time)
-                    date = dt.strftime("%x")
-                    time = dt.strftime("%X")
-                except Exception:
+        if not os.path.isdir(dest_dir):
+            # create the subfolders on the backup path
+            try:
+                logging.debug(
+                    "Creating subfolder %s on backup device %s...",
+                    dest_dir,
+                    device.device_name,
+                )
+                os.makedirs(dest_dir)
+                logging.debug("...backup subfolder created")
+            except (OSError, PermissionError, FileNotFoundError) as inst:
+                # There is a minuscule chance directory may have been
+                # created by another process between the time it
+                # takes to query and the time it takes to create a
+                # new directory. Ignore that error.
+                if inst.errno != errno.EEXIST:
                     logging.error(
-                        "Could not determine the file modification time of %s",
-                        backup_full_file_name,
+                        "Failed to create backup subfolder: %s",
+                        rpd_file.download_path,
                     )
-                    date = time = ""
+                    logging.error(inst)
 
-                source = rpd_file.get_souce_href()
-                device = make_href(
-                    name=rpd_file.device_display_name, uri=rpd_file.device_uri
-                )
-
-                if data.backup_duplicate_overwrite:
                     self.problems.append(
-                        BackupOverwrittenProblem(
-                            file_type_capitalized=rpd_file.title_capitalized,
-                            file_type=rpd_file.title,
-                            name=rpd_file.download_name,
-                            uri=get_uri(full_file_name=backup_full_file_name),
-                            source=source,
-                            device=device,
-                            date=date,
-                            time=time,
+                        BackupSubfolderCreationProblem(
+                            folder=make_href(
+                                name=rpd_file.download_subfolder,
+                                uri=get_uri(path=dest_dir),
+                            ),
+                            exception=inst,
                         )
                     )
-                    msg = "Overwriting backup file %s" % backup_full_file_name
-                else:
-                    self.problems.append(
-                        BackupAlreadyExistsProblem(
-                            file_type_capitalized=rpd_file.title_capitalized,
-                            file_type=rpd_file.title,
-                            name=rpd_file.download_name,
-                            uri=get_uri(full_file_name=backup_full_file_name),
-                            source=source,
-                            device=device,
-                            date=date,
-                            time=time,
-                        )
+
+        backup_already_exists = os.path.exists(backup_full_file_name)
+
+        if backup_already_exists:
+            try:
+                modification_time = os.path.getmtime(backup_full_file_name)
+                dt = datetime.fromtimestamp(modification_time)
+                date = dt.strftime("%x")
+                time = dt.strftime("%X")
+            except Exception:
+                logging.error(
+                    "Could not determine the file modification time of %s",
+                    backup_full_file_name,
+                )
+                date = time = ""
+
+            source = rpd_file.get_souce_href()
+            device_href = make_href(
+                name=rpd_file.device_display_name, uri=rpd_file.device_uri
+            )
+
+            if data.backup_duplicate_overwrite:
+                self.problems.append(
+                    BackupOverwrittenProblem(
+                        file_type_capitalized=rpd_file.title_capitalized,
+                        file_type=rpd_file.title,
+                        name=rpd_file.download_name,
+                        uri=get_uri(full_file_name=backup_full_file_name),
+                        source=source,
+                        device=device_href,
+                        date=date,
+                        time=time,
                     )
-                    msg = (
-                        "Skipping backup of file %s because it already exists"
-                        % backup_full_file_name
+                )
+                msg = "Overwriting backup file %s" % backup_full_file_name
+            else:
+                self.problems.append(
+                    BackupAlreadyExistsProblem(
+                        file_type_capitalized=rpd_file.title_capitalized,
+                        file_type=rpd_file.title,
+                        name=rpd_file.download_name,
+                        uri=get_uri(full_file_name=backup_full_file_name),
+                        source=source,
+                        device=device_href,
+                        date=date,
+                        time=time,
                     )
-                logging.warning(msg)
+                )
+                msg = (
+                    "Skipping backup of file %s because it already exists"
+                    % backup_full_file_name
+                )
+            logging.warning(msg)
 
-            if not backup_already_exists or data.backup_duplicate_overwrite:
-                logging.debug(
-                    "Backing up file %s on device %s...",
-                    data.download_count,
-                    self.device_name,
+        return (
+            dest_dir,
+            backup_full_file_name,
+            not backup_already_exists or data.backup_duplicate_overwrite,
+        )
+
+    def copy_to_devices(
+        self, rpd_file: RPDFile, copies: List[Tuple[BackupDeviceState, str]]
+    ) -> List[bool]:
+        """
+        Copy the downloaded file to the backup devices, reading it only once.
+
+        :param rpd_file: file to back up
+        :param copies: devices to copy the file to, and the full file name of
+         each copy
+        :return: for each device, whether the copy succeeded
+        """
+
+        source = rpd_file.download_full_file_name
+
+        if len(copies) == 1:
+            self.device, destination = copies[0]
+            self.problems = self.device.problems
+            return [
+                self.copy_from_filesystem(source, destination, rpd_file, verify=False)
+            ]
+
+        self.copying_to = [device for device, destination in copies]
+        exceptions = self.copy_to_destinations(
+            source, [destination for device, destination in copies], rpd_file
+        )
+
+        results = []
+        for (device, destination), exception in zip(copies, exceptions):
+            self.problems = device.problems
+            if exception is not None:
+                self.problems.append(
+                    FileCopyProblem(
+                        name=os.path.basename(source),
+                        uri=get_uri(full_file_name=source),
+                        exception=exception,
+                    )
                 )
-                source = rpd_file.download_full_file_name
-                destination = backup_full_file_name
-                backup_succeeded = self.copy_from_filesystem(
-                    source, destination, rpd_file
+                results.append(False)
+            else:
+                results.append(True)
+        return results
+
+    def verify_backup(
+        self, device: BackupDeviceState, rpd_file: RPDFile, backup_full_file_name: str
+    ) -> bool:
+        """
+        Check the backup matches the file as it was when it was downloaded. If it
+        does not, back it up again, up to verification_retries times.
+
+        :param device: device the file was backed up to
+        :param rpd_file: file details, with the checksum calculated when the file
+         was downloaded
+        :param backup_full_file_name: the backup
+        :return: True if the backup matches, else False
+        """
+
+        self.problems = device.problems
+        retries = 0
+        while not self.copy_matches(backup_full_file_name, rpd_file):
+            if retries == self.verification_retries:
+                self.report_verification_failure(backup_full_file_name, rpd_file)
+                return False
+            retries += 1
+            logging.warning(
+                "Backup %s does not match the downloaded file. Backing it up again "
+                "(attempt %s of %s)",
+                backup_full_file_name,
+                retries,
+                self.verification_retries,
+            )
+            self.device = device
+            if not self.copy_from_filesystem(
+                rpd_file.download_full_file_name,
+                backup_full_file_name,
+                rpd_file,
+                verify=False,
+            ):
+                return False
+        return True
+
+    def do_backup(self, data: BackupFileData) -> None:
+        rpd_file = data.rpd_file
+        self.scan_id = rpd_file.scan_id
+        self.verify_file = data.verify_file
+
+        devices = [self.backup_device(destination) for destination in data.destinations]
+        # Key is device id
+        backup_full_file_names = {}  # type: Dict[int, str]
+        dest_dirs = {}  # type: Dict[int, str]
+        backups_succeeded = {}  # type: Dict[int, bool]
+        mdata_exceptions = {}  # type: Dict[int, Optional[Tuple]]
+        # Value is None if the backup was not verified
+        verified = {}  # type: Dict[int, Optional[bool]]
+
+        copies = []  # type: List[Tuple[BackupDeviceState, str]]
+        for device, destination in zip(devices, data.destinations):
+            device.amount_downloaded = device.bytes_downloaded = 0
+            backup_full_file_names[device.device_id] = ""
+            backups_succeeded[device.device_id] = False
+            mdata_exceptions[device.device_id] = None
+            verified[device.device_id] = None
+            if data.move_succeeded and destination.do_backup:
+                self.problems = device.problems
+                dest_dir, backup_full_file_name, do_copy = self.prepare_backup(
+                    device, data
                 )
+                dest_dirs[device.device_id] = dest_dir
+                backup_full_file_names[device.device_id] = backup_full_file_name
+                if do_copy:
+                    logging.debug(
+                        "Backing up file %s on device %s...",
+                        data.download_count,
+                        device.device_name,
+                    )
+                    copies.append((device, backup_full_file_name))
+
+        if copies and self.verify_file and rpd_file.checksum is None:
+            # The checksum is normally calculated when the file is downloaded
+            rpd_file.checksum = file_checksum(
+                rpd_file.download_full_file_name,
+                check_for_command=self.check_for_controller_directive,
+            )
+
+        if copies:
+            for (device, backup_full_file_name), backup_succeeded in zip(
+                copies, self.copy_to_devices(rpd_file, copies)
+            ):
                 if backup_succeeded and self.verify_file:
-                    md5 = hashlib.md5(open(backup_full_file_name).read()).hexdigest()
-                    if md5 != rpd_file.md5:
-                        pass
+                    backup_succeeded = self.verify_backup(
+                        device, rpd_file, backup_full_file_name
+                    )
+                    verified[device.device_id] = backup_succeeded
+                backups_succeeded[device.device_id] = backup_succeeded
                 if backup_succeeded:
                     logging.debug(
                         "...backing up file %s on device %s succeeded",
                         data.download_count,
-                        self.device_name,
+                        device.device_name,
                     )
-
-                if backup_succeeded:
-                    mdata_exceptions = copy_file_metadata(
+                    mdata_exceptions[device.device_id] = copy_file_metadata(
                         rpd_file.download_full_file_name, backup_full_file_name
                     )
-            if not backup_succeeded:
+
+        for device, destination in zip(devices, data.destinations):
+            if not (data.move_succeeded and destination.do_backup):
+                continue
+            self.problems = device.problems
+            if not backups_succeeded[device.device_id]:
                 if rpd_file.status == DownloadStatus.download_failed:
                     rpd_file.status = DownloadStatus.download_and_backup_failed
-                else:
+                elif rpd_file.status != DownloadStatus.download_and_backup_failed:
                     rpd_file.status = DownloadStatus.backup_problem
             else:
                 # backup any THM, audio or XMP files
+                dest_dir = dest_dirs[device.device_id]
                 if rpd_file.download_thm_full_name:
                     self.backup_associate_file(
                         dest_dir, rpd_file.download_thm_full_name
@@ -263,77 +447,79 @@ class BackupFilesWorker(WorkerInPublishPullPipeline, FileCopy):
                         dest_dir, rpd_file.download_log_full_name
                     )
 
-        self.total_downloaded += rpd_file.size
-        bytes_not_downloaded = rpd_file.size - self.amount_downloaded
-        if bytes_not_downloaded and data.do_backup:
+        # Reply only once every device is finished with, so that each reply
+        # includes all the changes made to the file
+        for device, destination in zip(devices, data.destinations):
+            device.total_downloaded += rpd_file.size
+            bytes_not_downloaded = rpd_file.size - device.amount_downloaded
+            if bytes_not_downloaded and destination.do_backup:
+                self.content = pickle.dumps(
+                    BackupResults(
+                        scan_id=self.scan_id,
+                        device_id=device.device_id,
+                        total_downloaded=device.total_downloaded,
+                        chunk_downloaded=bytes_not_downloaded,
+                    ),
+                    pickle.HIGHEST_PROTOCOL,
+                )
+                self.send_message_to_sink()
+
             self.content = pickle.dumps(
                 BackupResults(
                     scan_id=self.scan_id,
-                    device_id=self.device_id,
-                    total_downloaded=self.total_downloaded,
-                    chunk_downloaded=bytes_not_downloaded,
+                    device_id=device.device_id,
+                    backup_succeeded=backups_succeeded[device.device_id],
+                    do_backup=destination.do_backup,
+                    rpd_file=RPDFileChanges(rpd_file),
+                    backup_full_file_name=backup_full_file_names[device.device_id],
+                    mdata_exceptions=mdata_exceptions[device.device_id],
+                    verified=verified[device.device_id],
                 ),
                 pickle.HIGHEST_PROTOCOL,
             )
             self.send_message_to_sink()
 
-        self.content = pickle.dumps(
-            BackupResults(
-                scan_id=self.scan_id,
-                device_id=self.device_id,
-                backup_succeeded=backup_succeeded,
-                do_backup=data.do_backup,
-                rpd_file=rpd_file,
-                backup_full_file_name=backup_full_file_name,
-                mdata_exceptions=mdata_exceptions,
-            ),
-            pickle.HIGHEST_PROTOCOL,
-        )
-        self.send_message_to_sink()
-
-    def reset_problems(self) -> None:
-        self.problems = BackingUpProblems(name=self.device_name, uri=self.uri)
-
-    def send_problems(self) -> None:
-        if self.problems:
+    def send_problems(self, device: BackupDeviceState) -> None:
+        if device.problems:
             self.content = pickle.dumps(
                 BackupResults(
                     scan_id=self.scan_id,
-                    device_id=self.device_id,
-                    problems=self.problems,
+                    device_id=device.device_id,
+                    problems=device.problems,
                 ),
                 pickle.HIGHEST_PROTOCOL,
             )
             self.send_message_to_sink()
-            self.reset_problems()
+            device.reset_problems()
+
+    def pausing(self) -> None:
+        # Let other processes use the devices while the download is paused
+        self.io_scheduler.suspend()
+
+    def resuming(self) -> None:
+        self.io_scheduler.resume()
 
     def cleanup_pre_stop(self):
-        self.send_problems()
+        for device in self.devices.values():
+            self.send_problems(device)
 
     def do_work(self):
-
-        backup_arguments = pickle.loads(self.content)
-        self.path = backup_arguments.path
-        self.device_name = backup_arguments.device_name
-        self.uri = get_uri(path=self.path)
         self.fdo_cache_normal = FdoCacheNormal()
         self.fdo_cache_large = FdoCacheLarge()
 
         while True:
             worker_id, directive, content = self.receiver.recv_multipart()
-            self.device_id = int(worker_id)
 
             self.check_for_command(directive, content)
 
             data = pickle.loads(content)  # type: BackupFileData
             if data.message == BackupStatus.backup_started:
-                self.reset_problems()
+                for destination in data.destinations:
+                    self.backup_device(destination).reset_problems()
             elif data.message == BackupStatus.backup_completed:
-                self.send_problems()
+                for destination in data.destinations:
+                    self.send_problems(self.backup_device(destination))
             else:
-                self.amount_downloaded = 0
-                self.init_copy_progress()
-
                 self.do_backup(data=data)
 
 
@@ -29,6 +29,8 @@ Rapid Photo Downloader deals with three types of cache:
    Location: /home/USER/.cache/rapid-photo-downloader/thumbnails/
    (Actual location may vary depending on value of environment variable
    XDG_CACHE_HOME)
+   The thumbnails are packed into segment files in the subfolder segments/,
+   and the database records where in the segments each thumbnail is.
 
 2. A cache of actual full files downloaded from a camera, which are then used
    to extract the thumbnail from. Since these same files could be downloaded,
@@ -51,17 +53,18 @@ __copyright__ = "Copyright 2015-2021, Damon Lynch"
 
 import os
 import sys
+import mmap
 import logging
 import hashlib
 from urllib.request import pathname2url
 import time
 import shutil
-from collections import namedtuple
-from typing import Optional, Tuple, Union
+from collections import namedtuple, defaultdict, OrderedDict
+from typing import Optional, Tuple, Union, Dict, List, Sequence, Iterator
 import sqlite3
 
-from PyQt5.QtCore import QSize
-from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QSize, QBuffer, QIODevice
+from PyQt5.QtGui import QImage, QImageReader
 
 from raphodo.storage.storage import (
     get_program_cache_directory,
@@ -72,12 +75,27 @@ from raphodo.constants import ThumbnailCacheDiskStatus
 from raphodo.rpdsql import CacheSQL
 
 
-GetThumbnail = namedtuple("GetThumbnail", "disk_status, thumbnail, path")
-GetThumbnailPath = namedtuple(
-    "GetThumbnailPath", "disk_status, path, mdatatime, orientation_unknown"
+GetThumbnail = namedtuple("GetThumbnail", "disk_status, thumbnail, path, size")
+GetCachedThumbnail = namedtuple(
+    "GetCachedThumbnail", "disk_status, thumbnail_bytes, mdatatime, orientation_unknown"
 )
 
 
+def thumbnail_to_jpeg(thumbnail: QImage) -> bytes:
+    """
+    Encode a thumbnail the way it is saved in the Rapid Photo Downloader thumbnail
+    cache: in JPEG format with 75% compression.
+
+    :param thumbnail: the thumbnail to encode
+    :return: the JPEG data
+    """
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    thumbnail.save(buffer, "jpg", quality=75)
+    return buffer.data().data()
+
+
 class MD5Name:
     """Generate MD5 hashes for file names."""
 
@@ -275,6 +293,38 @@ class Cache:
                     return png
         return None
 
+    def _probe_thumbnail(
+        self, path: str, modification_time: float, size: int
+    ) -> Optional[QSize]:
+        """
+        Like _get_thumbnail(), but without decoding the thumbnail unless there is
+        no other way to check it is current.
+
+        :return: the size of the thumbnail if it is current, else None
+        """
+
+        reader = QImageReader(path)
+        if not reader.canRead():
+            return None
+        thumb_mtime = reader.text("Thumb::MTime")
+        thumb_size = reader.text("Thumb::Size")
+        if not thumb_mtime or not thumb_size:
+            # The text can follow the image data, in which case the image must be
+            # loaded to read it
+            png = self._get_thumbnail(path, modification_time, size)
+            return None if png is None else png.size()
+        try:
+            current = (
+                float(thumb_mtime) == float(modification_time)
+                and int(thumb_size) == size
+            )
+        except ValueError:
+            return None
+        if not current:
+            return None
+        thumbnail_size = reader.size()
+        return thumbnail_size if thumbnail_size.isValid() else None
+
     def get_thumbnail_md5_name(
         self, full_file_name: str, camera_model: Optional[str] = None
     ) -> str:
@@ -300,6 +350,7 @@ class Cache:
         modification_time,
         size: int,
         camera_model: Optional[str] = None,
+        read_thumbnail: bool = True,
     ) -> GetThumbnail:
         """
         Attempt to retrieve a thumbnail from the thumbnail cache.
@@ -311,27 +362,38 @@ class Cache:
          into a float if it's not already
         :param camera_model: optional camera model. If the thumbnail is
          not from a camera, then should be None.
+        :param read_thumbnail: if False, only check the thumbnail is current
+         and determine its size, without decoding it if possible
         :return a GetThumbnail tuple of (1) ThumbnailCacheDiskStatus,
          to indicate whether the thumbnail was found, a failure, or
-         missing (2) the thumbnail as QImage, if found (or None), and
-         (3) the path (including the md5 name), else None,
+         missing (2) the thumbnail as QImage, if found and read_thumbnail
+         is True (or None), (3) the path (including the md5 name), else None,
+         and (4) the size of the thumbnail if found, else None
         """
 
         if not self.valid:
-            return GetThumbnail(ThumbnailCacheDiskStatus.not_found, None, None)
+            return GetThumbnail(ThumbnailCacheDiskStatus.not_found, None, None, None)
         md5_name, uri = self.md5.md5_hash_name(
             full_file_name=full_file_name, camera_model=camera_model
         )
         path = os.path.join(self.cache_dir, md5_name)
-        png = self._get_thumbnail(path, modification_time, size)
-        if png is not None:
-            return GetThumbnail(ThumbnailCacheDiskStatus.found, png, path)
-        if self.failure_dir is not None:
-            path = os.path.join(self.failure_dir, md5_name)
+        if read_thumbnail:
             png = self._get_thumbnail(path, modification_time, size)
             if png is not None:
-                return GetThumbnail(ThumbnailCacheDiskStatus.failure, None, None)
-        return GetThumbnail(ThumbnailCacheDiskStatus.not_found, None, None)
+                return GetThumbnail(
+                    ThumbnailCacheDiskStatus.found, png, path, png.size()
+                )
+        else:
+            thumbnail_size = self._probe_thumbnail(path, modification_time, size)
+            if thumbnail_size is not None:
+                return GetThumbnail(
+                    ThumbnailCacheDiskStatus.found, None, path, thumbnail_size
+                )
+        if self.failure_dir is not None:
+            path = os.path.join(self.failure_dir, md5_name)
+            if self._probe_thumbnail(path, modification_time, size) is not None:
+                return GetThumbnail(ThumbnailCacheDiskStatus.failure, None, None, None)
+        return GetThumbnail(ThumbnailCacheDiskStatus.not_found, None, None, None)
 
     def modify_existing_thumbnail_and_save_copy(
         self,
@@ -403,9 +465,232 @@ class FdoCacheLarge(Cache):
         super().__init__(cache_dir, failure_dir)
 
 
+class ThumbnailSegments:
+    """
+    Thumbnails packed one after the other into segment files, rather than each
+    being saved in a file of its own.
+
+    Each process appends to a segment of its own, so no locking is needed. Segments
+    are only ever appended to, until they are compacted when no other process is
+    using the cache. Segments are read using mmap.
+    """
+
+    # Start a new segment once the current one reaches this size
+    max_segment_size = 64 * 1024 * 1024
+
+    # When reading many thumbnails at once, the most that is read in one go, and
+    # the largest gap between thumbnails that is read through rather than skipped
+    max_read_size = 4 * 1024 * 1024
+    max_read_gap = 64 * 1024
+
+    # How many segments to keep mapped into memory at most, the least recently
+    # read being unmapped first
+    max_maps = 16
+
+    def __init__(self, segment_dir: str) -> None:
+        """
+        :param segment_dir: the directory the segment files are in
+        """
+
+        self.segment_dir = segment_dir
+        self.random_filename = GenerateRandomFileName()
+        # The segment this process appends to
+        self.segment = None  # type: Optional[str]
+        self.segment_file = None
+        # Segments mapped into memory for reading, least recently read first
+        self.maps = OrderedDict()  # type: Dict[str, mmap.mmap]
+
+    def path(self, segment: str) -> str:
+        return os.path.join(self.segment_dir, segment)
+
+    def segments(self) -> List[str]:
+        """
+        :return: the names of all segment files
+        """
+
+        try:
+            return [
+                entry.name
+                for entry in os.scandir(self.segment_dir)
+                if entry.name.endswith(".segment") and entry.is_file()
+            ]
+        except FileNotFoundError:
+            return []
+
+    def _new_segment(self) -> None:
+        self.close_segment()
+        os.makedirs(self.segment_dir, 0o700, exist_ok=True)
+        self.segment = self.random_filename.name(extension="segment")
+        self.segment_file = open(self.path(self.segment), "xb")
+        os.chmod(self.path(self.segment), 0o600)
+
+    def append(self, data: bytes) -> Tuple[str, int, int]:
+        """
+        Append a thumbnail to this process's segment.
+
+        Raises OSError if the thumbnail could not be written.
+
+        :param data: thumbnail in JPEG format
+        :return: the segment name, and offset and length of the thumbnail in it
+        """
+
+        if (
+            self.segment_file is None
+            or self.segment_file.tell() >= self.max_segment_size
+        ):
+            self._new_segment()
+        offset = self.segment_file.tell()
+        self.segment_file.write(data)
+        # Make the thumbnail available to other processes before it is added to
+        # the database
+        self.segment_file.flush()
+        return self.segment, offset, len(data)
+
+    def read(self, segment: str, offset: int, length: int) -> Optional[bytes]:
+        """
+        :param segment: name of the segment
+        :param offset: offset of the thumbnail in the segment
+        :param length: length of the thumbnail
+        :return: the thumbnail, or None if the segment is missing or too short
+        """
+
+        end = offset + length
+        mapped = self.maps.get(segment)
+        if mapped is None or end > len(mapped):
+            # Either not yet mapped, or it has since been appended to
+            if mapped is not None:
+                self.unmap(segment)
+            else:
+                self.unmap_missing()
+            try:
+                with open(self.path(segment), "rb") as segment_file:
+                    mapped = mmap.mmap(
+                        segment_file.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+            except (OSError, ValueError):
+                # ValueError is raised for an empty file
+                return None
+            self.maps[segment] = mapped
+            while len(self.maps) > self.max_maps:
+                self.unmap(next(iter(self.maps)))
+            if end > len(mapped):
+                return None
+        else:
+            self.maps.move_to_end(segment)
+        return mapped[offset:end]
+
+    def unmap(self, segment: str) -> None:
+        """
+        :param segment: name of the segment to unmap, if it is mapped
+        """
+
+        mapped = self.maps.pop(segment, None)
+        if mapped is not None:
+            mapped.close()
+
+    def unmap_missing(self) -> None:
+        """
+        Unmap segments that no longer exist, e.g. because they have been compacted
+        """
+
+        missing = [
+            segment for segment in self.maps if not os.path.exists(self.path(segment))
+        ]
+        for segment in missing:
+            self.unmap(segment)
+
+    def read_many(
+        self, thumbnails: Sequence[Tuple[str, int, int]]
+    ) -> List[Optional[bytes]]:
+        """
+        Read many thumbnails at once.
+
+        Thumbnails are read in the order they are in each segment. Thumbnails close
+        to one another are read together, so that most of the cache is read using
+        a few large sequential reads rather than one small read per thumbnail.
+
+        :param thumbnails: segment name, offset and length of each thumbnail
+        :return: for each thumbnail, in the order passed, the thumbnail, or None if
+         its segment is missing or too short
+        """
+
+        results = [None] * len(thumbnails)  # type: List[Optional[bytes]]
+        by_segment = defaultdict(list)  # type: Dict[str, List[Tuple[int, int, int]]]
+        for idx, (segment, offset, length) in enumerate(thumbnails):
+            by_segment[segment].append((offset, length, idx))
+
+        for segment, wanted in by_segment.items():
+            wanted.sort()
+            try:
+                segment_file = open(self.path(segment), "rb")
+            except OSError:
+                continue
+            with segment_file:
+                start = 0
+                while start < len(wanted):
+                    # Extend the read over the thumbnails that follow, as long as
+                    # little is read that is not needed
+                    span_start = wanted[start][0]
+                    span_end = span_start + wanted[start][1]
+                    end = start + 1
+                    while (
+                        end < len(wanted)
+                        and wanted[end][0] - span_end <= self.max_read_gap
+                        and wanted[end][0] + wanted[end][1] - span_start
+                        <= self.max_read_size
+                    ):
+                        span_end = max(span_end, wanted[end][0] + wanted[end][1])
+                        end += 1
+                    try:
+                        segment_file.seek(span_start)
+                        data = segment_file.read(span_end - span_start)
+                    except OSError:
+                        break
+                    for offset, length, idx in wanted[start:end]:
+                        if offset + length - span_start <= len(data):
+                            results[idx] = data[
+                                offset - span_start : offset + length - span_start
+                            ]
+                    start = end
+
+        return results
+
+    def close_segment(self) -> None:
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment = None
+
+    def close(self) -> None:
+        """
+        Close the segment being appended to, and unmap all segments
+        """
+
+        self.close_segment()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = OrderedDict()
+
+
 class ThumbnailCacheSql:
+    """
+    The Rapid Photo Downloader thumbnail cache.
+
+    Thumbnails are packed into segment files, and located using the offsets recorded
+    for them in the database. Thumbnails cached by earlier versions of the program
+    are each in a file of their own, until optimize() packs them into segments.
+    """
 
-    not_found = GetThumbnailPath(ThumbnailCacheDiskStatus.not_found, None, None, None)
+    not_found = GetCachedThumbnail(ThumbnailCacheDiskStatus.not_found, None, None, None)
+
+    # How often to update the time a thumbnail was last read, in seconds
+    access_resolution = 60 * 60 * 24
+
+    # Rewrite segments less than half of which is used by current thumbnails
+    min_segment_use = 0.5
+
+    # How many thumbnails get_thumbnails() reads at once
+    get_thumbnails_chunk_size = 256
 
     def __init__(self, create_table_if_not_exists: bool) -> None:
         self.cache_dir = get_program_cache_directory(create_if_not_exist=True)
@@ -437,6 +722,7 @@ class ThumbnailCacheSql:
             self.random_filename = GenerateRandomFileName()
             self.md5 = MD5Name()
             self.thumb_db = CacheSQL(self.cache_dir, create_table_if_not_exists)
+            self.segments = ThumbnailSegments(os.path.join(self.cache_dir, "segments"))
 
     def save_thumbnail(
         self,
@@ -448,7 +734,8 @@ class ThumbnailCacheSql:
         orientation_unknown: bool,
         thumbnail: Optional[QImage],
         camera_model: Optional[str] = None,
-    ) -> Optional[str]:
+        thumbnail_jpeg: Optional[bytes] = None,
+    ) -> bool:
         """
         Save in the thumbnail cache using jpeg 75% compression.
 
@@ -460,27 +747,42 @@ class ThumbnailCacheSql:
         :param mdatatime: file time recorded in metadata
         :param generation_failed: True if the thumbnail is meant to
          signify the application failed to generate the thumbnail. If
-         so, it will be saved as an empty PNG in the application
-         subdirectory in the fail cache directory.
+         so, only the failure is recorded in the database.
         :param thumbnail: the thumbnail to be saved. Will not be
          resized. Will be ignored if generation_failed is True.
         :param camera_model: optional camera model. If the thumbnail is
          not from a camera, then should be None.
-        :return the path of the saved file, else None if operation
-        failed
+        :param thumbnail_jpeg: the thumbnail already encoded using
+         thumbnail_to_jpeg(), which if specified is saved instead of
+         encoding the thumbnail again
+        :return True if the thumbnail was saved, else False
         """
 
         if not self.valid:
-            return None
+            return False
 
         md5_name, uri = self.md5.md5_hash_name(
             full_file_name=full_file_name, camera_model=camera_model, extension="jpg"
         )
 
+        segment = segment_offset = segment_length = None
         if generation_failed:
             logging.debug("Marking thumbnail for %s as 'generation failed'", uri)
         else:
             logging.debug("Saving thumbnail for %s in RPD thumbnail cache", uri)
+            if thumbnail_jpeg is None:
+                thumbnail_jpeg = thumbnail_to_jpeg(thumbnail)
+            if not thumbnail_jpeg:
+                return False
+            # The thumbnail must be written before the database records where it is
+            try:
+                segment, segment_offset, segment_length = self.segments.append(
+                    thumbnail_jpeg
+                )
+            except OSError as e:
+                logging.error("Unable to save thumbnail for %s: %s", uri, e)
+                self.segments.close_segment()
+                return False
 
         try:
             self.thumb_db.add_thumbnail(
@@ -491,37 +793,28 @@ class ThumbnailCacheSql:
                 md5_name=md5_name,
                 orientation_unknown=orientation_unknown,
                 failure=generation_failed,
+                segment=segment,
+                segment_offset=segment_offset,
+                segment_length=segment_length,
             )
         except sqlite3.OperationalError as e:
             logging.error(
                 "Database error adding thumbnail for %s: %s. Will not retry.", uri, e
             )
-            return None
-
-        if generation_failed:
-            return None
-
-        md5_full_name = os.path.join(self.cache_dir, md5_name)
-
-        temp_path = os.path.join(
-            self.cache_dir, self.random_filename.name(extension="jpg")
-        )
-
-        if thumbnail.save(temp_path, format="jpg", quality=75):
-            try:
-                os.rename(temp_path, md5_full_name)
-                os.chmod(md5_full_name, 0o600)
-            except OSError:
-                return None
+            return False
 
-            return md5_full_name
-        return None
+        return not generation_failed
 
-    def get_thumbnail_path(
-        self, full_file_name: str, mtime, size: int, camera_model: str = None
-    ) -> GetThumbnailPath:
+    def get_thumbnail(
+        self,
+        full_file_name: str,
+        mtime,
+        size: int,
+        camera_model: str = None,
+        read_thumbnail: bool = True,
+    ) -> GetCachedThumbnail:
         """
-        Attempt to get a thumbnail's path from the thumbnail cache.
+        Attempt to get a thumbnail from the thumbnail cache.
 
         :param full_file_name: full path of the file (including file
         name). Will be turned into an absolute path if it is a file
@@ -531,11 +824,14 @@ class ThumbnailCacheSql:
          into a float if it's not already
         :param camera_model: optional camera model. If the thumbnail is
          not from a camera, then should be None.
-        :return a GetThumbnailPath tuple of (1) ThumbnailCacheDiskStatus,
+        :param read_thumbnail: if False, only determine whether the
+         thumbnail is in the cache, and do not read it
+        :return a GetCachedThumbnail tuple of (1) ThumbnailCacheDiskStatus,
          to indicate whether the thumbnail was found, a failure, or
-         missing, (2) the path (including the md5 name), else None,
-         (3) the file's metadata time, and (4) a bool indicating whether
-         the orientation of the thumbnail is unknown
+         missing, (2) the thumbnail in JPEG format if it was found and
+         read_thumbnail is True, else None, (3) the file's metadata time,
+         and (4) a bool indicating whether the orientation of the thumbnail
+         is unknown
         """
 
         if not self.valid:
@@ -548,48 +844,262 @@ class ThumbnailCacheSql:
             return self.not_found
 
         if in_cache.failure:
-            return GetThumbnailPath(
+            return GetCachedThumbnail(
                 ThumbnailCacheDiskStatus.failure, None, in_cache.mdatatime, None
             )
 
-        path = os.path.join(self.cache_dir, in_cache.md5_name)
-        if not os.path.exists(path):
-            self.thumb_db.delete_thumbnails([in_cache.md5_name])
-            return self.not_found
+        thumbnail_bytes = None
+        if in_cache.segment is None:
+            # Saved by an earlier version of the program
+            path = os.path.join(self.cache_dir, in_cache.md5_name)
+            try:
+                if read_thumbnail:
+                    with open(path, "rb") as thumbnail:
+                        thumbnail_bytes = thumbnail.read()
+                elif not os.path.exists(path):
+                    raise FileNotFoundError
+            except OSError:
+                self.thumb_db.delete_thumbnails([in_cache.md5_name])
+                return self.not_found
+        elif read_thumbnail:
+            thumbnail_bytes = self.segments.read(
+                in_cache.segment, in_cache.segment_offset, in_cache.segment_length
+            )
+            if thumbnail_bytes is None:
+                self.thumb_db.delete_thumbnails([in_cache.md5_name])
+                return self.not_found
 
-        return GetThumbnailPath(
+        if read_thumbnail and (
+            in_cache.accessed is None
+            or in_cache.accessed < time.time() - self.access_resolution
+        ):
+            self.thumb_db.mark_accessed(in_cache.md5_name)
+
+        return GetCachedThumbnail(
             ThumbnailCacheDiskStatus.found,
-            path,
+            thumbnail_bytes,
             in_cache.mdatatime,
             in_cache.orientation_unknown,
         )
 
+    def get_thumbnails(
+        self, files: Sequence[Tuple[str, float, int, Optional[str]]]
+    ) -> Iterator[GetCachedThumbnail]:
+        """
+        Batch version of get_thumbnail(), for when many thumbnails are needed at
+        once, e.g. when a device has been scanned.
+
+        The files are looked up and read in chunks, so that no more than a chunk
+        of thumbnails is in memory at once. The files in each chunk are looked up
+        in the database using one query, and thumbnails in segments are read using
+        read_many().
+
+        :param files: sequence of full file name, file modification time, file size
+         in bytes and optional camera model, as for get_thumbnail()
+        :return: for each file, in the order passed, what get_thumbnail() would
+         return
+        """
+
+        for start in range(0, len(files), self.get_thumbnails_chunk_size):
+            yield from self._get_thumbnails(
+                files[start : start + self.get_thumbnails_chunk_size]
+            )
+
+    def _get_thumbnails(
+        self, files: Sequence[Tuple[str, float, int, Optional[str]]]
+    ) -> List[GetCachedThumbnail]:
+        """
+        Look up and read one chunk of the files passed to get_thumbnails()
+        """
+
+        results = [self.not_found] * len(files)  # type: List[GetCachedThumbnail]
+        if not self.valid or not files:
+            return results
+
+        lookups = [
+            (self.md5.get_uri(full_file_name, camera_model), size, mtime)
+            for full_file_name, mtime, size, camera_model in files
+        ]
+        in_caches = self.thumb_db.have_thumbnails(lookups)
+
+        packed = []  # type: List[int]
+        missing = []  # type: List[str]
+        for idx, in_cache in enumerate(in_caches):
+            if in_cache is None:
+                continue
+            if in_cache.failure:
+                results[idx] = GetCachedThumbnail(
+                    ThumbnailCacheDiskStatus.failure, None, in_cache.mdatatime, None
+                )
+            elif in_cache.segment is None:
+                # Saved by an earlier version of the program
+                try:
+                    with open(
+                        os.path.join(self.cache_dir, in_cache.md5_name), "rb"
+                    ) as thumbnail:
+                        thumbnail_bytes = thumbnail.read()
+                except OSError:
+                    missing.append(in_cache.md5_name)
+                else:
+                    results[idx] = GetCachedThumbnail(
+                        ThumbnailCacheDiskStatus.found,
+                        thumbnail_bytes,
+                        in_cache.mdatatime,
+                        in_cache.orientation_unknown,
+                    )
+            else:
+                packed.append(idx)
+
+        thumbnails = self.segments.read_many(
+            [
+                (
+                    in_caches[idx].segment,
+                    in_caches[idx].segment_offset,
+                    in_caches[idx].segment_length,
+                )
+                for idx in packed
+            ]
+        )
+        for idx, thumbnail_bytes in zip(packed, thumbnails):
+            in_cache = in_caches[idx]
+            if thumbnail_bytes is None:
+                missing.append(in_cache.md5_name)
+            else:
+                results[idx] = GetCachedThumbnail(
+                    ThumbnailCacheDiskStatus.found,
+                    thumbnail_bytes,
+                    in_cache.mdatatime,
+                    in_cache.orientation_unknown,
+                )
+
+        self.thumb_db.delete_thumbnails(missing)
+
+        stale = time.time() - self.access_resolution
+        self.thumb_db.mark_all_accessed(
+            [
+                in_cache.md5_name
+                for in_cache, result in zip(in_caches, results)
+                if result.disk_status == ThumbnailCacheDiskStatus.found
+                and (in_cache.accessed is None or in_cache.accessed < stale)
+            ]
+        )
+
+        return results
+
+    def _cache_files(self) -> List[os.DirEntry]:
+        """
+        :return: files in the cache directory other than those of the database.
+         Excludes segments.
+        """
+
+        db_names = self.thumb_db.db_fs_names()
+        return [
+            entry
+            for entry in os.scandir(self.cache_dir)
+            if entry.name not in db_names and entry.is_file()
+        ]
+
+    def compact(self) -> None:
+        """
+        Remove thumbnails that are no longer in the database from the segments, and
+        combine small segments.
+
+        Must only be called when no other process is using the cache.
+        """
+
+        if not self.valid:
+            return
+
+        self.segments.close()
+        usage = self.thumb_db.segment_usage()
+        segments = self.segments.segments()
+
+        to_delete = []
+        to_rewrite = []
+        small = []
+        for segment in segments:
+            try:
+                segment_size = os.path.getsize(self.segments.path(segment))
+            except OSError:
+                continue
+            used = usage.get(segment, 0)
+            if not used:
+                to_delete.append(segment)
+            elif used < segment_size * self.min_segment_use:
+                to_rewrite.append(segment)
+            elif segment_size < self.segments.max_segment_size // 4:
+                small.append(segment)
+        # Only combine small segments if there is more than one of them
+        if len(small) + len(to_rewrite) > 1:
+            to_rewrite.extend(small)
+
+        moved = 0
+        for segment in to_rewrite:
+            thumbnails = []
+            for rowid, offset, length in self.thumb_db.segment_thumbnails(segment):
+                data = self.segments.read(segment, offset, length)
+                if data is None:
+                    continue
+                try:
+                    location = self.segments.append(data)
+                except OSError as e:
+                    logging.error("Unable to compact thumbnail cache: %s", e)
+                    self.thumb_db.move_thumbnails(thumbnails)
+                    self.segments.close()
+                    return
+                thumbnails.append(location + (rowid,))
+            self.thumb_db.move_thumbnails(thumbnails)
+            moved += len(thumbnails)
+            to_delete.append(segment)
+
+        self.segments.close()
+        for segment in to_delete:
+            try:
+                os.remove(self.segments.path(segment))
+            except OSError:
+                pass
+
+        if to_delete:
+            logging.debug(
+                "Compacted thumbnail cache: moved %s thumbnails and removed %s "
+                "segments",
+                moved,
+                len(to_delete),
+            )
+
     def cleanup_cache(self, days: int = 30) -> None:
         """
-        Remove all thumbnails that have not been accessed for x days
+        Remove all thumbnails that have not been accessed for x days, then
+        compact the cache.
+
+        Must only be called when no other process is using the cache.
 
         :param how many days to remove from
         """
         time_period = 60 * 60 * 24 * days
         if self.valid:
-            i = 0
             now = time.time()
             deleted_thumbnails = []
-            for name in os.listdir(self.cache_dir):
-                thumbnail = os.path.join(self.cache_dir, name)
-                if (
-                    os.path.isfile(thumbnail)
-                    and os.path.getatime(thumbnail) < now - time_period
-                ):
-                    os.remove(thumbnail)
-                    deleted_thumbnails.append(name)
+            # Thumbnails saved by earlier versions of the program
+            for entry in self._cache_files():
+                if entry.stat().st_atime < now - time_period:
+                    os.remove(entry.path)
+                    deleted_thumbnails.append(entry.name)
+            if not self.thumb_db.cache_exists():
+                return
             if len(deleted_thumbnails):
-                if self.thumb_db.cache_exists():
-                    self.thumb_db.delete_thumbnails(deleted_thumbnails)
+                self.thumb_db.delete_thumbnails(deleted_thumbnails)
+            deleted = len(
+                deleted_thumbnails
+            ) + self.thumb_db.delete_packed_thumbnails_accessed_before(
+                now - time_period
+            )
+            if deleted:
                 logging.debug(
-                    "Deleted {} thumbnail files that had not been accessed for {} "
-                    "or more days".format(len(deleted_thumbnails), days)
+                    "Deleted {} thumbnails that had not been accessed for {} "
+                    "or more days".format(deleted, days)
                 )
+            self.compact()
 
     def purge_cache(self) -> None:
         """
@@ -599,6 +1109,8 @@ class ThumbnailCacheSql:
         if self.valid:
             if self.cache_dir is not None and os.path.isdir(self.cache_dir):
                 # Delete the sqlite3 database too
+                self.thumb_db.close()
+                self.segments.close()
                 shutil.rmtree(self.cache_dir)
 
     def no_thumbnails(self) -> int:
@@ -617,10 +1129,15 @@ class ThumbnailCacheSql:
 
         if not self.valid:
             return 0
-        cwd = os.getcwd()
-        os.chdir(self.cache_dir)
-        s = sum(os.path.getsize(f) for f in os.listdir(".") if os.path.isfile(f))
-        os.chdir(cwd)
+        s = sum(
+            entry.stat().st_size
+            for entry in os.scandir(self.cache_dir)
+            if entry.is_file()
+        )
+        s += sum(
+            os.path.getsize(self.segments.path(segment))
+            for segment in self.segments.segments()
+        )
         return s
 
     def db_size(self) -> int:
@@ -636,27 +1153,48 @@ class ThumbnailCacheSql:
         """
         Check for any thumbnails in the db that are not in the file system
         Check for any thumbnails exist on the file system that are not in the db
+        Pack thumbnails that are in files of their own into segments
+        Compact the segments
         Vacuum the db
 
+        Must only be called when no other process is using the cache.
+
         :return db rows removed, file system photos removed, db size reduction in bytes
         """
 
-        rows = self.thumb_db.md5_names()
-        rows = {row[0] for row in rows}
-        cwd = os.getcwd()
-        os.chdir(self.cache_dir)
+        # Every version of the same file shares the same md5 name, and so the same
+        # thumbnail file
+        unpacked = defaultdict(list)  # type: Dict[str, List[int]]
+        for rowid, md5 in self.thumb_db.unpacked_thumbnails():
+            unpacked[md5].append(rowid)
+        files = {entry.name: entry.path for entry in self._cache_files()}
 
-        to_delete_from_db = {md5 for md5 in rows if not os.path.exists(md5)}
+        to_delete_from_db = unpacked.keys() - files.keys()
         if len(to_delete_from_db):
             self.thumb_db.delete_thumbnails(list(to_delete_from_db))
 
-        md5s = {md5 for md5 in os.listdir(".")} - {self.thumb_db.db_fs_name()}
-        to_delete_from_fs = md5s - rows
-        if len(to_delete_from_fs):
-            for md5 in to_delete_from_fs:
-                os.remove(md5)
+        to_delete_from_fs = files.keys() - unpacked.keys()
+        for md5 in to_delete_from_fs:
+            os.remove(files[md5])
 
-        os.chdir(cwd)
+        thumbnails = []
+        packed = []
+        for md5 in unpacked.keys() & files.keys():
+            try:
+                with open(files[md5], "rb") as thumbnail:
+                    location = self.segments.append(thumbnail.read())
+            except OSError as e:
+                logging.error("Unable to pack thumbnail %s: %s", md5, e)
+                break
+            thumbnails.extend(location + (rowid,) for rowid in unpacked[md5])
+            packed.append(md5)
+        self.thumb_db.move_thumbnails(thumbnails)
+        for md5 in packed:
+            os.remove(files[md5])
+        if packed:
+            logging.info("Packed %s thumbnails into segments", len(packed))
+
+        self.compact()
 
         size = self.db_size()
         self.thumb_db.vacuum()
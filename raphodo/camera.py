@@ -625,9 +625,9 @@ class Camera:
         dest_full_filename: str,
         progress_callback,
         check_for_command,
-        return_file_bytes=False,
+        checksum=None,
         chunk_size=1048576,
-    ) -> Optional[bytes]:
+    ) -> None:
         """
         :param dir_name: directory on the camera
         :param file_name: the photo or video
@@ -638,65 +638,82 @@ class Camera:
          copy progress
         :param check_for_command: a function with which to check to see
          if the execution should pause, resume or stop
-        :param return_file_bytes: if True, return a copy of the file's
-         bytes, else make that part of the return value None
+        :param checksum: if not None, a hash object to update with the file's
+         bytes as they are copied
         :param chunk_size: the size of the chunks to copy. The default
          is 1MB.
-        :return: True if the file was successfully saved, else False,
-         and the bytes that were copied
         """
 
-        src_bytes = None
-        view = memoryview(bytearray(size))
+        # Each chunk is written as soon as it is read, so no more than one chunk
+        # of the file is ever in memory
+        view = memoryview(bytearray(min(chunk_size, size)))
         amount_downloaded = 0
-        for offset in range(0, size, chunk_size):
-            check_for_command()
-            stop = min(offset + chunk_size, size)
-            try:
-                bytes_read = gp.check_result(
-                    self.camera.file_read(
-                        dir_name,
-                        file_name,
-                        gp.GP_FILE_TYPE_NORMAL,
-                        offset,
-                        view[offset:stop],
-                        self.context,
-                    )
-                )
-                amount_downloaded += bytes_read
-                if progress_callback is not None:
-                    progress_callback(amount_downloaded, size)
-            except gp.GPhoto2Error as ex:
-                logging.error(
-                    "Error copying file %s from camera %s: %s",
-                    os.path.join(dir_name, file_name),
-                    self.display_name,
-                    gphoto2_named_error(ex.code),
-                )
-                if progress_callback is not None:
-                    progress_callback(size, size)
-                raise CameraProblemEx(code=CameraErrorCode.read, gp_exception=ex)
-
-        dest_file = None
         try:
             dest_file = io.open(dest_full_filename, "wb")
-            src_bytes = view.tobytes()
-            dest_file.write(src_bytes)
-            dest_file.close()
         except (OSError, PermissionError) as ex:
-            logging.error(
-                "Error saving file %s from camera %s. Error %s: %s",
-                os.path.join(dir_name, file_name),
-                self.display_name,
-                ex.errno,
-                ex.strerror,
-            )
-            if dest_file is not None:
-                dest_file.close()
+            self._log_save_error(dir_name, file_name, ex)
             raise CameraProblemEx(code=CameraErrorCode.write, py_exception=ex)
 
-        if return_file_bytes:
-            return src_bytes
+        # Remove the partial file should the copy fail or be stopped part way
+        try:
+            with dest_file:
+                for offset in range(0, size, chunk_size):
+                    check_for_command()
+                    length = min(chunk_size, size - offset)
+                    try:
+                        bytes_read = gp.check_result(
+                            self.camera.file_read(
+                                dir_name,
+                                file_name,
+                                gp.GP_FILE_TYPE_NORMAL,
+                                offset,
+                                view[:length],
+                                self.context,
+                            )
+                        )
+                    except gp.GPhoto2Error as ex:
+                        logging.error(
+                            "Error copying file %s from camera %s: %s",
+                            os.path.join(dir_name, file_name),
+                            self.display_name,
+                            gphoto2_named_error(ex.code),
+                        )
+                        if progress_callback is not None:
+                            progress_callback(size, size)
+                        raise CameraProblemEx(
+                            code=CameraErrorCode.read, gp_exception=ex
+                        )
+
+                    try:
+                        dest_file.write(view[:length])
+                    except (OSError, PermissionError) as ex:
+                        self._log_save_error(dir_name, file_name, ex)
+                        raise CameraProblemEx(
+                            code=CameraErrorCode.write, py_exception=ex
+                        )
+                    if checksum is not None:
+                        checksum.update(view[:length])
+
+                    amount_downloaded += bytes_read
+                    if progress_callback is not None:
+                        progress_callback(amount_downloaded, size)
+        except BaseException:
+            try:
+                os.remove(dest_full_filename)
+            except OSError:
+                pass
+            raise
+
+    def _log_save_error(
+        self, dir_name: str, file_name: str, ex: Union[OSError, PermissionError]
+    ) -> None:
+        logging.error(
+            "Error saving file %s from camera %s. Error %s: %s",
+            os.path.join(dir_name, file_name),
+            self.display_name,
+            ex.errno,
+            ex.strerror,
+        )
 
     def get_thumbnail(
         self,
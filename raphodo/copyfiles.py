@@ -24,16 +24,19 @@ __copyright__ = "Copyright 2011-2021, Damon Lynch"
 import os
 import sys
 import errno
+import fcntl
 import io
 import shutil
 import stat
 import hashlib
 import logging
 import pickle
+import queue
+import threading
 from operator import attrgetter
 from itertools import chain
 from collections import defaultdict
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Tuple, Callable, List
 import locale
 
 try:
@@ -44,6 +47,13 @@ except locale.Error:
 
 import gphoto2 as gp
 
+try:
+    import xxhash
+
+    have_xxhash = True
+except ImportError:
+    have_xxhash = False
+
 from raphodo.camera import Camera, CameraProblemEx, gphoto2_python_logging
 from raphodo.interprocess import (
     WorkerInPublishPullPipeline,
@@ -52,7 +62,7 @@ from raphodo.interprocess import (
 )
 from raphodo.constants import FileType, DownloadStatus, CameraErrorCode
 from raphodo.utilities import GenerateRandomFileName, create_temp_dirs, same_device
-from raphodo.rpdfile import RPDFile
+from raphodo.rpdfile import RPDFile, RPDFileChanges
 from raphodo.problemnotification import (
     CopyingProblems,
     CameraFileReadProblem,
@@ -60,13 +70,79 @@ from raphodo.problemnotification import (
     FileMoveProblem,
     FileDeleteProblem,
     FileCopyProblem,
+    FileVerificationProblem,
     CameraInitializationProblem,
 )
 from raphodo.storage.storage import get_uri
+from raphodo.ioscheduler import IOScheduler
 from raphodo.prefs.preferences import Preferences
 from raphodo.rescan import RescanCamera
 
 
+# ioctl to share the source file's data with the destination, on filesystems that
+# support it (e.g. Btrfs, XFS)
+FICLONE = 0x40049409
+# errno values indicating the kernel cannot copy between the files, in which case
+# they must be copied by reading and writing them
+kernel_copy_unsupported = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EBADF,
+    errno.ETXTBSY,
+}
+
+
+# Algorithm used to verify copies of files. Both xxHash and BLAKE2 are considerably
+# faster than MD5.
+checksum_algorithm = "xxh64" if have_xxhash else "blake2b"
+
+
+def new_checksum(algorithm: str = checksum_algorithm):
+    """
+    :param algorithm: "xxh64", or an algorithm provided by hashlib, e.g. "blake2b"
+     or "md5"
+    :return: hash object to update as a file is read
+    """
+
+    if algorithm == "xxh64":
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def file_checksum(
+    full_file_name: str,
+    algorithm: str = checksum_algorithm,
+    buffer_size: int = 1024 * 1024,
+    check_for_command: Optional[Callable[[], None]] = None,
+) -> str:
+    """
+    Calculate the checksum of a file, reading it one chunk at a time into the
+    same buffer, so the memory used does not depend on the file's size.
+
+    :param full_file_name: file to read
+    :param algorithm: hash algorithm to use
+    :param buffer_size: size of each read
+    :param check_for_command: if not None, a function to call before each read to
+     check if the process should pause, resume or stop
+    :return: checksum as a hexadecimal string
+    """
+
+    checksum = new_checksum(algorithm)
+    view = memoryview(bytearray(buffer_size))
+    with io.open(full_file_name, "rb", buffering=0) as f:
+        while True:
+            if check_for_command is not None:
+                check_for_command()
+            length = f.readinto(view)
+            if not length:
+                break
+            checksum.update(view[:length])
+    return checksum.hexdigest()
+
+
 def copy_file_metadata(src: str, dst: str) -> Optional[Tuple]:
     """
     Copy all stat info (mode bits, atime, mtime, flags) from src to
@@ -128,6 +204,54 @@ def copy_camera_file_metadata(mtime: float, dst: str) -> Optional[Tuple]:
         return (inst,)  # note the comma: return a Tuple
 
 
+class DestinationWriter(threading.Thread):
+    """
+    Write to one destination the chunks of a file read by another thread.
+
+    The chunks wait in a bounded queue, so the reader can get ahead of a slow
+    destination by no more than the queue's size.
+    """
+
+    def __init__(self, full_file_name: str, queue_size: int) -> None:
+        super().__init__(daemon=True)
+        self.full_file_name = full_file_name
+        # None signals there are no more chunks
+        self.chunks = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self.bytes_written = 0
+        self.exception = None  # type: Optional[Exception]
+
+    def run(self) -> None:
+        try:
+            dest = io.open(self.full_file_name, "wb")
+        except Exception as e:
+            self.exception = e
+            dest = None
+
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if dest is not None:
+                try:
+                    dest.write(chunk)
+                    self.bytes_written += len(chunk)
+                except Exception as e:
+                    # Keep emptying the queue so the reader is never blocked
+                    self.exception = e
+                    self.close(dest)
+                    dest = None
+
+        if dest is not None:
+            self.close(dest)
+
+    def close(self, dest: io.BufferedWriter) -> None:
+        try:
+            dest.close()
+        except Exception as e:
+            if self.exception is None:
+                self.exception = e
+
+
 class FileCopy:
     """
     Used by classes CopyFilesWorker and BackupFilesWorker
@@ -136,6 +260,14 @@ class FileCopy:
     def __init__(self):
         self.io_buffer = 1024 * 1024
         self.batch_size_bytes = 5 * 1024 * 1024
+        # How much the kernel copies at a time, between which progress is reported
+        # and pause or stop commands are checked for
+        self.kernel_copy_extent = 16 * 1024 * 1024
+        # How many chunks of size io_buffer each destination's writer can fall
+        # behind the reader when copying to more than one destination
+        self.destination_queue_size = 8
+        # Take turns with other processes using the same storage devices
+        self.io_scheduler = IOScheduler()
         self.dest = self.src = None
 
         self.bytes_downloaded = 0
@@ -151,34 +283,26 @@ class FileCopy:
         self.bytes_downloaded = 0
 
     def copy_from_filesystem(
-        self, source: str, destination: str, rpd_file: RPDFile
+        self, source: str, destination: str, rpd_file: RPDFile, verify: bool = True
     ) -> bool:
-        src_chunks = []
+        """
+        :param source: file to copy
+        :param destination: full file name of the copy
+        :param rpd_file: file details
+        :param verify: if False, the copy is not verified, even if files are
+         being verified
+        :return: True if the copy succeeded and, if it was verified, matches the
+         original
+        """
+
+        checksum = new_checksum() if self.verify_file and verify else None
         try:
-            self.dest = io.open(destination, "wb", self.io_buffer)
-            self.src = io.open(source, "rb", self.io_buffer)
-            total = rpd_file.size
-            amount_downloaded = 0
-
-            while True:
-                # first check if process is being stopped or paused
-                self.check_for_controller_directive()
-
-                chunk = self.src.read(self.io_buffer)
-                if chunk:
-                    self.dest.write(chunk)
-                    if self.verify_file:
-                        src_chunks.append(chunk)
-                    amount_downloaded += len(chunk)
-                    self.update_progress(amount_downloaded, total)
-                else:
-                    break
-            self.dest.close()
-            self.src.close()
+            with self.io_scheduler.copy(source, destination):
+                self._copy_file(source, destination, rpd_file, checksum)
 
-            if self.verify_file:
-                src_bytes = b"".join(src_chunks)
-                rpd_file.md5 = hashlib.md5(src_bytes).hexdigest()
+            if checksum is not None:
+                rpd_file.checksum = checksum.hexdigest()
+                return self.verify_copy(destination, rpd_file)
 
             return True
         except (OSError, FileNotFoundError, PermissionError) as e:
@@ -215,9 +339,249 @@ class FileCopy:
             )
             return False
 
+    def _copy_file(self, source: str, destination: str, rpd_file: RPDFile, checksum):
+        """
+        :param checksum: if not None, a hash object to update with the file's
+         contents
+        """
+
+        self.dest = io.open(destination, "wb", self.io_buffer)
+        self.src = io.open(source, "rb", buffering=0)
+        total = rpd_file.size
+        amount_downloaded = 0
+
+        # The bytes must pass through this process to calculate their checksum
+        if checksum is None and self.copy_in_kernel(
+            self.src.fileno(), self.dest.fileno()
+        ):
+            self.dest.close()
+            self.src.close()
+            return
+
+        # Read every chunk into the same buffer
+        view = memoryview(bytearray(self.io_buffer))
+        while True:
+            # first check if process is being stopped or paused
+            self.check_for_controller_directive()
+
+            length = self.src.readinto(view)
+            if length:
+                chunk = view[:length]
+                self.dest.write(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+                amount_downloaded += length
+                self.update_progress(amount_downloaded, total)
+            else:
+                break
+        self.dest.close()
+        self.src.close()
+
+    def copy_in_kernel(self, src_fd: int, dest_fd: int) -> bool:
+        """
+        Copy the file without its bytes passing through this process, by
+        cloning it or by having the kernel copy it.
+
+        Tries, in order: a reflink (FICLONE), which shares the source file's data
+        on filesystems that support it; copy_file_range(), which on some
+        filesystems and devices is done without the data passing through the CPU;
+        and sendfile().
+
+        :param src_fd: file descriptor of the source, positioned at its start
+        :param dest_fd: file descriptor of the empty destination
+        :return: True if the file was copied, False if nothing was copied because
+         the kernel cannot copy between the files
+        """
+
+        total = os.fstat(src_fd).st_size
+
+        if sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+            except OSError as e:
+                if e.errno not in kernel_copy_unsupported:
+                    raise
+            else:
+                self.update_progress(total, total)
+                return True
+
+        if hasattr(os, "copy_file_range"):
+            # Python 3.8 or newer
+            def copy_extent(offset: int, count: int) -> int:
+                return os.copy_file_range(src_fd, dest_fd, count, offset, offset)
+
+            if self._copy_extents(copy_extent, total):
+                return True
+
+        def copy_extent(offset: int, count: int) -> int:
+            return os.sendfile(dest_fd, src_fd, offset, count)
+
+        return self._copy_extents(copy_extent, total)
+
+    def _copy_extents(self, copy_extent: Callable[[int, int], int], total: int) -> bool:
+        """
+        Copy a file one extent at a time using a kernel copy function
+
+        :param copy_extent: function taking the offset and the number of bytes to
+         copy, returning how many were copied
+        :param total: size of the file
+        :return: True if the file was copied, False if nothing was copied because
+         the kernel cannot copy between the files
+        """
+
+        offset = 0
+        while offset < total:
+            self.check_for_controller_directive()
+            try:
+                copied = copy_extent(
+                    offset, min(self.kernel_copy_extent, total - offset)
+                )
+            except OSError as e:
+                if offset == 0 and e.errno in kernel_copy_unsupported:
+                    return False
+                raise
+            if copied == 0:
+                if offset == 0:
+                    # Some filesystems report success while copying nothing
+                    return False
+                # The file has been truncated since the copy began
+                break
+            offset += copied
+            self.update_progress(offset, total)
+        return True
+
+    def copy_to_destinations(
+        self, source: str, destinations: List[str], rpd_file: RPDFile
+    ) -> List[Optional[Exception]]:
+        """
+        Copy a file to several destinations at once, reading it only once.
+
+        Each chunk read is queued for every destination, which is written to by
+        its own thread. A slow destination holds up the others only once its
+        queue is full.
+
+        The copies are not verified.
+
+        Calls update_destination_progress() with the amount written to each
+        destination.
+
+        :param source: file to copy
+        :param destinations: full file names of the copies to make
+        :param rpd_file: file details
+        :return: for each destination, None if the copy succeeded, else the
+         exception that caused it to fail
+        """
+
+        total = rpd_file.size
+        writers = [
+            DestinationWriter(destination, self.destination_queue_size)
+            for destination in destinations
+        ]
+        for writer in writers:
+            writer.start()
+
+        read_exception = None  # type: Optional[Exception]
+        try:
+            with self.io_scheduler.copy(source, *destinations), io.open(
+                source, "rb", buffering=0
+            ) as src:
+                while True:
+                    # first check if process is being stopped or paused
+                    self.check_for_controller_directive()
+
+                    # Every writer holds a reference to the chunk until it is
+                    # written, so each chunk must be a new object
+                    chunk = src.read(self.io_buffer)
+                    if not chunk:
+                        break
+                    for writer in writers:
+                        if writer.exception is None:
+                            writer.chunks.put(chunk)
+                    for index, writer in enumerate(writers):
+                        self.update_destination_progress(
+                            index, writer.bytes_written, total
+                        )
+        except Exception as e:
+            read_exception = e
+            try:
+                msg = "%s: %s" % (e.errno, e.strerror)
+            except AttributeError:
+                msg = str(e)
+            logging.error("%s. Failed to read %s", msg, source)
+        finally:
+            for writer in writers:
+                writer.chunks.put(None)
+            for writer in writers:
+                writer.join()
+
+        results = []  # type: List[Optional[Exception]]
+        for index, writer in enumerate(writers):
+            self.update_destination_progress(index, writer.bytes_written, total)
+            exception = read_exception or writer.exception
+            if writer.exception is not None:
+                e = writer.exception
+                try:
+                    msg = "%s: %s" % (e.errno, e.strerror)
+                except AttributeError:
+                    msg = str(e)
+                logging.error(
+                    "%s. Failed to copy %s to %s", msg, source, writer.full_file_name
+                )
+            results.append(exception)
+        return results
+
+    def copy_matches(self, full_file_name: str, rpd_file: RPDFile) -> bool:
+        """
+        Check that the file's checksum matches that of the file it was copied from.
+        The copy is read once, in binary mode, one chunk at a time.
+
+        :param full_file_name: the copy of the file
+        :param rpd_file: file details, with the checksum of the original
+        :return: True if the checksums match, False otherwise
+        """
+
+        with self.io_scheduler.copy(full_file_name):
+            checksum = file_checksum(
+                full_file_name, check_for_command=self.check_for_controller_directive
+            )
+        return checksum == rpd_file.checksum
+
+    def verify_copy(self, full_file_name: str, rpd_file: RPDFile) -> bool:
+        """
+        Check that the file's checksum matches that of the file it was copied from,
+        recording a problem if it does not.
+
+        :param full_file_name: the copy of the file
+        :param rpd_file: file details, with the checksum of the original
+        :return: True if the checksums match, False otherwise
+        """
+
+        if self.copy_matches(full_file_name, rpd_file):
+            return True
+
+        self.report_verification_failure(full_file_name, rpd_file)
+        return False
+
+    def report_verification_failure(
+        self, full_file_name: str, rpd_file: RPDFile
+    ) -> None:
+        logging.error(
+            "Copy %s of %s does not match the original",
+            full_file_name,
+            rpd_file.full_file_name,
+        )
+        self.problems.append(
+            FileVerificationProblem(
+                name=os.path.basename(full_file_name),
+                uri=get_uri(full_file_name=full_file_name),
+            )
+        )
+
 
 class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
     def __init__(self):
+        # Send back only what changed in the files received from the main process
+        RPDFile.track_changes = True
         super().__init__("CopyFiles")
 
     def terminate_camera_removed(self) -> None:
@@ -231,6 +595,13 @@ class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
         self.send_finished_command()
         sys.exit(0)
 
+    def pausing(self) -> None:
+        # Let other processes use the devices while the download is paused
+        self.io_scheduler.suspend()
+
+    def resuming(self) -> None:
+        self.io_scheduler.resume()
+
     def cleanup_pre_stop(self) -> None:
         super().cleanup_pre_stop()
         if self.camera is not None:
@@ -280,16 +651,18 @@ class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
 
     def copy_from_camera(self, rpd_file: RPDFile) -> bool:
 
+        checksum = new_checksum() if self.verify_file else None
         try:
-            src_bytes = self.camera.save_file_by_chunks(
-                dir_name=rpd_file.path,
-                file_name=rpd_file.name,
-                size=rpd_file.size,
-                dest_full_filename=rpd_file.temp_full_file_name,
-                progress_callback=self.update_progress,
-                check_for_command=self.check_for_controller_directive,
-                return_file_bytes=self.verify_file,
-            )
+            with self.io_scheduler.copy(rpd_file.temp_full_file_name):
+                self.camera.save_file_by_chunks(
+                    dir_name=rpd_file.path,
+                    file_name=rpd_file.name,
+                    size=rpd_file.size,
+                    dest_full_filename=rpd_file.temp_full_file_name,
+                    progress_callback=self.update_progress,
+                    check_for_command=self.check_for_controller_directive,
+                    checksum=checksum,
+                )
         except CameraProblemEx as e:
             name = rpd_file.name
             uri = rpd_file.get_uri()
@@ -306,8 +679,9 @@ class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
                 )
             return False
 
-        if self.verify_file:
-            rpd_file.md5 = hashlib.md5(src_bytes).hexdigest()
+        if checksum is not None:
+            rpd_file.checksum = checksum.hexdigest()
+            return self.verify_copy(rpd_file.temp_full_file_name, rpd_file)
 
         return True
 
@@ -513,10 +887,13 @@ class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
                                 exception=inst,
                             )
                         )
-                    if self.verify_file:
-                        rpd_file.md5 = hashlib.md5(
-                            open(temp_full_file_name, "rb").read()
-                        ).hexdigest()
+                    if copy_succeeded and self.verify_file:
+                        # The file was moved, not copied, so there is no copy to
+                        # verify
+                        rpd_file.checksum = file_checksum(
+                            temp_full_file_name,
+                            check_for_command=self.check_for_controller_directive,
+                        )
                     self.update_progress(rpd_file.size, rpd_file.size)
                 else:
                     # The download folder changed since the scan occurred, and is now
@@ -645,7 +1022,7 @@ class CopyFilesWorker(WorkerInPublishPullPipeline, FileCopy):
             self.content = pickle.dumps(
                 CopyFilesResults(
                     copy_succeeded=copy_succeeded,
-                    rpd_file=rpd_file,
+                    rpd_file=RPDFileChanges(rpd_file),
                     download_count=download_count,
                     mdata_exceptions=mdata_exceptions,
                 ),
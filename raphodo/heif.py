@@ -21,7 +21,7 @@ __author__ = "Damon Lynch"
 __copyright__ = "Copyright 2020-2021, Damon Lynch"
 
 import logging
-from typing import Optional
+from typing import Optional, Tuple
 import ctypes, ctypes.util
 
 from PyQt5.QtGui import QImage
@@ -70,6 +70,20 @@ def libheif_version() -> str:
             return ""
 
 
+def heif_image_size(full_file_name: str) -> Optional[Tuple[int, int]]:
+    """
+    Determine the size of the HEIF / HEIC primary image without decoding it
+    :param full_file_name: image to examine
+    :return: width and height, or None if it could not be determined
+    """
+
+    try:
+        # pyheif.open() is available from pyheif 0.5
+        return tuple(pyheif.open(full_file_name).size)
+    except Exception:
+        return None
+
+
 def load_heif(
     full_file_name: str, catch_pyheif_exceptions: bool = True, process_name: str = ""
 ):
@@ -31,7 +31,8 @@ import pickle
 import os
 import shlex
 import time
-from collections import deque
+import threading
+from collections import deque, namedtuple
 from typing import Optional, Set, List, Dict, Sequence, Any, Tuple, Union
 
 
@@ -53,7 +54,15 @@ else:
 
 from zmq.eventloop.zmqstream import ZMQStream
 
-from raphodo.rpdfile import RPDFile, FileTypeCounter, FileSizeSum, Photo, Video
+from raphodo.rpdfile import (
+    RPDFile,
+    RPDFileChanges,
+    FileTypeCounter,
+    FileSizeSum,
+    Photo,
+    Video,
+    rpd_file_state,
+)
 from raphodo.devices import Device
 from raphodo.utilities import CacheDirs, set_pdeathsig
 from raphodo.constants import (
@@ -373,7 +382,8 @@ class PullPipelineManager(ProcessManager, QObject):
     def process_thread_directive(self) -> None:
         directive, worker_id, data = self.thread_controller.recv_multipart()
 
-        # Directives: START, STOP, TERMINATE, SEND_TO_WORKER, STOP_WORKER, START_WORKER
+        # Directives: START, STOP, TERMINATE, SEND_TO_WORKER, STOP_WORKER, START_WORKER,
+        # PRIORITIZE
         if directive == b"START":
             self.start()
         elif directive == b"START_WORKER":
@@ -388,6 +398,8 @@ class PullPipelineManager(ProcessManager, QObject):
             self.pause()
         elif directive == b"RESUME":
             self.resume(worker_id=worker_id)
+        elif directive == b"PRIORITIZE":
+            self.prioritize(worker_id=worker_id, data=data)
         elif directive == b"TERMINATE":
             self.forcefully_terminate()
         else:
@@ -490,9 +502,18 @@ class LoadBalancerWorkerManager(ProcessManager):
             cmd, self.backend_port, self.sink_port, worker_id, self.logging_port
         )
 
-    def start_workers(self) -> None:
-        for worker_id in range(self.no_workers):
-            self.add_worker(worker_id)
+    def start_workers(self, no_workers: Optional[int] = None) -> None:
+        """
+        :param no_workers: how many workers to start, if not all of them
+        """
+
+        if no_workers is None:
+            no_workers = self.no_workers
+        for _ in range(no_workers):
+            self.start_worker()
+
+    def start_worker(self) -> None:
+        self.add_worker(len(self.processes))
 
     def zombie_workers(self) -> List[int]:
         return [
@@ -503,7 +524,30 @@ class LoadBalancerWorkerManager(ProcessManager):
 
 
 class LRUQueue:
-    """LRUQueue class using ZMQStream/IOLoop for event dispatching"""
+    """
+    LRUQueue class using ZMQStream/IOLoop for event dispatching.
+
+    Scales the number of workers in use to the workload, between min_workers and
+    the process manager's number of workers. Workers that are not needed are
+    parked: they remain running, but no work is sent to them until they are
+    needed again.
+    """
+
+    min_workers = 1
+    # How often to evaluate the workload, in milliseconds
+    autoscale_interval = 1000
+    # Proportion of the interval that all workers must have been busy with work
+    # waiting before adding more workers
+    saturated_threshold = 0.75
+    # Do not add workers if the system's CPUs are busier than this percentage
+    max_system_cpu = 90.0
+    # If the system is waiting on I/O for more than this percentage of the time
+    # while the workers are mostly idle, the workers are waiting on the same
+    # devices and more of them would only contend for those devices
+    io_wait_threshold = 20.0
+    low_worker_cpu = 50.0
+    # How many intervals a worker must have been idle throughout before parking it
+    park_after = 5
 
     def __init__(
         self,
@@ -517,10 +561,23 @@ class LRUQueue:
         self.worker_type = worker_type
         self.process_manager = process_manager
         self.workers = deque()
+        self.parked = deque()
         self.terminating = False
         self.terminating_workers = set()  # type: Set[bytes]
         self.stopped_workers = set()  # type: Set[int]
 
+        # Workers that have announced themselves, and the ids of those yet to
+        self.known_workers = set()  # type: Set[bytes]
+        self.starting_workers = set()  # type: Set[int]
+
+        self.saturated_since = None  # type: Optional[float]
+        self.saturated_time = 0.0
+        self.min_idle = 0
+        self.idle_intervals = 0
+        self.interval_start = time.monotonic()
+        # Prime the CPU measurements, which are relative to the previous call
+        psutil.cpu_times_percent(interval=None)
+
         self.backend = ZMQStream(backend_socket)
         self.frontend = ZMQStream(frontend_socket)
         self.controller = ZMQStream(controller_socket)
@@ -529,8 +586,24 @@ class LRUQueue:
 
         self.loop = ioloop.IOLoop.instance()
 
+        self.autoscaler = ioloop.PeriodicCallback(
+            self.autoscale, self.autoscale_interval
+        )
+        self.autoscaler.start()
+
+    def start_workers(self, no_workers: int) -> None:
+        first_worker_id = len(self.process_manager.processes)
+        self.process_manager.start_workers(no_workers)
+        self.starting_workers.update(
+            range(first_worker_id, len(self.process_manager.processes))
+        )
+
     def handle_controller(self, msg):
         self.terminating = True
+        self.autoscaler.stop()
+
+        self.workers.extend(self.parked)
+        self.parked.clear()
 
         while len(self.workers):
             worker_identity = self.workers.popleft()
@@ -549,8 +622,12 @@ class LRUQueue:
         # Queue worker address for LRU routing
         worker_identity, empty, client_addr = msg[:3]
 
+        if worker_identity not in self.known_workers:
+            self.known_workers.add(worker_identity)
+            self.starting_workers.discard(get_worker_id_from_identity(worker_identity))
+
         # add worker back to the list of workers
-        self.workers.append(worker_identity)
+        self.add_available_worker(worker_identity)
 
         zw = self.process_manager.zombie_workers()
         if zw:
@@ -562,6 +639,7 @@ class LRUQueue:
         if msg[-1] == b"STOPPED" and self.terminating:
             worker_id = get_worker_id_from_identity(worker_identity)
             self.stopped_workers.add(worker_id)
+            self.known_workers.discard(worker_identity)
             self.terminating_workers.remove(worker_identity)
             if len(self.terminating_workers) == 0:
                 for worker_id in self.stopped_workers:
@@ -580,9 +658,14 @@ class LRUQueue:
                             logging.debug("Process %s is sleeping", pid)
                 self.loop.add_timeout(time.time() + 0.5, self.loop.stop)
 
+    def add_available_worker(self, worker_identity: bytes) -> None:
+        self.workers.append(worker_identity)
         if len(self.workers) == 1:
             # on first recv, start accepting frontend messages
             self.frontend.on_recv(self.handle_frontend)
+            if self.saturated_since is not None:
+                self.saturated_time += time.monotonic() - self.saturated_since
+                self.saturated_since = None
 
     def handle_frontend(self, request):
         #  Dequeue and drop the next worker address
@@ -590,12 +673,202 @@ class LRUQueue:
 
         message = [worker_identity, b""] + request
         self.backend.send_multipart(message)
+        self.min_idle = min(self.min_idle, len(self.workers))
         if len(self.workers) == 0:
             # stop receiving until workers become available again
             self.frontend.stop_on_recv()
+            self.saturated_since = time.monotonic()
+
+    def worker_running(self, worker_id: int) -> bool:
+        try:
+            process = self.process_manager.processes[worker_id]  # type: psutil.Process
+            return process.status() != psutil.STATUS_ZOMBIE
+        except (KeyError, psutil.Error):
+            return False
+
+    def forget_dead_workers(self) -> None:
+        """
+        Stop counting workers that terminated without sending STOPPED, including
+        those that terminated before announcing themselves
+        """
+
+        self.starting_workers = {
+            worker_id
+            for worker_id in self.starting_workers
+            if self.worker_running(worker_id)
+        }
+        for worker_identity in list(self.known_workers):
+            if self.worker_running(get_worker_id_from_identity(worker_identity)):
+                continue
+            logging.warning(
+                "%s load balancer lost worker %s",
+                self.worker_type,
+                worker_identity.decode(),
+            )
+            self.known_workers.remove(worker_identity)
+            if worker_identity in self.parked:
+                self.parked.remove(worker_identity)
+            if worker_identity in self.workers:
+                self.workers.remove(worker_identity)
+                if not self.workers:
+                    self.frontend.stop_on_recv()
+                    self.saturated_since = time.monotonic()
+
+    @classmethod
+    def scaling_decision(
+        cls,
+        work_waiting: bool,
+        saturated: float,
+        starting: int,
+        active: int,
+        max_workers: int,
+        io_wait: float,
+        system_cpu: float,
+        mean_worker_cpu: float,
+        min_idle: int,
+        idle_intervals: int,
+    ) -> Tuple[int, int]:
+        """
+        Decide how to scale the workers in use, given the workload measured over
+        the last interval.
+
+        :param work_waiting: whether work was waiting for a worker at the end of
+         the interval
+        :param saturated: proportion of the interval all workers were busy
+        :param starting: how many workers have been started but are not yet ready
+        :param active: how many workers are in use or starting
+        :param max_workers: the most workers that can be in use
+        :param io_wait: percentage of the time the system waited on I/O
+        :param system_cpu: percentage of the system's CPUs in use
+        :param mean_worker_cpu: mean CPU utilisation of the workers in use
+        :param min_idle: the fewest workers that were idle during the interval
+        :param idle_intervals: how many intervals in a row at least one worker has
+         been idle throughout
+        :return: how many workers to add, or -1 to park a worker, and the new
+         number of idle intervals
+        """
+
+        if work_waiting and saturated >= cls.saturated_threshold:
+            if starting:
+                return 0, 0
+            # Workers waiting on the same devices as each other
+            if (
+                io_wait >= cls.io_wait_threshold
+                and mean_worker_cpu < cls.low_worker_cpu
+            ):
+                return 0, 0
+            if system_cpu >= cls.max_system_cpu:
+                return 0, 0
+            # Grow quickly when there is a lot of work
+            return min(max(1, active // 2), max_workers - active), 0
+        if min_idle > 0 and active > cls.min_workers:
+            idle_intervals += 1
+            if idle_intervals >= cls.park_after:
+                return -1, 0
+            return 0, idle_intervals
+        return 0, 0
+
+    def autoscale(self) -> None:
+        """
+        Add workers when all are busy and work is waiting, if the system has the
+        CPU to spare and the workers are not all waiting on I/O. Park workers that
+        have been idle for several intervals.
+        """
+
+        if self.terminating:
+            return
+
+        self.forget_dead_workers()
+
+        now = time.monotonic()
+        saturated_time = self.saturated_time
+        if self.saturated_since is not None:
+            saturated_time += now - self.saturated_since
+            self.saturated_since = now
+        saturated = saturated_time / max(now - self.interval_start, 0.001)
+        self.saturated_time = 0.0
+        self.interval_start = now
+        min_idle = self.min_idle
+        self.min_idle = len(self.workers)
+
+        work_waiting = not self.workers and bool(
+            self.frontend.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN
+        )
+        active = (
+            len(self.known_workers) - len(self.parked) + len(self.starting_workers)
+        )
+
+        cpu_times = psutil.cpu_times_percent(interval=None)
+        io_wait = getattr(cpu_times, "iowait", 0.0)
+        system_cpu = 100.0 - cpu_times.idle - io_wait
+        # CPU utilisation of the workers in use, each measured since the previous
+        # interval
+        worker_cpu = []
+        for worker_identity in self.known_workers:
+            process = self.process_manager.processes[
+                get_worker_id_from_identity(worker_identity)
+            ]  # type: psutil.Process
+            try:
+                cpu_percent = process.cpu_percent()
+            except psutil.Error:
+                continue
+            if worker_identity not in self.parked:
+                worker_cpu.append(cpu_percent)
+
+        to_add, self.idle_intervals = self.scaling_decision(
+            work_waiting=work_waiting,
+            saturated=saturated,
+            starting=len(self.starting_workers),
+            active=active,
+            max_workers=self.process_manager.no_workers,
+            io_wait=io_wait,
+            system_cpu=system_cpu,
+            mean_worker_cpu=sum(worker_cpu) / max(len(worker_cpu), 1),
+            min_idle=min_idle,
+            idle_intervals=self.idle_intervals,
+        )
+
+        if to_add < 0:
+            if not self.workers:
+                return
+            worker_identity = self.workers.pop()
+            self.parked.append(worker_identity)
+            logging.debug(
+                "%s load balancer parking idle %s",
+                self.worker_type,
+                worker_identity.decode(),
+            )
+            if not self.workers:
+                self.frontend.stop_on_recv()
+                self.saturated_since = now
+            return
+
+        while to_add and self.parked:
+            worker_identity = self.parked.popleft()
+            logging.debug(
+                "%s load balancer resuming use of %s",
+                self.worker_type,
+                worker_identity.decode(),
+            )
+            self.add_available_worker(worker_identity)
+            to_add -= 1
+        to_add = min(
+            to_add,
+            self.process_manager.no_workers - len(self.process_manager.processes),
+        )
+        if to_add > 0:
+            logging.debug(
+                "%s load balancer starting %s more workers",
+                self.worker_type,
+                to_add,
+            )
+            self.start_workers(to_add)
 
 
 class LoadBalancer:
+    # How many requests to queue before the sender must wait
+    frontend_hwm = 10
+
     def __init__(self, worker_type: str, process_manager) -> None:
 
         self.parser = argparse.ArgumentParser()
@@ -609,6 +882,9 @@ class LoadBalancer:
 
         context = zmq.Context()
         frontend = context.socket(zmq.PULL)
+        # Queue few requests here, so that those not yet sent can still be
+        # reordered by whoever is sending them
+        frontend.set_hwm(self.frontend_hwm)
         frontend_port = frontend.bind_to_random_port("tcp://*")
 
         backend = context.socket(zmq.ROUTER)
@@ -640,10 +916,11 @@ class LoadBalancer:
         process_manager = process_manager(
             no_workers, backend_port, sink_port, logging_port
         )
-        process_manager.start_workers()
 
         # create queue with the sockets
         queue = LRUQueue(backend, frontend, controller, worker_type, process_manager)
+        # Start with half the workers, adding more only if the workload needs them
+        queue.start_workers(max(LRUQueue.min_workers, (no_workers + 1) // 2))
 
         # start reactor, which is an infinite loop
         ioloop.IOLoop.instance().start()
@@ -902,6 +1179,18 @@ class PublishPullPipelineManager(PullPipelineManager):
             message = [make_filter_from_worker_id(worker_id), b"RESUME"]
             self.controller_socket.send_multipart(message)
 
+    def prioritize(self, worker_id: bytes, data: bytes) -> None:
+        """
+        Tell a worker which of the items it has yet to work on it should work on
+        next
+
+        :param worker_id: the worker
+        :param data: the pickled items, most important first
+        """
+
+        if int(worker_id) in self.workers:
+            self.controller_socket.send_multipart([worker_id, b"PRIORITIZE", data])
+
 
 class ProcessLoggerPublisher:
     """
@@ -1108,25 +1397,71 @@ class WorkerInPublishPullPipeline(WorkerProcess):
 
     def check_for_controller_directive(self) -> None:
         try:
-            # Don't block if process is running regularly
-            # If there is no command,exception will occur
-            worker_id, command = self.controller.recv_multipart(zmq.DONTWAIT)
-            assert command in [b"PAUSE", b"STOP"]
-            assert worker_id == self.worker_id
-
-            if command == b"PAUSE":
-                # Because the process is paused, do a blocking read to
-                # wait for the next command
-                worker_id, command = self.controller.recv_multipart()
-                assert command in [b"RESUME", b"STOP"]
-            if command == b"STOP":
-                self.cleanup_pre_stop()
-                # before finishing, signal to sink that we've terminated
-                self.sender.send_multipart([self.worker_id, b"cmd", b"STOPPED"])
-                sys.exit(0)
+            while True:
+                # Don't block if process is running regularly
+                # If there is no command,exception will occur
+                worker_id, command, *data = self.controller.recv_multipart(
+                    zmq.DONTWAIT
+                )
+                assert command in [b"PAUSE", b"STOP", b"PRIORITIZE"]
+                assert worker_id == self.worker_id
+
+                if command == b"PRIORITIZE":
+                    self.prioritize(data[0])
+                    # Look for any further command
+                    continue
+
+                if command == b"PAUSE":
+                    self.pausing()
+                    # Because the process is paused, do a blocking read to
+                    # wait for the next command
+                    while True:
+                        worker_id, command, *data = self.controller.recv_multipart()
+                        if command != b"PRIORITIZE":
+                            break
+                        self.prioritize(data[0])
+                    assert command in [b"RESUME", b"STOP"]
+                    if command == b"RESUME":
+                        self.resuming()
+                if command == b"STOP":
+                    self.cleanup_pre_stop()
+                    # before finishing, signal to sink that we've terminated
+                    self.sender.send_multipart([self.worker_id, b"cmd", b"STOPPED"])
+                    sys.exit(0)
+                break
         except zmq.Again:
             pass  # Continue working
 
+    def pausing(self) -> None:
+        """
+        Operations to run when the process is paused, before it waits to be
+        resumed, e.g. to let other processes use what it holds.
+
+        Implement in child class if needed.
+        """
+
+        pass
+
+    def resuming(self) -> None:
+        """
+        Operations to run when the process is resumed after being paused.
+
+        Implement in child class if needed.
+        """
+
+        pass
+
+    def prioritize(self, data: bytes) -> None:
+        """
+        Change which items to work on next.
+
+        Implement in child class if needed.
+
+        :param data: the pickled items, most important first
+        """
+
+        pass
+
     def resume_work(self) -> None:
         worker_id, command = self.controller.recv_multipart()
         assert command in [b"RESUME", b"STOP"]
@@ -1400,7 +1735,7 @@ class CopyFilesResults:
         total_downloaded: Optional[int] = None,
         chunk_downloaded: Optional[int] = None,
         copy_succeeded: Optional[bool] = None,
-        rpd_file: Optional[RPDFile] = None,
+        rpd_file: Optional[RPDFileChanges] = None,
         download_count: Optional[int] = None,
         mdata_exceptions: Optional[Tuple] = None,
         problems: Optional[CopyingProblems] = None,
@@ -1419,7 +1754,7 @@ class CopyFilesResults:
         :param chunk_downloaded: how many bytes were downloaded since
          the last message
         :param copy_succeeded: whether the copy was successful or not
-        :param rpd_file: details of the file that was copied
+        :param rpd_file: changes made to the file that was copied
         :param download_count: a running count of how many files
          have been copied. Used in download tracking.
         :param mdata_exceptions: details of errors setting file metadata
@@ -1492,7 +1827,7 @@ class RenameAndMoveFileResults:
     def __init__(
         self,
         move_succeeded: bool = None,
-        rpd_file: RPDFile = None,
+        rpd_file: RPDFileChanges = None,
         download_count: int = None,
         stored_sequence_no: int = None,
         downloads_today: List[str] = None,
@@ -1532,14 +1867,26 @@ class OffloadResults:
         self.folders_preview = folders_preview
 
 
-class BackupArguments:
+class BackupDestination:
     """
-    Pass start up data to the back up process
+    A backup device to which the back up process is to back up a file
     """
 
-    def __init__(self, path: str, device_name: str) -> None:
+    def __init__(
+        self, device_id: int, path: str, device_name: str, do_backup: bool
+    ) -> None:
+        """
+        :param device_id: id of the backup device
+        :param path: path of the backup device
+        :param device_name: name of the device to display to the user
+        :param do_backup: whether the file should be backed up to this device.
+         Even if it is not, a reply is expected so the progress bar can be updated.
+        """
+
+        self.device_id = device_id
         self.path = path
         self.device_name = device_name
+        self.do_backup = do_backup
 
 
 class BackupFileData:
@@ -1549,9 +1896,9 @@ class BackupFileData:
 
     def __init__(
         self,
+        destinations: List[BackupDestination],
         rpd_file: Optional[RPDFile] = None,
         move_succeeded: Optional[bool] = None,
-        do_backup: Optional[bool] = None,
         path_suffix: Optional[str] = None,
         backup_duplicate_overwrite: Optional[bool] = None,
         verify_file: Optional[bool] = None,
@@ -1559,9 +1906,9 @@ class BackupFileData:
         save_fdo_thumbnail: Optional[int] = None,
         message: Optional[BackupStatus] = None,
     ) -> None:
+        self.destinations = destinations
         self.rpd_file = rpd_file
         self.move_succeeded = move_succeeded
-        self.do_backup = do_backup
         self.path_suffix = path_suffix
         self.backup_duplicate_overwrite = backup_duplicate_overwrite
         self.verify_file = verify_file
@@ -1579,11 +1926,17 @@ class BackupResults:
         chunk_downloaded: Optional[int] = None,
         backup_succeeded: Optional[bool] = None,
         do_backup: Optional[bool] = None,
-        rpd_file: Optional[RPDFile] = None,
+        rpd_file: Optional[RPDFileChanges] = None,
         backup_full_file_name: Optional[str] = None,
         mdata_exceptions: Optional[Tuple] = None,
         problems: Optional[BackingUpProblems] = None,
+        verified: Optional[bool] = None,
     ) -> None:
+        """
+        :param verified: whether the backup matches the file as it was downloaded,
+         or None if it was not checked
+        """
+
         self.scan_id = scan_id
         self.device_id = device_id
         self.total_downloaded = total_downloaded
@@ -1594,6 +1947,7 @@ class BackupResults:
         self.backup_full_file_name = backup_full_file_name
         self.mdata_exceptions = mdata_exceptions
         self.problems = problems
+        self.verified = verified
 
 
 class GenerateThumbnailsArguments:
@@ -1661,11 +2015,58 @@ class GenerateThumbnailsArguments:
         self.entire_photo_required = entire_photo_required
 
 
+# The pixels of a thumbnail, sent to the main process without being encoded
+RawThumbnail = namedtuple("RawThumbnail", "width height bytes_per_line format data")
+
+
+def raw_thumbnail(thumbnail: QImage) -> RawThumbnail:
+    """
+    :param thumbnail: thumbnail to send to the main process
+    :return: a copy of its pixels
+    """
+
+    return RawThumbnail(
+        width=thumbnail.width(),
+        height=thumbnail.height(),
+        bytes_per_line=thumbnail.bytesPerLine(),
+        format=int(thumbnail.format()),
+        data=thumbnail.constBits().asstring(thumbnail.sizeInBytes()),
+    )
+
+
+def thumbnail_to_pixmap(thumbnail: Optional[Union[bytes, RawThumbnail]]) -> QPixmap:
+    """
+    Convert a thumbnail received from a worker process into a pixmap.
+
+    :param thumbnail: the thumbnail's pixels, or the thumbnail in an image
+     format like JPEG or PNG, or None if there is no thumbnail
+    :return: the pixmap, which is null if there is no thumbnail
+    """
+
+    if thumbnail is None:
+        return QPixmap()
+    if isinstance(thumbnail, RawThumbnail):
+        # The image uses the data without copying it, until it is copied into
+        # the pixmap
+        image = QImage(
+            thumbnail.data,
+            thumbnail.width,
+            thumbnail.height,
+            thumbnail.bytes_per_line,
+            QImage.Format(thumbnail.format),
+        )
+    else:
+        image = QImage.fromData(thumbnail)
+    if image.isNull():
+        return QPixmap()
+    return QPixmap.fromImage(image)
+
+
 class GenerateThumbnailsResults:
     def __init__(
         self,
-        rpd_file: Optional[RPDFile] = None,
-        thumbnail_bytes: Optional[bytes] = None,
+        rpd_file: Optional[Union[RPDFile, RPDFileChanges]] = None,
+        thumbnail_bytes: Optional[Union[bytes, RawThumbnail]] = None,
         scan_id: Optional[int] = None,
         cache_dirs: Optional[CacheDirs] = None,
         camera_removed: Optional[bool] = None,
@@ -1693,6 +2094,8 @@ class ThumbnailExtractorArgument:
         write_fdo_thumbnail: bool,
         send_thumb_to_main: bool,
         force_exiftool: bool,
+        received_state: Optional[Tuple[Any, ...]] = None,
+        preview_reply_port: Optional[int] = None,
     ) -> None:
         self.rpd_file = rpd_file
         self.task = task
@@ -1706,6 +2109,95 @@ class ThumbnailExtractorArgument:
         self.write_fdo_thumbnail = write_fdo_thumbnail
         self.send_thumb_to_main = send_thumb_to_main
         self.force_exiftool = force_exiftool
+        # If not None, the state of the file when the main process sent it, and only
+        # the changes made to it since are sent back
+        self.received_state = received_state
+        # If not None, the port on which to report whether the photo's preview was
+        # found in the exif buffer. If it was not, no thumbnail is sent, because
+        # the photo will be sent again in its entirety.
+        self.preview_reply_port = preview_reply_port
+
+
+class SentFiles:
+    """
+    Snapshots of the files sent to a manager's worker processes. Workers send back
+    only the changes they made to a file, which are applied to the snapshot of the
+    file that was sent.
+
+    Files are added and removed in the main thread, and the changes are applied in
+    the manager's thread.
+    """
+
+    def __init__(self) -> None:
+        # key is uid, value is the class of the file, its state, the number of
+        # replies still expected, and the file's scan id
+        self.sent = {}  # type: Dict[bytes, List]
+        # Devices whose files were removed before every reply was received
+        self.removed_scan_ids = set()  # type: Set[int]
+        self.lock = threading.Lock()
+
+    def add(self, rpd_file: RPDFile, replies: int = 1) -> None:
+        """
+        Take a snapshot of a file that is about to be sent to a worker. Call before
+        sending the file.
+
+        :param rpd_file: file to be sent
+        :param replies: how many replies to expect for the file, i.e. how many
+         workers it is being sent to
+        """
+
+        with self.lock:
+            self.sent[rpd_file.uid] = [
+                rpd_file.__class__,
+                rpd_file_state(rpd_file),
+                replies,
+                rpd_file.scan_id,
+            ]
+
+    def remove(self, scan_id: int) -> None:
+        """
+        Remove the snapshots of the files sent from a device for which replies are
+        still expected, e.g. because the device was removed, its download finished,
+        or the worker was stopped. Replies that arrive later are ignored.
+
+        :param scan_id: the device's scan id
+        """
+
+        with self.lock:
+            uids = [uid for uid, sent in self.sent.items() if sent[3] == scan_id]
+            for uid in uids:
+                del self.sent[uid]
+            if uids:
+                self.removed_scan_ids.add(scan_id)
+        if uids:
+            logging.debug(
+                "Removed %s files still awaiting a reply for scan id %s",
+                len(uids),
+                scan_id,
+            )
+
+    def apply(self, rpd_file: Union[RPDFile, RPDFileChanges]) -> Optional[RPDFile]:
+        """
+        :param rpd_file: the changes a worker made to a file, or the file itself
+        :return: the file that was sent with the changes applied, or None if the
+         file was never sent
+        """
+
+        if isinstance(rpd_file, RPDFile):
+            return rpd_file
+
+        with self.lock:
+            sent = self.sent.get(rpd_file.uid)
+            if sent is None:
+                if self.removed_scan_ids:
+                    logging.debug("Ignoring changes to a file that was removed")
+                else:
+                    logging.error("Received changes to a file that was not sent")
+                return None
+            sent[2] -= 1
+            if sent[2] <= 0:
+                del self.sent[rpd_file.uid]
+        return rpd_file.apply(sent[0], sent[1])
 
 
 class RenameMoveFileManager(PushPullDaemonManager):
@@ -1722,12 +2214,14 @@ class RenameMoveFileManager(PushPullDaemonManager):
         super().__init__(logging_port=logging_port, thread_name=ThreadNames.rename)
         self._process_name = "Rename and Move File Manager"
         self._process_to_run = "renameandmovefile.py"
+        self.sent_files = SentFiles()
 
     def process_sink_data(self):
         data = pickle.loads(self.content)  # type: RenameAndMoveFileResults
         if data.move_succeeded is not None:
-
-            self.message.emit(data.move_succeeded, data.rpd_file, data.download_count)
+            rpd_file = self.sent_files.apply(data.rpd_file)
+            if rpd_file is not None:
+                self.message.emit(data.move_succeeded, rpd_file, data.download_count)
 
         elif data.problems is not None:
             self.renameProblems.emit(data.problems)
@@ -1758,14 +2252,7 @@ class ThumbnailDaemonManager(PushPullDaemonManager):
 
     def process_sink_data(self) -> None:
         data = pickle.loads(self.content)  # type: GenerateThumbnailsResults
-        if data.thumbnail_bytes is None:
-            thumbnail = QPixmap()
-        else:
-            thumbnail = QImage.fromData(data.thumbnail_bytes)
-            if thumbnail.isNull():
-                thumbnail = QPixmap()
-            else:
-                thumbnail = QPixmap.fromImage(thumbnail)
+        thumbnail = thumbnail_to_pixmap(data.thumbnail_bytes)
         self.message.emit(data.rpd_file, thumbnail)
 
 
@@ -1851,16 +2338,21 @@ class ScanManager(PublishPullPipelineManager):
 
 class BackupManager(PublishPullPipelineManager):
     """
-    Each backup "device" (it could be an external drive, or a user-
-    specified path on the local file system) has associated with it one
-    worker process. For example if photos and videos are both being
-    backed up to the same external hard drive, one worker process
-    handles both the photos and the videos. However if photos are being
-    backed up to one drive, and videos to another, there would be a
-    worker process for each drive (2 in total).
+    One worker process backs up to every backup "device" (it could be an
+    external drive, or a user-specified path on the local file system).
+    For example if photos are being backed up to one drive, and videos to
+    another, the worker handles both drives. Each file is read once, and
+    written to every device it is being backed up to at the same time.
+
+    The worker replies separately for each device.
     """
 
-    message = pyqtSignal(int, bool, bool, RPDFile, str, "PyQt_PyObject")
+    # There is only ever one worker
+    worker_id = 0
+
+    message = pyqtSignal(
+        int, bool, bool, RPDFile, str, "PyQt_PyObject", "PyQt_PyObject"
+    )
     bytesBackedUp = pyqtSignal("PyQt_PyObject", "PyQt_PyObject")
     backupProblems = pyqtSignal(int, "PyQt_PyObject")
 
@@ -1868,6 +2360,7 @@ class BackupManager(PublishPullPipelineManager):
         super().__init__(logging_port=logging_port, thread_name=ThreadNames.backup)
         self._process_name = "Backup Manager"
         self._process_to_run = "backupfile.py"
+        self.sent_files = SentFiles()
 
     def process_sink_data(self) -> None:
         data = pickle.loads(self.content)  # type: BackupResults
@@ -1879,14 +2372,17 @@ class BackupManager(PublishPullPipelineManager):
         elif data.backup_succeeded is not None:
             assert data.do_backup is not None
             assert data.rpd_file is not None
-            self.message.emit(
-                data.device_id,
-                data.backup_succeeded,
-                data.do_backup,
-                data.rpd_file,
-                data.backup_full_file_name,
-                data.mdata_exceptions,
-            )
+            rpd_file = self.sent_files.apply(data.rpd_file)
+            if rpd_file is not None:
+                self.message.emit(
+                    data.device_id,
+                    data.backup_succeeded,
+                    data.do_backup,
+                    rpd_file,
+                    data.backup_full_file_name,
+                    data.mdata_exceptions,
+                    data.verified,
+                )
         else:
             assert data.problems is not None
             self.backupProblems.emit(data.device_id, data.problems)
@@ -1908,6 +2404,7 @@ class CopyFilesManager(PublishPullPipelineManager):
         super().__init__(logging_port=logging_port, thread_name=ThreadNames.copy)
         self._process_name = "Copy Files Manager"
         self._process_to_run = "copyfiles.py"
+        self.sent_files = SentFiles()
 
     def process_sink_data(self) -> None:
         data = pickle.loads(self.content)  # type: CopyFilesResults
@@ -1929,12 +2426,14 @@ class CopyFilesManager(PublishPullPipelineManager):
         elif data.copy_succeeded is not None:
             assert data.rpd_file is not None
             assert data.download_count is not None
-            self.message.emit(
-                data.copy_succeeded,
-                data.rpd_file,
-                data.download_count,
-                data.mdata_exceptions,
-            )
+            rpd_file = self.sent_files.apply(data.rpd_file)
+            if rpd_file is not None:
+                self.message.emit(
+                    data.copy_succeeded,
+                    rpd_file,
+                    data.download_count,
+                    data.mdata_exceptions,
+                )
 
         elif data.problems is not None:
             self.copyProblems.emit(data.scan_id, data.problems)
@@ -0,0 +1,341 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""
+Schedule the reading and writing done by the program's processes, so that they
+take turns on each physical storage device.
+
+Processes copying, backing up and generating thumbnails can otherwise all use the
+same memory card reader or USB disk at once, making it seek back and forth
+between them.
+"""
+
+__author__ = "Damon Lynch"
+__copyright__ = "Copyright 2021, Damon Lynch"
+
+import contextlib
+import fcntl
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from raphodo.storage.storage import get_program_cache_directory
+
+
+# Key is the device's major and minor number. Value is the path of the device in
+# sysfs, or None if the path is not on a block device.
+_physical_devices = {}  # type: Dict[int, Optional[str]]
+
+
+def physical_device(path: str) -> Optional[str]:
+    """
+    Determine the physical block device a file or directory is on, e.g. the disk
+    rather than the partition.
+
+    :param path: file or directory. If it does not exist, the directory it would
+     be created in is used.
+    :return: the device's path in sysfs, e.g. /sys/devices/.../block/sdb, or None
+     if the path is not on a block device, e.g. it is on a network or a camera
+    """
+
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    if not path:
+        return None
+
+    try:
+        st_dev = os.stat(path).st_dev
+    except OSError:
+        return None
+
+    try:
+        return _physical_devices[st_dev]
+    except KeyError:
+        pass
+
+    sys_path = "/sys/dev/block/{}:{}".format(os.major(st_dev), os.minor(st_dev))
+    if os.path.exists(sys_path):
+        device = os.path.realpath(sys_path)
+        if os.path.exists(os.path.join(device, "partition")):
+            device = os.path.dirname(device)
+    else:
+        # e.g. tmpfs, a network file system, or a Btrfs subvolume
+        device = None
+
+    _physical_devices[st_dev] = device
+    return device
+
+
+def _read_sysfs_attribute(device: str, attribute: str) -> Optional[str]:
+    try:
+        with open(os.path.join(device, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def device_seeks_slowly(device: str) -> bool:
+    """
+    :param device: the device's path in sysfs
+    :return: True if the device is a spinning disk, or is removable or attached by
+     USB, e.g. a memory card reader, else False
+    """
+
+    return (
+        _read_sysfs_attribute(device, "queue/rotational") == "1"
+        or _read_sysfs_attribute(device, "removable") == "1"
+        or "/usb" in device
+    )
+
+
+class IOScheduler:
+    """
+    Limit how many of the program's processes can use each physical storage device
+    at the same time.
+
+    Each device has a lock file. Its first byte is the queue. Each of its
+    remaining bytes is a slot, one of which must be held with a record lock for the
+    device to be used. The kernel releases the locks should the process holding
+    them terminate.
+
+    Only the process holding the queue acquires a slot, so that processes take
+    turns in the order they asked for them: a process copying one file after
+    another cannot keep the device to itself. Processes waiting for the queue
+    block in the kernel rather than polling the slots.
+
+    A process that is paused while it holds a turn gives it up until it resumes,
+    so that a paused download does not hold up other processes.
+
+    Record locks belong to a process, not to a file descriptor, and closing any
+    descriptor of a file releases all the process's locks on it. Each lock file is
+    therefore opened only once in each process, and only one thread in a process
+    should use the scheduler.
+    """
+
+    # Devices that seek slowly are used by one process at a time
+    slow_device_slots = 1
+    fast_device_slots = 4
+    queue_byte = 0
+    # How long to wait before trying again to acquire a slot, in seconds
+    retry_delay = 0.05
+    # How long a read waits for its turn at most, after which it reads anyway, so
+    # that a device that has stopped responding cannot hold it up indefinitely, in
+    # seconds
+    max_read_wait = 10.0
+
+    def __init__(self) -> None:
+        self.cache_directory = get_program_cache_directory(create_if_not_exist=True)
+        # Key is the device's path in sysfs
+        self.fds = {}  # type: Dict[str, Optional[int]]
+        self.no_slots = {}  # type: Dict[str, int]
+        self.seeks_slowly = {}  # type: Dict[str, bool]
+        # The turns held, each a list of the device, the file descriptor of its
+        # lock file and the slot, in the order they were taken
+        self.held = []  # type: List[List]
+        self.suspended = False
+
+    def _lock_file(self, device: str) -> Optional[int]:
+        """
+        :param device: the device's path in sysfs
+        :return: file descriptor of the device's lock file, or None if it could
+         not be opened
+        """
+
+        try:
+            return self.fds[device]
+        except KeyError:
+            pass
+
+        fd = None
+        if self.cache_directory is not None:
+            dev = _read_sysfs_attribute(device, "dev") or os.path.basename(device)
+            lock_file_name = "io_{}.lock".format(dev.replace(":", "_"))
+            try:
+                fd = os.open(
+                    os.path.join(self.cache_directory, lock_file_name),
+                    os.O_RDWR | os.O_CREAT,
+                    0o600,
+                )
+            except OSError:
+                logging.error(
+                    "Unable to open the I/O scheduler lock file in %s",
+                    self.cache_directory,
+                )
+        self.fds[device] = fd
+        self.seeks_slowly[device] = device_seeks_slowly(device)
+        if self.seeks_slowly[device]:
+            self.no_slots[device] = self.slow_device_slots
+        else:
+            self.no_slots[device] = self.fast_device_slots
+        return fd
+
+    def _devices(self, paths: Tuple[str, ...]) -> List[Tuple[str, int]]:
+        """
+        :param paths: files or directories
+        :return: the devices the paths are on and the file descriptors of their
+         lock files, sorted so that every process acquires them in the same order
+        """
+
+        devices = []  # type: List[Tuple[str, int]]
+        for device in sorted({physical_device(path) for path in paths} - {None}):
+            fd = self._lock_file(device)
+            if fd is not None:
+                devices.append((device, fd))
+        return devices
+
+    def _try_acquire_slot(self, device: str, fd: int) -> Optional[int]:
+        """
+        :return: the slot acquired, or None if none is free
+        """
+
+        for slot in range(1, self.no_slots[device] + 1):
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            except OSError:
+                continue
+            return slot
+        return None
+
+    def _take_turn(
+        self, device: str, fd: int, deadline: Optional[float] = None
+    ) -> Optional[int]:
+        """
+        Wait in the queue for a turn to use the device, then acquire a slot
+
+        :param deadline: if specified, the time.monotonic() value after which to
+         stop waiting for a slot
+        :return: the slot acquired, or None if the deadline passed
+        """
+
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, self.queue_byte)
+        try:
+            while True:
+                slot = self._try_acquire_slot(device, fd)
+                if slot is not None:
+                    return slot
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.retry_delay)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, self.queue_byte)
+
+    def _release(self, turns: List[List]) -> None:
+        for turn in reversed(turns):
+            self.held.remove(turn)
+            if not self.suspended:
+                fcntl.lockf(turn[1], fcntl.LOCK_UN, 1, turn[2])
+
+    @contextlib.contextmanager
+    def copy(self, *paths: str):
+        """
+        Wait for a turn to copy a whole file on every device the paths are on,
+        and hold it until the context exits.
+
+        :param paths: the file being copied, and its copies
+        """
+
+        turns = []  # type: List[List]
+        try:
+            for device, fd in self._devices(paths):
+                turns.append([device, fd, self._take_turn(device, fd)])
+                self.held.append(turns[-1])
+            yield
+        finally:
+            self._release(turns)
+
+    @contextlib.contextmanager
+    def read(self, path: str):
+        """
+        Wait for a turn to read part of a file, and hold it until the context
+        exits. Waits no longer than max_read_wait.
+
+        :param path: the file being read
+        """
+
+        devices = self._devices((path,))
+        if not devices:
+            yield
+            return
+
+        device, fd = devices[0]
+        slot = self._take_turn(device, fd, time.monotonic() + self.max_read_wait)
+        if slot is None:
+            logging.debug("Reading from %s without waiting any longer for a turn", path)
+            yield
+            return
+        turns = [[device, fd, slot]]
+        self.held.extend(turns)
+        try:
+            yield
+        finally:
+            self._release(turns)
+
+    def wait_for_turn(self, path: str) -> None:
+        """
+        Wait for a turn to use the device the path is on, but do not hold it.
+        Does not wait at all if the device does not seek slowly, because reading
+        from it hardly slows other processes using it. Waits no longer than
+        max_read_wait.
+
+        Use before work that reads a file but mostly uses the CPU, so that
+        it reads between the files being copied, and other processes are not held
+        up while it works.
+
+        :param path: the file about to be read
+        """
+
+        for device, fd in self._devices((path,)):
+            if self.seeks_slowly[device]:
+                slot = self._take_turn(
+                    device, fd, time.monotonic() + self.max_read_wait
+                )
+                if slot is not None:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, 1, slot)
+
+    def suspend(self) -> None:
+        """
+        Give up every turn held, e.g. while the process is paused. Call resume()
+        before continuing to use the devices.
+        """
+
+        if self.suspended:
+            return
+        for device, fd, slot in reversed(self.held):
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, slot)
+        self.suspended = True
+
+    def resume(self) -> None:
+        """
+        Wait for the turns given up by suspend() to be taken again
+        """
+
+        if not self.suspended:
+            return
+        self.suspended = False
+        for turn in self.held:
+            turn[2] = self._take_turn(turn[0], turn[1])
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            if fd is not None:
+                os.close(fd)
+        self.fds = {}
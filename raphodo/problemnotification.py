@@ -192,6 +192,12 @@ class FileCopyProblem(SeriousProblem):
         return escape(_("Unable to copy file %s")) % self.href
 
 
+class FileVerificationProblem(SeriousProblem):
+    @property
+    def body(self) -> str:
+        return escape(_("Copy of file %s does not match the original")) % self.href
+
+
 class FileZeroLengthProblem(SeriousProblem):
     @property
     def body(self) -> str:
@@ -178,7 +178,7 @@ from raphodo.interprocess import (
     ScanArguments,
     CopyFilesArguments,
     RenameAndMoveFileData,
-    BackupArguments,
+    BackupDestination,
     BackupFileData,
     OffloadData,
     ProcessLoggingManager,
@@ -807,6 +807,7 @@ class RapidWindow(QMainWindow):
         # For meaning of 'Devices', see devices.py
         self.devices = DeviceCollection(self.exiftool_process, self)
         self.backup_devices = BackupDeviceCollection(rapidApp=self)
+        self.backup_worker_started = False
 
         logging.debug("Starting thumbnail daemon model")
 
@@ -3732,6 +3733,9 @@ Do you want to proceed with the download?"""
 
         # Initiate copy files process
 
+        for rpd_file in files:
+            self.copyfilesmq.sent_files.add(rpd_file)
+
         device = self.devices[scan_id]
         copyfiles_args = CopyFilesArguments(
             scan_id=scan_id,
@@ -3767,6 +3771,18 @@ Do you want to proceed with the download?"""
                 self.cleanTempDirsForScanId(scan_id, remove_entry=False)
             self.temp_dirs_by_scan_id = {}
 
+    def removeSentFiles(self, scan_id: int) -> None:
+        """
+        Stop tracking the files of a device sent to the processes that download
+        them, and for which replies are still expected, e.g. because the device
+        was removed or its download finished.
+
+        :param scan_id: the device's scan id
+        """
+
+        for manager in (self.copyfilesmq, self.renamemq, self.backupmq):
+            manager.sent_files.remove(scan_id)
+
     def cleanTempDirsForScanId(self, scan_id: int, remove_entry: bool = True):
         """
         Deletes temporary files and folders used in download.
@@ -3821,6 +3837,7 @@ Do you want to proceed with the download?"""
                 mdata_exceptions=mdata_exceptions,
             )
 
+        self.renamemq.sent_files.add(rpd_file)
         self.sendDataMessageToThread(
             self.rename_controller,
             data=RenameAndMoveFileData(
@@ -4049,17 +4066,27 @@ Do you want to proceed with the download?"""
     def sendBackupStartFinishMessageToWorkers(self, message: BackupStatus) -> None:
         if self.prefs.backup_files:
             download_types = self.download_files.download_types
+            destinations = []
             for path in self.backup_devices:
                 backup_type = self.backup_devices[path].backup_type
                 if (
                     backup_type == BackupLocationType.photos_and_videos
                     or download_types == DownloadingFileTypes.photos_and_videos
                 ) or backup_type == download_types:
-                    device_id = self.backup_devices.device_id(path)
-                    data = BackupFileData(message=message)
-                    self.sendDataMessageToThread(
-                        self.backup_controller, worker_id=device_id, data=data
-                    )
+                    destinations.append(self.backupDestination(path, do_backup=True))
+            if destinations:
+                data = BackupFileData(destinations=destinations, message=message)
+                self.sendDataMessageToThread(
+                    self.backup_controller, worker_id=BackupManager.worker_id, data=data
+                )
+
+    def backupDestination(self, path: str, do_backup: bool) -> BackupDestination:
+        return BackupDestination(
+            device_id=self.backup_devices.device_id(path),
+            path=path,
+            device_name=self.backup_devices.name(path),
+            do_backup=do_backup,
+        )
 
     def backupFile(
         self, rpd_file: RPDFile, move_succeeded: bool, download_count: int
@@ -4077,6 +4104,10 @@ Do you want to proceed with the download?"""
         else:
             logging.debug("Backing up video %s", rpd_file.download_name)
 
+        # The changes made to the file are sent back for every backup device
+        self.backupmq.sent_files.add(rpd_file, replies=len(self.backup_devices))
+
+        destinations = []
         for path in self.backup_devices:
             backup_type = self.backup_devices[path].backup_type
             do_backup = (
@@ -4094,27 +4125,26 @@ Do you want to proceed with the download?"""
                 logging.debug("Backing up to %s", path)
             else:
                 logging.debug("Not backing up to %s", path)
-            # Even if not going to backup to this device, need to send it
-            # anyway so progress bar can be updated. Not this most efficient
-            # but the code is more simpler
-            # TODO: investigate a more optimal approach!
-
-            device_id = self.backup_devices.device_id(path)
-            data = BackupFileData(
-                rpd_file=rpd_file,
-                move_succeeded=move_succeeded,
-                do_backup=do_backup,
-                path_suffix=path_suffix,
-                backup_duplicate_overwrite=self.prefs.backup_duplicate_overwrite,
-                verify_file=self.prefs.verify_file,
-                download_count=download_count,
-                save_fdo_thumbnail=self.prefs.save_fdo_thumbnails,
-            )
-            self.sendDataMessageToThread(
-                self.backup_controller, worker_id=device_id, data=data
-            )
+            # Even if not going to backup to this device, need to include it
+            # anyway so progress bar can be updated.
+            destinations.append(self.backupDestination(path, do_backup=do_backup))
+
+        # The file is read once and written to all its destinations at the same time
+        data = BackupFileData(
+            destinations=destinations,
+            rpd_file=rpd_file,
+            move_succeeded=move_succeeded,
+            path_suffix=path_suffix,
+            backup_duplicate_overwrite=self.prefs.backup_duplicate_overwrite,
+            verify_file=self.prefs.verify_file,
+            download_count=download_count,
+            save_fdo_thumbnail=self.prefs.save_fdo_thumbnails,
+        )
+        self.sendDataMessageToThread(
+            self.backup_controller, worker_id=BackupManager.worker_id, data=data
+        )
 
-    @pyqtSlot(int, bool, bool, RPDFile, str, "PyQt_PyObject")
+    @pyqtSlot(int, bool, bool, RPDFile, str, "PyQt_PyObject", "PyQt_PyObject")
     def fileBackedUp(
         self,
         device_id: int,
@@ -4123,9 +4153,17 @@ Do you want to proceed with the download?"""
         rpd_file: RPDFile,
         backup_full_file_name: str,
         mdata_exceptions: Optional[Tuple[Exception]],
+        verified: Optional[bool],
     ) -> None:
 
         if do_backup:
+            if verified is False:
+                logging.error(
+                    "Backup %s of %s failed verification",
+                    backup_full_file_name,
+                    rpd_file.download_name,
+                )
+
             if (
                 self.prefs.generate_thumbnails
                 and self.prefs.save_fdo_thumbnails
@@ -4339,6 +4377,8 @@ Do you want to proceed with the download?"""
         # directory
         logging.debug("Purging temp directories")
         self.cleanTempDirsForScanId(scan_id)
+        # Files that failed to download may never have been replied to
+        self.removeSentFiles(scan_id)
         if self.prefs.move:
             logging.debug("Deleting downloaded source files")
             self.deleteSourceFiles(scan_id)
@@ -6108,6 +6148,9 @@ Do you want to proceed with the download?"""
             elif device_state == DeviceState.thumbnailing:
                 self.thumbnailModel.terminateThumbnailGeneration(scan_id)
 
+            self.removeSentFiles(scan_id)
+            self.thumbnailModel.thumbnailer.remove_sent_files(scan_id)
+
             if ignore_in_this_program_instantiation:
                 self.devices.ignore_device(scan_id=scan_id)
 
@@ -6282,8 +6325,7 @@ Do you want to proceed with the download?"""
         self.backupPanel.setupBackupDisplay()
 
     def removeBackupDevice(self, path: str) -> None:
-        device_id = self.backup_devices.device_id(path)
-        self.sendStopWorkerToThread(self.backup_controller, worker_id=device_id)
+        # The backup worker is told which devices to back up to with each file
         del self.backup_devices[path]
 
     def resetupBackupDevices(self) -> None:
@@ -6461,14 +6503,13 @@ Do you want to proceed with the download?"""
                 logging.warning("This Computer download path is not specified")
 
     def addDeviceToBackupManager(self, path: str) -> None:
-        device_id = self.backup_devices.device_id(path)
-        self.backup_controller.send_multipart(
-            create_inproc_msg(
-                b"START_WORKER",
-                worker_id=device_id,
-                data=BackupArguments(path, self.backup_devices.name(path)),
+        # One worker backs up to every device. Start it when the first device is
+        # added.
+        if not self.backup_worker_started:
+            self.backup_controller.send_multipart(
+                create_inproc_msg(b"START_WORKER", worker_id=BackupManager.worker_id)
             )
-        )
+            self.backup_worker_started = True
 
     def setupManualBackup(self) -> None:
         """
@@ -60,7 +60,7 @@ from raphodo.interprocess import (
     RenameAndMoveFileResults,
     DaemonProcess,
 )
-from raphodo.rpdfile import RPDFile, Photo, Video
+from raphodo.rpdfile import RPDFile, RPDFileChanges, Photo, Video
 from raphodo.rpdsql import DownloadedSQL
 from raphodo.utilities import (
     stdchannel_redirected,
@@ -293,6 +293,8 @@ class RenameMoveFileWorker(DaemonProcess):
     """
 
     def __init__(self) -> None:
+        # Send back only what changed in the files received from the main process
+        RPDFile.track_changes = True
         super().__init__("Rename and Move")
 
         self.prefs = Preferences()
@@ -1077,6 +1079,7 @@ class RenameMoveFileWorker(DaemonProcess):
                                         modification_time=rpd_file.modification_time,
                                         download_full_file_name=rpd_file.download_full_file_name,
                                     )
+                                    self.downloaded.update_filter()
                                 except sqlite3.OperationalError as e:
                                     # This should never happen because this is the only
                                     # process writing to the database..... but just in
@@ -1094,7 +1097,7 @@ class RenameMoveFileWorker(DaemonProcess):
                         self.content = pickle.dumps(
                             RenameAndMoveFileResults(
                                 move_succeeded=move_succeeded,
-                                rpd_file=rpd_file,
+                                rpd_file=RPDFileChanges(rpd_file),
                                 download_count=download_count,
                             ),
                             pickle.HIGHEST_PROTOCOL,
@@ -22,12 +22,14 @@ __copyright__ = "Copyright 2011-2021, Damon Lynch"
 import os
 import time
 from datetime import datetime
+from enum import Enum
 import uuid
 import logging
 import mimetypes
+from operator import attrgetter
 from collections import Counter, UserDict
 import locale
-from typing import Optional, List, Tuple, Union, Any
+from typing import Optional, List, Tuple, Union, Any, Dict
 
 import gi
 
@@ -338,6 +340,95 @@ class RPDFile:
     title = ""
     title_capitalized = ""
 
+    # Set to True in worker processes that send back only the changes they make to
+    # the files they receive. See RPDFileChanges.
+    track_changes = False
+
+    # A scan can produce hundreds of thousands of files, all of which are kept for
+    # the session and pickled each time they are sent between processes. Slots keep
+    # them compact. Only these attributes are pickled.
+    wire_attributes = (
+        "from_camera",
+        "camera_details",
+        "device_display_name",
+        "device_uri",
+        "path",
+        "name",
+        "prev_full_name",
+        "prev_datetime",
+        "previously_downloaded",
+        "full_file_name",
+        "raw_exif_bytes",
+        "exif_source",
+        "file_type",
+        "extension",
+        "extension_type",
+        "mime_type",
+        "size",
+        "_datetime",
+        "_no_datetime_metadata",
+        "never_read_mdatatime",
+        "device_timestamp_type",
+        "mdatatime_caused_ctime_change",
+        "_mtime",
+        "_raw_mtime",
+        "_mdatatime",
+        "ctime",
+        "camera_memory_card_identifiers",
+        "thm_full_name",
+        "audio_file_full_name",
+        "xmp_file_full_name",
+        "log_file_full_name",
+        "status",
+        "problem",
+        "scan_id",
+        "uid",
+        "job_code",
+        "thumbnail_status",
+        "fdo_thumbnail_128_name",
+        "fdo_thumbnail_256_name",
+        "fdo_thumbnail_256",
+        "thumbnail_cache_status",
+        "cache_full_file_name",
+        "temp_sample_full_file_name",
+        "temp_sample_is_complete_file",
+        "temp_full_file_name",
+        "temp_thm_full_name",
+        "temp_audio_full_name",
+        "temp_xmp_full_name",
+        "temp_log_full_name",
+        "temp_cache_full_file_chunk",
+        "download_start_time",
+        "download_folder",
+        "download_subfolder",
+        "download_path",
+        "download_name",
+        "download_full_file_name",
+        "download_full_base_name",
+        "download_thm_full_name",
+        "download_xmp_full_name",
+        "download_log_full_name",
+        "download_audio_full_name",
+        "thm_extension",
+        "audio_extension",
+        "xmp_extension",
+        "log_extension",
+        "metadata",
+        "metadata_failure",
+        "subfolder_pref_list",
+        "name_pref_list",
+        "generate_extension_case",
+        "modified_via_daemon_process",
+        "name_generation_problem",
+        "strip_characters",
+        "sequences",
+        "checksum",
+        "generate_thumbnail",
+    )
+    # received_state is the pickled state the file was created from, if
+    # track_changes is True
+    __slots__ = wire_attributes + ("received_state",)
+
     def __init__(
         self,
         name: str,
@@ -407,22 +498,13 @@ class RPDFile:
         """
 
         self.from_camera = from_camera
+        # Details of the camera are shared by all files from the camera. The
+        # camera model, port etc. are properties derived from them.
         self.camera_details = camera_details
 
         self.device_display_name = device_display_name
         self.device_uri = device_uri
 
-        if camera_details is not None:
-            self.camera_model = camera_details.model
-            self.camera_port = camera_details.port
-            self.camera_display_name = camera_details.display_name
-            self.is_mtp_device = camera_details.is_mtp == True
-            self.camera_storage_descriptions = camera_details.storage_desc
-        else:
-            self.camera_model = self.camera_port = self.camera_display_name = None
-            self.camera_storage_descriptions = None
-            self.is_mtp_device = False
-
         self.path = path
 
         self.name = name
@@ -590,6 +672,52 @@ class RPDFile:
         # If true, there was a name generation problem
         self.name_generation_problem = False
 
+        # Assigned only when needed
+        self.strip_characters = None  # type: Optional[bool]
+        self.sequences = None
+        # Checksum of the file's contents when verifying copies of it
+        self.checksum = None  # type: Optional[str]
+        self.generate_thumbnail = False
+
+        self.received_state = None  # type: Optional[Tuple[Any, ...]]
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        # A tuple of the attribute values, in the order of wire_attributes
+        return _get_rpdfile_state(self)
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        for name, value in zip(RPDFile.wire_attributes, state):
+            object.__setattr__(self, name, value)
+        self.received_state = state if RPDFile.track_changes else None
+
+    @property
+    def camera_model(self) -> Optional[str]:
+        if self.camera_details is None:
+            return None
+        return self.camera_details.model
+
+    @property
+    def camera_port(self) -> Optional[str]:
+        if self.camera_details is None:
+            return None
+        return self.camera_details.port
+
+    @property
+    def camera_display_name(self) -> Optional[str]:
+        if self.camera_details is None:
+            return None
+        return self.camera_details.display_name
+
+    @property
+    def is_mtp_device(self) -> bool:
+        return self.camera_details is not None and self.camera_details.is_mtp == True
+
+    @property
+    def camera_storage_descriptions(self) -> Optional[List[str]]:
+        if self.camera_details is None:
+            return None
+        return self.camera_details.storage_desc
+
     def should_write_fdo(self) -> bool:
         """
         :return: True if a FDO thumbnail should be written for this file
@@ -846,7 +974,102 @@ class RPDFile:
         )
 
 
+_get_rpdfile_state = attrgetter(*RPDFile.wire_attributes)
+
+# Attribute values that cannot be modified in place, and so can be compared with
+# the value the file was received with to determine if they changed
+_immutable_types = (
+    type(None),
+    str,
+    bytes,
+    int,
+    float,
+    datetime,
+    Enum,
+    tuple,
+    frozenset,
+)
+# Cache of whether a type is immutable
+_type_is_immutable = {}  # type: Dict[type, bool]
+
+
+class RPDFileChanges:
+    """
+    The attributes a worker process changed in a file it received, which it sends
+    back in place of the entire file. Much smaller than the file it describes.
+
+    The process that sent the file keeps a snapshot of its state, to which the
+    changes are applied.
+    """
+
+    __slots__ = ("uid", "changes")
+
+    def __init__(self, rpd_file: RPDFile) -> None:
+        """
+        :param rpd_file: the file, which was received from another process while
+         RPDFile.track_changes was True. If it was not, all its attributes are
+         recorded as changed.
+        """
+
+        self.uid = rpd_file.uid
+        state = _get_rpdfile_state(rpd_file)
+        received = rpd_file.received_state
+        if received is None:
+            self.changes = tuple(enumerate(state))
+            return
+
+        changes = []
+        for index, (value, previous) in enumerate(zip(state, received)):
+            value_type = type(value)
+            immutable = _type_is_immutable.get(value_type)
+            if immutable is None:
+                immutable = issubclass(value_type, _immutable_types)
+                _type_is_immutable[value_type] = immutable
+            # Mutable values may have been modified in place
+            if immutable and (
+                value is previous
+                or (value_type is type(previous) and value == previous)
+            ):
+                continue
+            changes.append((index, value))
+        self.changes = tuple(changes)
+
+    def __getstate__(self) -> Tuple[bytes, Tuple[Tuple[int, Any], ...]]:
+        return self.uid, self.changes
+
+    def __setstate__(self, state: Tuple[bytes, Tuple[Tuple[int, Any], ...]]) -> None:
+        self.uid, self.changes = state
+
+    def apply(self, rpd_file_class: type, state: Tuple[Any, ...]) -> RPDFile:
+        """
+        Recreate the file the changes were made to.
+
+        :param rpd_file_class: class of the file that was sent, e.g. Photo
+        :param state: state of the file when it was sent, as returned by
+         rpd_file_state()
+        :return: a new file with the changes applied
+        """
+
+        state = list(state)
+        for index, value in self.changes:
+            state[index] = value
+        rpd_file = rpd_file_class.__new__(rpd_file_class)
+        rpd_file.__setstate__(state)
+        return rpd_file
+
+
+def rpd_file_state(rpd_file: RPDFile) -> Tuple[Any, ...]:
+    """
+    :param rpd_file: file whose state to get
+    :return: a snapshot of the values of the attributes that are pickled
+    """
+
+    return _get_rpdfile_state(rpd_file)
+
+
 class Photo(RPDFile):
+    __slots__ = ()
+
     title = _("photo")
     title_capitalized = _("Photo")
 
@@ -909,6 +1132,8 @@ class Photo(RPDFile):
 
 
 class Video(RPDFile):
+    __slots__ = ()
+
     title = _("video")
     title_capitalized = _("Video")
 
@@ -938,6 +1163,8 @@ class Video(RPDFile):
 
 
 class SamplePhoto(Photo):
+    __slots__ = ()
+
     def __init__(self, sample_name="IMG_1234.CR2", sequences=None):
         mtime = time.time()
         super().__init__(
@@ -966,6 +1193,8 @@ class SamplePhoto(Photo):
 
 
 class SampleVideo(Video):
+    __slots__ = ()
+
     def __init__(self, sample_name="MVI_1234.MOV", sequences=None):
         mtime = time.time()
         super().__init__(
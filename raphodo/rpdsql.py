@@ -24,8 +24,22 @@ __copyright__ = "Copyright 2015-2022, Damon Lynch"
 import sqlite3
 import os
 import datetime
-from collections import namedtuple
-from typing import Optional, List, Tuple, Any, Sequence, NamedTuple, Dict
+import time
+import threading
+import struct
+import hashlib
+import fcntl
+from collections import namedtuple, defaultdict
+from typing import (
+    Optional,
+    List,
+    Tuple,
+    Any,
+    Sequence,
+    NamedTuple,
+    Dict,
+    DefaultDict,
+)
 import logging
 
 from PyQt5.QtCore import Qt
@@ -43,7 +57,11 @@ class FileDownloaded(NamedTuple):
     download_datetime: datetime.datetime
 
 
-InCache = namedtuple("InCache", "md5_name, mdatatime, orientation_unknown, failure")
+InCache = namedtuple(
+    "InCache",
+    "md5_name, mdatatime, orientation_unknown, failure, segment, segment_offset, "
+    "segment_length, accessed",
+)
 
 ThumbnailRow = namedtuple(
     "ThumbnailRow",
@@ -60,6 +78,89 @@ sqlite3.register_converter("FILETYPE", lambda v: FileType(int(v)))
 sqlite3_timeout = 10.0
 sqlite3_retry_attempts = 5
 
+# How many compiled statements each pooled connection keeps. The default is 128.
+sqlite3_cached_statements = 256
+
+
+class SQLiteConnectionPool:
+    """
+    Long lived connections to on-disk databases, one per database file per process
+    and thread.
+
+    Opening a database file is relatively expensive, and worker processes like the
+    scanner query the databases once or twice for every file they encounter.
+    Keeping the connection open means the statement cache (i.e. prepared
+    statements) and the page cache survive between queries.
+
+    Connections are never shared across a fork: if the process id changes, any
+    inherited connections are abandoned (not closed, which is unsafe in the child)
+    and fresh ones opened.
+    """
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self) -> None:
+        self.pid = os.getpid()
+        self._local = threading.local()
+
+    def _connections(self) -> Dict[str, sqlite3.Connection]:
+        if os.getpid() != self.pid:
+            self._reset()
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def connection(self, db: str) -> sqlite3.Connection:
+        """
+        :param db: full path to the database file
+        :return: the connection for this process and thread, opening it if needed
+        """
+
+        connections = self._connections()
+        conn = connections.get(db)
+        if conn is None:
+            conn = sqlite3.connect(
+                db,
+                timeout=sqlite3_timeout,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                cached_statements=sqlite3_cached_statements,
+            )
+            try:
+                # Write ahead logging lets readers in other processes proceed while
+                # one process writes, and makes each commit a sequential append
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute("PRAGMA cache_size=-8192")
+            except sqlite3.OperationalError as e:
+                # For example the database is on a file system that does not
+                # support the shared memory WAL requires
+                logging.warning("Could not tune database %s: %s", db, e)
+            connections[db] = conn
+        return conn
+
+    def close(self, db: str) -> None:
+        """
+        Close the connection to the database, if one is open in this process and
+        thread. It will be reopened the next time it is needed, which is how
+        connections are recovered after an error.
+
+        :param db: full path to the database file
+        """
+
+        conn = self._connections().pop(db, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.warning("Error closing database %s: %s", db, e)
+
+
+sqlite_connections = SQLiteConnectionPool()
+
 
 class ThumbnailRowsSQL:
     """
@@ -708,6 +809,242 @@ class ThumbnailRowsSQL:
         self.conn.commit()
 
 
+class DownloadedFilter:
+    """
+    Bloom filter of the file names and sizes recorded in the database of
+    previously downloaded files.
+
+    Most files on a freshly inserted memory card have never been downloaded. When
+    the filter says a file cannot be in the database, there is no need to query it.
+    The filter never gives a false negative, only the occasional false positive,
+    in which case the database is queried as normal. The file modification time is
+    not part of the key so the filter can also be used for the time zone offset
+    search.
+
+    The filter is persisted in a file alongside the database. The file records the
+    highest database rowid it covers, which means bringing it up to date requires
+    reading only those rows added since it was last updated. It also records the
+    database schema version, which changes if the table is dropped and recreated,
+    and a fingerprint of the row with the highest rowid it covers, which changes if
+    the database is deleted and created again. In either case the filter is rebuilt
+    from scratch.
+    """
+
+    header = struct.Struct("<4sIIQQqqQ")
+    magic = b"RPDF"
+    version = 2
+    no_hashes = 7
+    # When the filter is full, it has a false positive rate of about 1%
+    bits_per_entry = 10
+    minimum_capacity = 1024 * 64
+
+    def __init__(self, filter_file: str, table_name: str) -> None:
+        """
+        :param filter_file: full path of the file the filter is persisted in
+        :param table_name: name of the table of downloaded files
+        """
+
+        self.filter_file = filter_file
+        self.table_name = table_name
+        self.no_bits = 0
+        self.bits = b""
+
+    def _positions(self, name: str, size: int) -> List[int]:
+        digest = hashlib.blake2b(
+            "{}/{}".format(name, size).encode("utf-8", "surrogateescape"),
+            digest_size=16,
+        ).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little")
+        return [(h1 + i * h2) % self.no_bits for i in range(self.no_hashes)]
+
+    def might_contain(self, name: str, size: int) -> bool:
+        """
+        :param name: file name, not including path
+        :param size: file size in bytes
+        :return: False if the file is definitely not in the database, else True
+        """
+
+        if not self.no_bits:
+            return True
+        bits = self.bits
+        for position in self._positions(name, size):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _fingerprint(self, conn: sqlite3.Connection, rowid: int) -> int:
+        """
+        :return: a hash of the file name and size in the row, or 0 if there is no
+         such row
+        """
+
+        row = conn.execute(
+            "SELECT file_name, size FROM {tn} WHERE rowid=?".format(tn=self.table_name),
+            (rowid,),
+        ).fetchone()
+        if row is None:
+            return 0
+        digest = hashlib.blake2b(
+            "{}/{}".format(*row).encode("utf-8", "surrogateescape"), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "little")
+
+    def _rebuild(
+        self, fd: int, conn: sqlite3.Connection, max_rowid: int, schema_version: int
+    ) -> None:
+        entries = conn.execute(
+            "SELECT COUNT(*) FROM {tn}".format(tn=self.table_name)
+        ).fetchone()[0]
+        # Allow for the database to double in size before the filter needs rebuilding
+        capacity = max(entries * 2, self.minimum_capacity)
+        self.no_bits = capacity * self.bits_per_entry
+        bits = bytearray((self.no_bits + 7) // 8)
+        for name, size in conn.execute(
+            "SELECT file_name, size FROM {tn} WHERE rowid<=?".format(
+                tn=self.table_name
+            ),
+            (max_rowid,),
+        ):
+            for position in self._positions(name, size):
+                bits[position >> 3] |= 1 << (position & 7)
+
+        os.ftruncate(fd, 0)
+        os.pwrite(
+            fd,
+            self.header.pack(
+                self.magic,
+                self.version,
+                self.no_hashes,
+                self.no_bits,
+                entries,
+                max_rowid,
+                schema_version,
+                self._fingerprint(conn, max_rowid),
+            ),
+            0,
+        )
+        os.pwrite(fd, bytes(bits), self.header.size)
+        logging.debug(
+            "Built filter of %s previously downloaded files (%s bytes)",
+            entries,
+            len(bits),
+        )
+
+    def update(self, conn: sqlite3.Connection) -> None:
+        """
+        Bring the persisted filter up to date with the database, rebuilding it
+        if it is missing, invalid or full.
+
+        Only the bytes of the filter that change are written.
+
+        :param conn: connection to the database of downloaded files
+        """
+
+        max_rowid = (
+            conn.execute(
+                "SELECT max(rowid) FROM {tn}".format(tn=self.table_name)
+            ).fetchone()[0]
+            or 0
+        )
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+
+        fd = os.open(self.filter_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            header = os.pread(fd, self.header.size, 0)
+            try:
+                (
+                    magic,
+                    version,
+                    no_hashes,
+                    no_bits,
+                    entries,
+                    covered_rowid,
+                    covered_schema_version,
+                    fingerprint,
+                ) = self.header.unpack(header)
+            except struct.error:
+                valid = False
+            else:
+                # Rowids only decrease, and the row the filter covers up to only
+                # changes, when the database is created again
+                valid = (
+                    magic == self.magic
+                    and version == self.version
+                    and no_hashes == self.no_hashes
+                    and covered_schema_version == schema_version
+                    and os.fstat(fd).st_size == self.header.size + (no_bits + 7) // 8
+                    and covered_rowid <= max_rowid
+                    and fingerprint == self._fingerprint(conn, covered_rowid)
+                )
+
+            if not valid:
+                self._rebuild(fd, conn, max_rowid, schema_version)
+                return
+
+            if covered_rowid == max_rowid:
+                # Another process has already brought the filter up to date
+                return
+
+            self.no_bits = no_bits
+            changes = defaultdict(int)  # type: DefaultDict[int, int]
+            for name, size in conn.execute(
+                "SELECT file_name, size FROM {tn} WHERE rowid>? AND rowid<=?".format(
+                    tn=self.table_name
+                ),
+                (covered_rowid, max_rowid),
+            ):
+                entries += 1
+                for position in self._positions(name, size):
+                    changes[position >> 3] |= 1 << (position & 7)
+
+            if entries > no_bits // self.bits_per_entry:
+                self._rebuild(fd, conn, max_rowid, schema_version)
+                return
+
+            for offset, value in changes.items():
+                offset += self.header.size
+                existing = os.pread(fd, 1, offset)[0]
+                if existing | value != existing:
+                    os.pwrite(fd, bytes((existing | value,)), offset)
+            os.pwrite(
+                fd,
+                self.header.pack(
+                    self.magic,
+                    self.version,
+                    self.no_hashes,
+                    no_bits,
+                    entries,
+                    max_rowid,
+                    schema_version,
+                    self._fingerprint(conn, max_rowid),
+                ),
+                0,
+            )
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        """
+        Bring the persisted filter up to date and then load it into memory
+
+        :param conn: connection to the database of downloaded files
+        """
+
+        self.update(conn)
+        with open(self.filter_file, "rb") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            header = f.read(self.header.size)
+            no_bits = self.header.unpack(header)[3]
+            self.bits = f.read()
+        self.no_bits = no_bits
+        logging.debug(
+            "Loaded filter of previously downloaded files (%s bytes)", len(self.bits)
+        )
+
+
 class DownloadedSQL:
     """
     Previous file download detection.
@@ -730,6 +1067,25 @@ class DownloadedSQL:
         self.table_name = "downloaded"
         self.update_table()
 
+        self.filter_file = os.path.join(data_dir, "downloaded_files.filter")
+        # Loaded only by processes that check many files, like the scanner
+        self.filter = None  # type: Optional[DownloadedFilter]
+
+        # Queries are built once so the connection's statement cache reuses them
+        self.sql_add = """INSERT OR REPLACE INTO {tn} (file_name, size, mtime,
+            download_name, download_datetime) VALUES (?,?,?,?,?)""".format(
+            tn=self.table_name
+        )
+        self.sql_downloaded = """SELECT download_name, download_datetime as [timestamp]
+            FROM {tn} WHERE file_name=? AND size=? AND mtime=?""".format(
+            tn=self.table_name
+        )
+        self.sql_downloaded_range = """SELECT download_name,
+            download_datetime as [timestamp], mtime FROM {tn}
+            WHERE file_name=? AND size=? AND mtime<=? AND mtime >=?""".format(
+            tn=self.table_name
+        )
+
         # Generate values to calculate shifts in time zones /
         self.time_zone_offsets = {}  # type: Dict[int, Tuple[int]]
         for time_zone_offset_resolution in (60, 30, 15):  # minutes
@@ -753,6 +1109,10 @@ class DownloadedSQL:
         # h:mm. Set to actual offset when one is found. Can be negative.
         self.found_offset_hr = ""
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return sqlite_connections.connection(self.db)
+
     def update_table(self, reset: bool = False) -> None:
         """
         Create or update the database table
@@ -760,10 +1120,11 @@ class DownloadedSQL:
          build it
         """
 
-        conn = sqlite3.connect(self.db, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn = self.conn
 
         if reset:
             conn.execute(r"""DROP TABLE IF EXISTS {tn}""".format(tn=self.table_name))
+            conn.commit()
             conn.execute("VACUUM")
 
         conn.execute(
@@ -790,7 +1151,35 @@ class DownloadedSQL:
         )
 
         conn.commit()
-        conn.close()
+
+    def load_filter(self) -> None:
+        """
+        Load the filter of previously downloaded files into memory, so that files
+        that have never been downloaded need not be looked up in the database
+        """
+
+        downloaded_filter = DownloadedFilter(self.filter_file, self.table_name)
+        try:
+            downloaded_filter.load(self.conn)
+        except (OSError, sqlite3.Error, struct.error) as e:
+            logging.warning(
+                "Could not load filter of previously downloaded files: %s", e
+            )
+        else:
+            self.filter = downloaded_filter
+
+    def update_filter(self) -> None:
+        """
+        Bring the persisted filter of previously downloaded files up to date with
+        the database, e.g. after recording downloads
+        """
+
+        try:
+            DownloadedFilter(self.filter_file, self.table_name).update(self.conn)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(
+                "Could not update filter of previously downloaded files: %s", e
+            )
 
     @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
     def add_downloaded_file(
@@ -809,16 +1198,13 @@ class DownloadedSQL:
          or the character . that the user manually marked the file
          as previously downloaded
         """
-        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
+        conn = self.conn
 
         logging.debug("Adding %s to downloaded files", name)
 
         try:
             conn.execute(
-                r"""INSERT OR REPLACE INTO {tn} (file_name, size, mtime,
-                download_name, download_datetime) VALUES (?,?,?,?,?)""".format(
-                    tn=self.table_name
-                ),
+                self.sql_add,
                 (
                     name,
                     size,
@@ -827,17 +1213,15 @@ class DownloadedSQL:
                     datetime.datetime.now(),
                 ),
             )
+            conn.commit()
         except sqlite3.OperationalError as e:
             logging.warning(
                 "Database error adding download file %s: %s. May retry.",
                 download_full_file_name,
                 e,
             )
-            conn.close()
+            sqlite_connections.close(self.db)
             raise sqlite3.OperationalError from e
-        else:
-            conn.commit()
-            conn.close()
 
     def file_downloaded(
         self,
@@ -855,15 +1239,11 @@ class DownloadedSQL:
         :return: download name (including path) and when it was
          downloaded, else None if never downloaded
         """
-        conn = sqlite3.connect(self.db, detect_types=sqlite3.PARSE_DECLTYPES)
-        c = conn.cursor()
-        c.execute(
-            """SELECT download_name, download_datetime as [timestamp] FROM {tn} 
-            WHERE file_name=? AND size=? AND mtime=?""".format(
-                tn=self.table_name
-            ),
-            (name, size, modification_time),
-        )
+        if self.filter is not None and not self.filter.might_contain(name, size):
+            return None
+
+        c = self.conn.cursor()
+        c.execute(self.sql_downloaded, (name, size, modification_time))
         row = c.fetchone()
         if row is not None:
             return FileDownloaded._make(row)
@@ -873,11 +1253,7 @@ class DownloadedSQL:
 
         if self.found_offset:
             c.execute(
-                """SELECT download_name, download_datetime as [timestamp] FROM {tn} 
-                WHERE file_name=? AND size=? AND mtime=?""".format(
-                    tn=self.table_name
-                ),
-                (name, size, modification_time - self.found_offset),
+                self.sql_downloaded, (name, size, modification_time - self.found_offset)
             )
             row = c.fetchone()
             if row is not None:
@@ -893,10 +1269,7 @@ class DownloadedSQL:
         # For why 24 hours, see this map:
         # https://en.wikipedia.org/wiki/Time_zone#/media/File:World_Time_Zones_Map.png
         c.execute(
-            """SELECT download_name, download_datetime as [timestamp], mtime FROM {tn} 
-            WHERE file_name=? AND size=? AND mtime<=? AND mtime >=?""".format(
-                tn=self.table_name
-            ),
+            self.sql_downloaded_range,
             (name, size, modification_time + 86400, modification_time - 86400),
         )
         row = c.fetchone()
@@ -905,14 +1278,132 @@ class DownloadedSQL:
             mtime = row[2]  # type: float
             for offset in self.time_zone_offsets[time_zone_offset_resolution]:
                 if mtime + offset == modification_time:
-                    self.found_offset = offset
-                    m, s = divmod(offset, 60)
-                    h, m = divmod(m, 60)
-                    self.found_offset_hr = f"{h:d}:{m:02d}"
-                    logging.info("Time zone offset is %s", self.found_offset_hr)
-                    return FileDownloaded(download_name=name, download_datetime=row[1])
+                    self._set_found_offset(offset)
+                    return FileDownloaded(
+                        download_name=row[0], download_datetime=row[1]
+                    )
         return None
 
+    def _set_found_offset(self, offset: int) -> None:
+        self.found_offset = offset
+        m, s = divmod(offset, 60)
+        h, m = divmod(m, 60)
+        self.found_offset_hr = f"{h:d}:{m:02d}"
+        logging.info("Time zone offset is %s", self.found_offset_hr)
+
+    def files_downloaded(
+        self,
+        files: Sequence[Tuple[str, int, float]],
+        time_zone_offset_resolution: Optional[int] = None,
+    ) -> List[Optional[FileDownloaded]]:
+        """
+        Batch version of file_downloaded(), for when many files need to be checked
+        at once, e.g. during a scan.
+
+        Rather than one query per file, the files are loaded into a temporary table
+        that is joined against the table of downloaded files. The time zone offset
+        search, if requested, is likewise applied to the whole batch at once.
+
+        :param files: sequence of file name (not including path), file size in bytes,
+         and file modification time
+        :param time_zone_offset_resolution: if not None, the resolution in minutes
+         with which to search for files whose modification time differs only because
+         of a time zone change
+        :return: for each file, in the order passed, the download name (including
+         path) and when it was downloaded, else None if never downloaded
+        """
+
+        results = [None] * len(files)  # type: List[Optional[FileDownloaded]]
+        if self.filter is not None:
+            candidates = [
+                (idx,) + tuple(file)
+                for idx, file in enumerate(files)
+                if self.filter.might_contain(file[0], file[1])
+            ]
+        else:
+            candidates = [(idx,) + tuple(file) for idx, file in enumerate(files)]
+        if not candidates:
+            return results
+
+        conn = self.conn
+        conn.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS scan_batch (
+            idx INTEGER PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+            )"""
+        )
+        try:
+            conn.executemany(
+                "INSERT INTO scan_batch (idx, file_name, size, mtime) VALUES (?,?,?,?)",
+                candidates,
+            )
+
+            join = """SELECT b.idx, d.download_name, d.download_datetime{extra}
+                FROM scan_batch b JOIN {tn} d ON d.file_name=b.file_name AND
+                d.size=b.size AND {mtime_clause}"""
+
+            for idx, download_name, download_datetime in conn.execute(
+                join.format(
+                    extra="", tn=self.table_name, mtime_clause="d.mtime=b.mtime"
+                )
+            ):
+                results[idx] = FileDownloaded(download_name, download_datetime)
+
+            if time_zone_offset_resolution is not None and any(
+                results[candidate[0]] is None for candidate in candidates
+            ):
+                # Only the files not yet matched need to be examined further
+                conn.executemany(
+                    "DELETE FROM scan_batch WHERE idx=?",
+                    (
+                        (idx,)
+                        for idx, result in enumerate(results)
+                        if result is not None
+                    ),
+                )
+
+                if self.found_offset:
+                    for idx, download_name, download_datetime in conn.execute(
+                        join.format(
+                            extra="",
+                            tn=self.table_name,
+                            mtime_clause="d.mtime=b.mtime - ?",
+                        ),
+                        (self.found_offset,),
+                    ):
+                        results[idx] = FileDownloaded(download_name, download_datetime)
+
+                # Files with the same name and size within +- 24 hours. See the
+                # comment in file_downloaded()
+                candidates = conn.execute(
+                    join.format(
+                        extra=", d.mtime",
+                        tn=self.table_name,
+                        mtime_clause="d.mtime<=b.mtime + 86400 AND "
+                        "d.mtime>=b.mtime - 86400",
+                    )
+                ).fetchall()
+                offsets = self.time_zone_offsets[time_zone_offset_resolution]
+                for idx, download_name, download_datetime, mtime in candidates:
+                    if results[idx] is not None:
+                        continue
+                    modification_time = files[idx][2]
+                    for offset in offsets:
+                        if mtime + offset == modification_time:
+                            if offset != self.found_offset:
+                                self._set_found_offset(offset)
+                            results[idx] = FileDownloaded(
+                                download_name, download_datetime
+                            )
+                            break
+        finally:
+            conn.execute("DELETE FROM scan_batch")
+            conn.commit()
+
+        return results
+
 
 class CacheSQL:
     def __init__(
@@ -930,17 +1421,47 @@ class CacheSQL:
         if create_table_if_not_exists:
             self.update_table()
 
+        # Queries are built once so the connection's statement cache reuses them
+        self.sql_add = """INSERT OR REPLACE INTO {tn} (uri, size, mtime, mdatatime,
+            md5_name, orientation_unknown, failure, segment, segment_offset,
+            segment_length, accessed) VALUES (?,?,?,?,?,?,?,?,?,?,?)""".format(
+            tn=self.table_name
+        )
+        self.sql_have = """SELECT md5_name, mdatatime, orientation_unknown, failure,
+            segment, segment_offset, segment_length, accessed
+            FROM {tn} WHERE uri=? AND size=? AND mtime=?""".format(
+            tn=self.table_name
+        )
+
     def db_fs_name(self) -> str:
         return "thumbnail_cache.sqlite"
 
+    def db_fs_names(self) -> Tuple[str, ...]:
+        """
+        :return: names of the database file and the files SQLite keeps alongside it,
+         without path
+        """
+
+        name = self.db_fs_name()
+        return name, name + "-wal", name + "-shm", name + "-journal"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return sqlite_connections.connection(self.db)
+
+    def close(self) -> None:
+        """
+        Close this process's connection to the database, e.g. before deleting it
+        """
+
+        sqlite_connections.close(self.db)
+
     def cache_exists(self) -> bool:
-        conn = sqlite3.connect(self.db)
-        row = conn.execute(
+        row = self.conn.execute(
             """SELECT name FROM sqlite_master WHERE type='table' AND name='{}'""".format(
                 self.table_name
             )
         ).fetchone()
-        conn.close()
         return row is not None
 
     def update_table(self, reset: bool = False) -> None:
@@ -949,10 +1470,11 @@ class CacheSQL:
         :param reset: if True, delete the contents of the table and
          build it
         """
-        conn = sqlite3.connect(self.db, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn = self.conn
 
         if reset:
             conn.execute(r"""DROP TABLE IF EXISTS {tn}""".format(tn=self.table_name))
+            conn.commit()
             conn.execute("VACUUM")
 
         conn.execute(
@@ -964,12 +1486,37 @@ class CacheSQL:
             md5_name TEXT NOT NULL,
             orientation_unknown BOOLEAN NOT NULL,
             failure BOOLEAN NOT NULL,
+            segment TEXT,
+            segment_offset INTEGER,
+            segment_length INTEGER,
+            accessed REAL,
             PRIMARY KEY (uri, mtime, size)
             )""".format(
                 tn=self.table_name
             )
         )
 
+        # Thumbnails cached by earlier versions of the program are each stored in
+        # their own file, and have no segment
+        columns = {
+            row[1]
+            for row in conn.execute(
+                "PRAGMA table_info({tn})".format(tn=self.table_name)
+            )
+        }
+        for column, column_type in (
+            ("segment", "TEXT"),
+            ("segment_offset", "INTEGER"),
+            ("segment_length", "INTEGER"),
+            ("accessed", "REAL"),
+        ):
+            if column not in columns:
+                conn.execute(
+                    "ALTER TABLE {tn} ADD COLUMN {column} {column_type}".format(
+                        tn=self.table_name, column=column, column_type=column_type
+                    )
+                )
+
         conn.execute(
             """CREATE INDEX IF NOT EXISTS md5_name_idx ON
         {tn} (md5_name)""".format(
@@ -977,8 +1524,14 @@ class CacheSQL:
             )
         )
 
+        conn.execute(
+            """CREATE INDEX IF NOT EXISTS segment_idx ON
+        {tn} (segment)""".format(
+                tn=self.table_name
+            )
+        )
+
         conn.commit()
-        conn.close()
 
     @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
     def add_thumbnail(
@@ -990,6 +1543,9 @@ class CacheSQL:
         md5_name: str,
         orientation_unknown: bool,
         failure: bool,
+        segment: Optional[str] = None,
+        segment_offset: Optional[int] = None,
+        segment_length: Optional[int] = None,
     ) -> None:
         """
         Add file to database of downloaded files
@@ -1002,27 +1558,37 @@ class CacheSQL:
          file could not be determined, else False
         :param failure: if True, indicates the thumbnail could not be
          generated, otherwise False
+        :param segment: name of the segment file the thumbnail is stored in
+        :param segment_offset: where in the segment file the thumbnail starts
+        :param segment_length: size of the thumbnail in bytes
         """
 
-        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
+        conn = self.conn
 
         try:
             conn.execute(
-                r"""INSERT OR REPLACE INTO {tn} (uri, size, mtime, mdatatime,
-                md5_name, orientation_unknown, failure) VALUES (?,?,?,?,?,?,?)""".format(
-                    tn=self.table_name
+                self.sql_add,
+                (
+                    uri,
+                    size,
+                    mtime,
+                    mdatatime,
+                    md5_name,
+                    orientation_unknown,
+                    failure,
+                    segment,
+                    segment_offset,
+                    segment_length,
+                    time.time(),
                 ),
-                (uri, size, mtime, mdatatime, md5_name, orientation_unknown, failure),
             )
+            conn.commit()
         except sqlite3.OperationalError as e:
             logging.warning(
                 "Database error adding thumbnail for %s: %s. May retry.", uri, e
             )
-            conn.close()
+            self.close()
             raise sqlite3.OperationalError from e
-        else:
-            conn.commit()
-            conn.close()
 
     @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
     def have_thumbnail(self, uri: str, size: int, mtime: float) -> Optional[InCache]:
@@ -1037,23 +1603,15 @@ class CacheSQL:
          present
         """
 
-        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
-
         try:
-            c = conn.cursor()
-            c.execute(
-                """SELECT md5_name, mdatatime, orientation_unknown, failure FROM {tn} WHERE
-                uri=? AND size=? AND mtime=?""".format(
-                    tn=self.table_name
-                ),
-                (uri, size, mtime),
-            )
+            c = self.conn.cursor()
+            c.execute(self.sql_have, (uri, size, mtime))
             row = c.fetchone()
         except sqlite3.OperationalError as e:
             logging.warning(
                 "Database error reading thumbnail for %s: %s. May retry.", uri, e
             )
-            conn.close()
+            self.close()
             raise sqlite3.OperationalError from e
 
         if row is not None:
@@ -1061,6 +1619,60 @@ class CacheSQL:
         else:
             return None
 
+    @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
+    def have_thumbnails(
+        self, files: Sequence[Tuple[str, int, float]]
+    ) -> List[Optional[InCache]]:
+        """
+        Batch version of have_thumbnail(), for when the thumbnails of many files
+        are needed at once.
+
+        The files are loaded into a temporary table that is joined against the
+        cache table, so only one query is needed.
+
+        :param files: sequence of uri, file size in bytes and file modification time
+        :return: for each file, in the order passed, what have_thumbnail() would
+         return
+        """
+
+        results = [None] * len(files)  # type: List[Optional[InCache]]
+        if not files:
+            return results
+
+        conn = self.conn
+        try:
+            conn.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS lookup_batch (
+                idx INTEGER PRIMARY KEY,
+                uri TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL
+                )"""
+            )
+            conn.executemany(
+                "INSERT INTO lookup_batch (idx, uri, size, mtime) VALUES (?,?,?,?)",
+                ((idx,) + tuple(file) for idx, file in enumerate(files)),
+            )
+            for row in conn.execute(
+                """SELECT b.idx, c.md5_name, c.mdatatime, c.orientation_unknown,
+                c.failure, c.segment, c.segment_offset, c.segment_length, c.accessed
+                FROM lookup_batch b JOIN {tn} c ON c.uri=b.uri AND c.size=b.size AND
+                c.mtime=b.mtime""".format(
+                    tn=self.table_name
+                )
+            ):
+                results[row[0]] = InCache._make(row[1:])
+            conn.execute("DELETE FROM lookup_batch")
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.warning(
+                "Database error reading %s thumbnails: %s. May retry.", len(files), e
+            )
+            self.close()
+            raise sqlite3.OperationalError from e
+
+        return results
+
     @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
     def _delete(self, names: List[str], conn):
         conn.execute(
@@ -1079,7 +1691,7 @@ class CacheSQL:
         if len(md5_names) == 0:
             return
 
-        conn = sqlite3.connect(self.db)
+        conn = self.conn
         # Limit to number of parameters: 900
         # See https://www.sqlite.org/limits.html
         try:
@@ -1093,32 +1705,144 @@ class CacheSQL:
             logging.error(
                 "Database error while deleting %s thumbnails: %s", len(md5_names), e
             )
+            conn.rollback()
         else:
             conn.commit()
-        conn.close()
 
     def no_thumbnails(self) -> int:
         """
         :return: how many thumbnails are in the db
         """
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
+        c = self.conn.cursor()
         c.execute("SELECT COUNT(*) FROM {tn}".format(tn=self.table_name))
         count = c.fetchall()
         return count[0][0]
 
     def md5_names(self) -> List[Tuple[str]]:
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
+        c = self.conn.cursor()
         c.execute("SELECT md5_name FROM {tn}".format(tn=self.table_name))
         rows = c.fetchall()
         return rows
 
+    def unpacked_thumbnails(self) -> List[Tuple[int, str]]:
+        """
+        :return: rowid and md5 name of the thumbnails that are stored in their own
+         file
+        """
+
+        return self.conn.execute(
+            """SELECT rowid, md5_name FROM {tn} WHERE segment IS NULL
+            AND NOT failure""".format(
+                tn=self.table_name
+            )
+        ).fetchall()
+
+    def mark_accessed(self, md5_name: str) -> None:
+        """
+        Record that a thumbnail was read from the cache
+        """
+
+        self.mark_all_accessed([md5_name])
+
+    def mark_all_accessed(self, md5_names: Sequence[str]) -> None:
+        """
+        Record that thumbnails were read from the cache
+        """
+
+        if not md5_names:
+            return
+
+        conn = self.conn
+        accessed = time.time()
+        try:
+            conn.executemany(
+                "UPDATE {tn} SET accessed=? WHERE md5_name=?".format(
+                    tn=self.table_name
+                ),
+                ((accessed, md5_name) for md5_name in md5_names),
+            )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # Not important enough to retry
+            logging.debug("Database error recording thumbnail access: %s", e)
+            conn.rollback()
+
+    def delete_packed_thumbnails_accessed_before(self, accessed: float) -> int:
+        """
+        Delete thumbnails stored in segments that have not been read or written
+        since the time specified
+
+        :param accessed: time in seconds since the epoch
+        :return: how many thumbnails were deleted
+        """
+
+        conn = self.conn
+        cursor = conn.execute(
+            """DELETE FROM {tn} WHERE segment IS NOT NULL AND
+            (accessed IS NULL OR accessed < ?)""".format(
+                tn=self.table_name
+            ),
+            (accessed,),
+        )
+        conn.commit()
+        return cursor.rowcount
+
+    def segment_usage(self) -> Dict[str, int]:
+        """
+        :return: for each segment containing thumbnails, how many bytes of
+         it are used by thumbnails in the database
+        """
+
+        rows = self.conn.execute(
+            """SELECT segment, SUM(segment_length) FROM {tn} WHERE segment IS NOT NULL
+            GROUP BY segment""".format(
+                tn=self.table_name
+            )
+        ).fetchall()
+        return dict(rows)
+
+    def segment_thumbnails(self, segment: str) -> List[Tuple[int, int, int]]:
+        """
+        :param segment: name of the segment
+        :return: rowid, offset and length of each thumbnail in the segment, sorted
+         by offset
+        """
+
+        return self.conn.execute(
+            """SELECT rowid, segment_offset, segment_length FROM {tn}
+            WHERE segment=? ORDER BY segment_offset""".format(
+                tn=self.table_name
+            ),
+            (segment,),
+        ).fetchall()
+
+    def move_thumbnails(self, thumbnails: Sequence[Tuple[str, int, int, int]]) -> None:
+        """
+        Record a new location for thumbnails
+
+        :param thumbnails: segment, offset and length of the new location, and
+         the rowid of each thumbnail. The md5 name cannot be used, because it is
+         shared by every version of the same file.
+        """
+
+        conn = self.conn
+        conn.executemany(
+            """UPDATE {tn} SET segment=?, segment_offset=?, segment_length=?
+            WHERE rowid=?""".format(
+                tn=self.table_name
+            ),
+            thumbnails,
+        )
+        conn.commit()
+
     def vacuum(self) -> None:
-        conn = sqlite3.connect(self.db)
+        conn = self.conn
+        conn.commit()
         conn.execute("VACUUM")
-        conn.close()
+        # Fold the write ahead log back into the database so its size on disk is
+        # accurate
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
 
 class FileFormatSQL:
@@ -1252,6 +1976,95 @@ class FileFormatSQL:
         return None
 
 
+class PreviewOffsetSQL:
+    """
+    Index of how much of the start of a photo must be read to get both its metadata
+    and its embedded preview, learned per camera model and file extension as
+    thumbnails are generated.
+    """
+
+    def __init__(self, data_dir: str = None) -> None:
+        """
+        :param data_dir: where the database is saved. If None, use
+         default
+        """
+        if data_dir is None:
+            data_dir = get_program_data_directory(create_if_not_exist=True)
+
+        self.db = os.path.join(data_dir, "preview_offsets.sqlite")
+        self.table_name = "offsets"
+        self.update_table()
+
+    def update_table(self, reset: bool = False) -> None:
+        """
+        Create or update the database table
+        :param reset: if True, delete the contents of the table and
+         build it
+        """
+
+        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
+
+        if reset:
+            conn.execute(r"""DROP TABLE IF EXISTS {tn}""".format(tn=self.table_name))
+            conn.execute("VACUUM")
+
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS {tn} (
+            camera TEXT NOT NULL,
+            extension TEXT NOT NULL,
+            bytes_needed INTEGER NOT NULL,
+            PRIMARY KEY (camera, extension)
+            )""".format(
+                tn=self.table_name
+            )
+        )
+
+        conn.commit()
+        conn.close()
+
+    @retry(stop=stop_after_attempt(sqlite3_retry_attempts))
+    def add_offset(self, camera: str, extension: str, offset: int) -> None:
+        """
+        Record the offset, keeping the largest seen for the camera and extension
+
+        :param camera: camera model, or an empty string if unknown
+        :param extension: file extension, in lower case
+        :param offset: how many bytes from the start of the file must be read
+        """
+
+        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
+        with conn:
+            conn.execute(
+                """INSERT OR IGNORE INTO {tn} (camera, extension, bytes_needed)
+                VALUES (?, ?, ?)""".format(
+                    tn=self.table_name
+                ),
+                (camera, extension, offset),
+            )
+            conn.execute(
+                """UPDATE {tn} SET bytes_needed=max(bytes_needed, ?)
+                WHERE camera=? AND extension=?""".format(
+                    tn=self.table_name
+                ),
+                (offset, camera, extension),
+            )
+        conn.close()
+
+    def get_offsets(self) -> Dict[Tuple[str, str], int]:
+        """
+        :return: offsets indexed by camera model and extension
+        """
+
+        conn = sqlite3.connect(self.db, timeout=sqlite3_timeout)
+        rows = conn.execute(
+            "SELECT camera, extension, bytes_needed FROM {tn}".format(
+                tn=self.table_name
+            )
+        ).fetchall()
+        conn.close()
+        return {(camera, extension): offset for camera, extension, offset in rows}
+
+
 if __name__ == "__main__":
     import uuid
 
@@ -46,12 +46,15 @@ __author__ = "Damon Lynch"
 __copyright__ = "Copyright 2011-2022, Damon Lynch"
 
 import os
+import stat as statmodule
 import sys
 import pickle
 import logging
 from collections import namedtuple, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import tempfile
+import time
 import operator
 import locale
 
@@ -61,7 +64,17 @@ try:
 except locale.Error:
     pass
 
-from typing import List, Dict, Union, Optional, Iterator, Tuple, DefaultDict
+from typing import (
+    List,
+    Dict,
+    Union,
+    Optional,
+    Iterator,
+    Tuple,
+    DefaultDict,
+    Deque,
+    Callable,
+)
 
 from PyQt5.QtCore import QStorageInfo
 
@@ -86,6 +99,7 @@ from raphodo.constants import (
     all_tags_offset_exiftool,
 )
 from raphodo.rpdsql import DownloadedSQL
+from raphodo.scanmanifest import ScanManifest, ManifestEntry, scan_manifest_key
 from raphodo.cache import ThumbnailCacheSql
 from raphodo.utilities import (
     stdchannel_redirected,
@@ -133,14 +147,408 @@ CameraMetadataDetails = namedtuple(
 )
 SampleMetadata = namedtuple("SampleMetadata", "datetime determined_by")
 
+# Extensions of files that can be associated with a photo or video, in lower case
+ASSOCIATE_FILE_EXTENSIONS = frozenset(
+    fileformats.AUDIO_EXTENSIONS
+    + fileformats.VIDEO_THUMBNAIL_EXTENSIONS
+    + ["xmp", "log"]
+)
+
+
+class AssociateFileIndex:
+    """
+    Index of files that may be associated with a photo or video, like THM, XMP,
+    LOG and audio files, built from directory listings that have already been
+    made.
+
+    Locating an associate file is then a dictionary lookup rather than a series of
+    file system or camera queries.
+
+    Files are indexed by their base name and lower case extension. Extensions
+    are matched without regard to case, preferring an exact match, then upper
+    case.
+    """
+
+    def __init__(self) -> None:
+        # base name: lower case extension: list of path and actual extension
+        self._index = defaultdict(
+            lambda: defaultdict(list)
+        )  # type: DefaultDict[str, DefaultDict[str, List[Tuple[str, str]]]]
+
+    @classmethod
+    def from_directory_listing(
+        cls, path: str, names: List[str]
+    ) -> "AssociateFileIndex":
+        """
+        :param path: the directory the files are in
+        :param names: the names of the files in the directory
+        :return: index of associate files in the directory
+        """
+
+        index = cls()
+        for name in names:
+            base_name, ext = os.path.splitext(name)
+            ext = ext[1:]
+            if ext.lower() in ASSOCIATE_FILE_EXTENSIONS:
+                index.add(path, base_name, ext)
+        return index
+
+    def add(self, path: str, base_name: str, ext: str) -> None:
+        """
+        :param path: the directory the file is in
+        :param base_name: file name without its extension
+        :param ext: the file's extension, without leading period
+        """
+
+        self._index[base_name][ext.lower()].append((path, ext))
+
+    def find(
+        self,
+        base_name: str,
+        extensions_to_check: List[str],
+        paths: Optional[List[str]] = None,
+    ) -> Optional[str]:
+        """
+        :param base_name: base name of file, without directory
+        :param extensions_to_check: list of extensions in lower case without leading
+         period, in order of preference
+        :param paths: if specified, the directories the associate file must be in
+        :return: full file path if found, else None
+        """
+
+        by_extension = self._index.get(base_name)
+        if not by_extension:
+            return None
+        for e in extensions_to_check:
+            candidates = by_extension.get(e)
+            if not candidates:
+                continue
+            upper = e.upper()
+            for path, ext in sorted(
+                candidates,
+                key=lambda candidate: (candidate[1] != e, candidate[1] != upper),
+            ):
+                if paths is None or path in paths:
+                    return "{}.{}".format(os.path.join(path, base_name), ext)
+        return None
+
+
+# A directory and the files in it, with the result of calling stat on each file,
+# or None if that failed
+ScannedDirectory = namedtuple("ScannedDirectory", "path files")
+
+# File systems on which each directory listing or stat can take a long time, and
+# which therefore benefit from being listed in parallel
+high_latency_file_systems = frozenset(
+    (
+        "nfs",
+        "nfs4",
+        "cifs",
+        "smb3",
+        "smbfs",
+        "sshfs",
+        "davfs",
+        "9p",
+    )
+)
+high_latency_listing_threads = 8
+
+# File systems whose modification times are too coarse, or whose directory
+# modification times are too unreliably updated by cameras, to show whether a
+# directory has changed since the last scan
+coarse_mtime_file_systems = frozenset(
+    ("vfat", "msdos", "fat", "exfat", "fuseblk", "ntfs", "ntfs3")
+)
+
+euid = os.geteuid()
+groups = frozenset(os.getgroups()) | {os.getegid()}
+
+
+def high_latency_file_system(path: str) -> bool:
+    """
+    :param path: path on the file system
+    :return: True if the path is on a network or FUSE file system
+    """
+
+    fstype = file_system_type(path)
+    return fstype in high_latency_file_systems or fstype.startswith("fuse")
+
+
+def file_system_type(path: str) -> str:
+    """
+    :param path: path on the file system
+    :return: the type of the file system, e.g. "ext4" or "vfat"
+    """
+
+    # fileSystemType() returns a QByteArray
+    return bytes(QStorageInfo(path).fileSystemType()).decode()
+
+
+def readable(full_file_name: str, stat: Optional[os.stat_result]) -> bool:
+    """
+    Determine if the file can be read, using the result of a previous call to stat
+    where possible.
+
+    The permission bits are checked first. Only if they deny access is os.access
+    called, in case access is granted some other way, e.g. by an ACL.
+
+    :param full_file_name: path and name of the file
+    :param stat: result of calling stat on the file, or None if that failed
+    :return: True if the file can be read, else False
+    """
+
+    if stat is None:
+        return False
+    if euid == 0:
+        return True
+    if stat.st_uid == euid:
+        mode = stat.st_mode & statmodule.S_IRUSR
+    elif stat.st_gid in groups:
+        mode = stat.st_mode & statmodule.S_IRGRP
+    else:
+        mode = stat.st_mode & statmodule.S_IROTH
+    return bool(mode) or os.access(full_file_name, os.R_OK)
+
+
+def list_directory(
+    path: str,
+    manifest: Optional[ScanManifest] = None,
+) -> Tuple[List[Tuple[os.DirEntry, Optional[os.stat_result]]], List[str]]:
+    """
+    List a directory using os.scandir, calling stat on each file.
+
+    Like os.walk, errors listing the directory are ignored, and symbolic links to
+    directories are reported as directories.
+
+    :param path: directory to list
+    :param manifest: if specified, the directory is replayed from the previous
+     scan when it is unchanged, and what was found is recorded
+    :return: files with their stat results (None if stat failed), and the names
+     of subdirectories that are not symbolic links. Files replayed from the
+     manifest have a ManifestEntry in place of their os.DirEntry.
+    """
+
+    files = []
+    dirs = []
+    mtime = None
+    if manifest is not None:
+        # Get the modification time before listing the directory, so that any
+        # change made while it is being listed is detected in the next scan
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+        else:
+            directory = manifest.previous_directory(path, mtime)
+            if directory is not None:
+                # Replay the unchanged directory as it was found in the last scan
+                return (
+                    [
+                        (ManifestEntry(name, os.path.join(path, name)), stat)
+                        for name, stat in directory.files.items()
+                    ],
+                    list(directory.dirs),
+                )
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return files, dirs
+
+    file_entries = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = False
+            if not is_symlink:
+                dirs.append(entry.name)
+        else:
+            file_entries.append(entry)
+
+    for entry in file_entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            stat = None
+        files.append((entry, stat))
+
+    if mtime is not None and all(stat is not None for entry, stat in files):
+        manifest.record_directory(
+            path, mtime, [(entry.name, stat) for entry, stat in files], dirs
+        )
+    return files, dirs
+
+
+def walk_file_system(
+    path: str,
+    filter_dirs: Callable[[str, List[str]], List[str]],
+    threads: int = 1,
+    manifest: Optional[ScanManifest] = None,
+) -> Iterator[ScannedDirectory]:
+    """
+    Walk the file system top down, in the same order as os.walk, calling stat on
+    each file exactly once.
+
+    When threads is greater than one, the subdirectories of each directory are
+    listed in a thread pool while the caller is processing the directories that
+    come before them, which hides the latency of network and FUSE file systems.
+
+    :param path: directory to walk
+    :param filter_dirs: function taking the directory path and the names of its
+     subdirectories, and returning the subdirectories to walk
+    :param threads: how many directories to list at once
+    :param manifest: manifest from the previous scan of the device, if any
+    """
+
+    if threads <= 1:
+        stack = [path]
+        while stack:
+            dir_name = stack.pop()
+            files, dirs = list_directory(dir_name, manifest)
+            yield ScannedDirectory(dir_name, files)
+            stack.extend(
+                os.path.join(dir_name, d) for d in reversed(filter_dirs(dir_name, dirs))
+            )
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        stack = [(path, executor.submit(list_directory, path, manifest))]
+        try:
+            while stack:
+                dir_name, future = stack.pop()
+                files, dirs = future.result()
+                yield ScannedDirectory(dir_name, files)
+                subdirs = [
+                    os.path.join(dir_name, d) for d in filter_dirs(dir_name, dirs)
+                ]
+                stack.extend(
+                    (subdir, executor.submit(list_directory, subdir, manifest))
+                    for subdir in reversed(subdirs)
+                )
+        finally:
+            for dir_name, future in stack:
+                future.cancel()
+
+
+class BufferedWalk:
+    """
+    File system walk that is read twice but listed once.
+
+    The first pass, sample(), is used to determine the device's approach to time
+    zones and typically stops early. The directories it read are kept and replayed
+    by the second pass, scan(), which then continues the walk where the first pass
+    left off.
+    """
+
+    def __init__(self, walk: Iterator[ScannedDirectory]) -> None:
+        self.walk = walk
+        self.buffer = deque()  # type: Deque[ScannedDirectory]
+
+    def sample(self) -> Iterator[ScannedDirectory]:
+        yield from self.buffer
+        for directory in self.walk:
+            self.buffer.append(directory)
+            yield directory
+
+    def scan(self) -> Iterator[ScannedDirectory]:
+        while self.buffer:
+            yield self.buffer.popleft()
+        yield from self.walk
+
+
+class AdaptiveBatchSize:
+    """
+    Determine when to send the files scanned so far to the sink.
+
+    Every batch costs the main window a model update, so batches should be large.
+    But the user should see the first files quickly, and the main window should
+    not be flooded when it is busy. Batches therefore start small, and are sent at
+    an interval that grows towards a steady value, or beyond it when the sink is
+    not keeping up. The batch size is the number of files expected to be scanned in
+    that interval, at the rate files are currently being scanned.
+
+    The sink not keeping up is detected by sending blocking: the socket to the sink
+    only queues a few messages before it blocks.
+    """
+
+    minimum_size = 10
+    maximum_size = 1000
+    initial_interval = 0.05
+    steady_interval = 0.5
+    maximum_interval = 4.0
+    # Sending blocking for longer than this fraction of the time taken to scan the
+    # batch means the sink is not keeping up
+    blocked_fraction = 0.1
+
+    def __init__(self) -> None:
+        self.size = self.minimum_size
+        self.interval = self.initial_interval
+        self.files_per_second = 0.0
+        self.batch_started = time.monotonic()
+
+    def due(self, no_files: int) -> bool:
+        """
+        Called only after a file has been processed, so while no files are
+        arriving, e.g. from a slow device, a partial batch is not sent.
+
+        :param no_files: number of files in the batch
+        :return: True if the batch should be sent now
+        """
+
+        return no_files >= self.size or (
+            no_files > 0 and time.monotonic() - self.batch_started >= self.interval
+        )
+
+    def sent(self, no_files: int, send_time: float) -> None:
+        """
+        Adjust the batch size after a batch has been sent
+
+        :param no_files: number of files in the batch
+        :param send_time: seconds it took to send the batch to the sink
+        """
+
+        now = time.monotonic()
+        scan_time = max(now - self.batch_started - send_time, 0.001)
+        self.batch_started = now
+
+        files_per_second = no_files / scan_time
+        if self.files_per_second:
+            self.files_per_second = (self.files_per_second + files_per_second) / 2
+        else:
+            self.files_per_second = files_per_second
+
+        if send_time > scan_time * self.blocked_fraction:
+            self.interval = min(self.interval * 2, self.maximum_interval)
+        elif self.interval < self.steady_interval:
+            self.interval = min(self.interval * 1.5, self.steady_interval)
+        else:
+            self.interval = max(self.interval * 0.75, self.steady_interval)
+
+        self.size = min(
+            max(int(self.files_per_second * self.interval), self.minimum_size),
+            self.maximum_size,
+        )
+
 
 class ScanWorker(WorkerInPublishPullPipeline):
     def __init__(self):
         self.downloaded = DownloadedSQL()
+        self.downloaded.load_filter()
+        self.associate_files = AssociateFileIndex()
+        # Result of calling stat on the file system file being processed
+        self.file_stat = None  # type: Optional[os.stat_result]
+        # What was found the last time the device was scanned
+        self.scan_manifest = None  # type: Optional[ScanManifest]
         self.thumbnail_cache = ThumbnailCacheSql(create_table_if_not_exists=False)
         self.no_previously_downloaded = 0
         self.file_batch = []
-        self.batch_size = 50
+        self.batch_sizer = AdaptiveBatchSize()
         self.file_type_counter = rpdfile.FileTypeCounter()
         self.file_size_sum = rpdfile.FileSizeSum()
         self.device_timestamp_type = DeviceTimestampTZ.undetermined
@@ -380,19 +788,9 @@ class ScanWorker(WorkerInPublishPullPipeline):
         if not terminated:
             if self.file_batch:
                 # Send any remaining files, including the sample photo or video
-                self.content = pickle.dumps(
-                    ScanResults(
-                        self.file_batch,
-                        self.file_type_counter,
-                        self.file_size_sum,
-                        sample_photo=self.sample_photo,
-                        sample_video=self.sample_video,
-                        entire_video_required=self.entire_video_required,
-                        entire_photo_required=self.entire_photo_required,
-                    ),
-                    pickle.HIGHEST_PROTOCOL,
-                )
-                self.send_message_to_sink()
+                self.send_file_batch()
+            if self.scan_manifest is not None:
+                self.scan_manifest.save()
         elif self.download_from_camera or self.download_from_camera_fuse:
             self.content = pickle.dumps(
                 ScanResults(scan_id=int(self.worker_id), camera_removed=True),
@@ -423,28 +821,44 @@ class ScanWorker(WorkerInPublishPullPipeline):
             )
             self.send_message_to_sink()
 
-    def walk_file_system(self, path_to_walk: str) -> Iterator[Tuple[str, str]]:
+    def filter_dirs(self, dir_name: str, dir_list: List[str]) -> List[str]:
         """
-        Return files on local file system, ignoring those in directories
-        the user doesn't want scanned
-        :param path_to_walk: the path to scan
+        Remove directories the user doesn't want scanned
+
+        :param dir_name: the directory containing the subdirectories
+        :param dir_list: names of the subdirectories
+        :return: names of the subdirectories to scan
         """
 
-        for dir_name, dir_list, file_list in os.walk(path_to_walk):
-            if len(dir_list) > 0:
-                # Do not scan gvfs gphoto2 mount
-                dir_list[:] = (
-                    d for d in dir_list if not gvfs_gphoto2_path(dir_name + d)
-                )
+        if dir_list:
+            # Do not scan gvfs gphoto2 mount
+            dir_list = [d for d in dir_list if not gvfs_gphoto2_path(dir_name + d)]
+
+            if self.scan_preferences.ignored_paths:
+                # Don't inspect paths the user wants ignored
+                dir_list = list(filter(self.scan_preferences.scan_this_path, dir_list))
+        return dir_list
 
-                if self.scan_preferences.ignored_paths:
-                    # Don't inspect paths the user wants ignored
-                    # Altering subdirs in place controls the looping
-                    # [:] ensures the list is altered in place
-                    # (mutating slice method)
-                    dir_list[:] = filter(self.scan_preferences.scan_this_path, dir_list)
-            for name in file_list:
-                yield dir_name, name
+    def walk_file_system(self, path_to_walk: str) -> Iterator[ScannedDirectory]:
+        """
+        Return directories and the files in them on local file system, ignoring
+        directories the user doesn't want scanned
+        :param path_to_walk: the path to scan
+        """
+
+        if self.download_from_camera_fuse or high_latency_file_system(path_to_walk):
+            threads = high_latency_listing_threads
+            logging.debug(
+                "Listing directories on %s using %s threads", self.display_name, threads
+            )
+        else:
+            threads = 1
+        return walk_file_system(
+            path=path_to_walk,
+            filter_dirs=self.filter_dirs,
+            threads=threads,
+            manifest=self.scan_manifest,
+        )
 
     def scan_file_system(self, scan_arguments: ScanArguments):
         """
@@ -489,21 +903,41 @@ class ScanWorker(WorkerInPublishPullPipeline):
         self.problems.uri = get_uri(path=path)
         self.problems.name = self.display_name
 
+        key = scan_manifest_key(scan_arguments.device)
+        if key is not None:
+            # Files on This Computer may be edited in place, which does not change
+            # the modification time of the directory they are in
+            self.scan_manifest = ScanManifest(
+                key=key,
+                root=path,
+                reuse_stats=scan_arguments.device.device_type != DeviceType.path
+                and file_system_type(path) not in coarse_mtime_file_systems,
+            )
+            self.scan_manifest.load()
+
+        # The file system is walked only once. What is read while determining the
+        # time zone approach is replayed during the scan proper.
+        walks = [BufferedWalk(self.walk_file_system(path)) for path in paths]
+
         # Before doing anything else, determine time zone approach
-        # Need two different walks because first folder of files
+        # Need two different passes because first folder of files
         # might be videos, then the 2nd folder photos, etc.
-        for path in paths:
-            self.distinguish_non_camera_device_timestamp(path)
+        for walk in walks:
+            self.distinguish_non_camera_device_timestamp(walk.sample())
             if self.device_timestamp_type != DeviceTimestampTZ.undetermined:
                 break
 
-        for path in paths:
+        for path, walk in zip(paths, walks):
             if scanning_specific_path:
                 logging.info("Scanning {} on {}".format(path, self.display_name))
-            for dir_name, name in self.walk_file_system(path):
-                self.dir_name = dir_name
-                self.file_name = name
-                self.process_file()
+            for directory in walk.scan():
+                self.dir_name = directory.path
+                self.associate_files = AssociateFileIndex.from_directory_listing(
+                    directory.path, [entry.name for entry, stat in directory.files]
+                )
+                for entry, self.file_stat in directory.files:
+                    self.file_name = entry.name
+                    self.process_file()
 
     def scan_camera(self, scan_arguments: ScanArguments) -> None:
         """
@@ -575,10 +1009,7 @@ class ScanWorker(WorkerInPublishPullPipeline):
             logging.info("Scanning {}".format(self.display_name))
             self._camera_folders_and_files = []
             self._camera_file_names = defaultdict(list)
-            self._camera_audio_files = defaultdict(list)
-            self._camera_video_thumbnails = defaultdict(list)
-            self._camera_xmp_files = defaultdict(list)
-            self._camera_log_files = defaultdict(list)
+            self.associate_files = AssociateFileIndex()
             self._folder_identifiers = {}
             self._folder_identifers_for_file = defaultdict(
                 list
@@ -809,14 +1240,8 @@ class ScanWorker(WorkerInPublishPullPipeline):
                         )
             else:
                 # this file on the camera is not a photo or video
-                if ext_lower in fileformats.AUDIO_EXTENSIONS:
-                    self._camera_audio_files[base_name].append((path, ext))
-                elif ext_lower in fileformats.VIDEO_THUMBNAIL_EXTENSIONS:
-                    self._camera_video_thumbnails[base_name].append((path, ext))
-                elif ext_lower == "xmp":
-                    self._camera_xmp_files[base_name].append((path, ext))
-                elif ext_lower == "log":
-                    self._camera_log_files[base_name].append((path, ext))
+                if ext_lower in ASSOCIATE_FILE_EXTENSIONS:
+                    self.associate_files.add(path, base_name, ext)
                 else:
                     logging.info(
                         "Ignoring unknown file %s on %s",
@@ -951,7 +1376,7 @@ class ScanWorker(WorkerInPublishPullPipeline):
         file = os.path.join(self.dir_name, self.file_name)
 
         # do we have permission to read the file?
-        if self.download_from_camera or os.access(file, os.R_OK):
+        if self.download_from_camera or readable(file, self.file_stat):
 
             # count how many files of each type are included
             # i.e. how many photos and videos
@@ -1005,7 +1430,7 @@ class ScanWorker(WorkerInPublishPullPipeline):
                     size = file_info.size
                     camera_file = CameraFile(name=self.file_name, size=size)
                 else:
-                    stat = os.stat(file)
+                    stat = self.file_stat
                     size = stat.st_size
                     if size <= 0:
                         logging.error(
@@ -1038,17 +1463,11 @@ class ScanWorker(WorkerInPublishPullPipeline):
                 # check if an audio file is associated with the photo or video
                 audio_file_full_name = self.get_audio_file(base_name, camera_file)
 
-                # has the file been downloaded previously?
-                # note: we should use the adjusted mtime, not the raw one
+                # Whether the file has been downloaded previously is determined
+                # for the entire batch of files at once, just before it is sent.
+                # Note: it uses the adjusted mtime, not the raw one
                 adjusted_mtime = self.adjusted_mtime(modification_time)
 
-                downloaded = self.downloaded.file_downloaded(
-                    name=self.file_name,
-                    size=size,
-                    modification_time=adjusted_mtime,
-                    time_zone_offset_resolution=self.time_zone_offset_resolution,
-                )
-
                 thumbnail_cache_status = ThumbnailCacheDiskStatus.unknown
 
                 # Assign metadata time, if we have it
@@ -1057,6 +1476,20 @@ class ScanWorker(WorkerInPublishPullPipeline):
 
                 ignore_mdatatime = self.ignore_mdatatime(ext=ext)
 
+                if (
+                    not mdatatime
+                    and self.scan_manifest is not None
+                    and not ignore_mdatatime
+                ):
+                    # Was the metadata time found when the unchanged file was last
+                    # scanned?
+                    previous_file = self.scan_manifest.previous_file(
+                        full_file_name=file, size=size, mtime=modification_time
+                    )
+                    if previous_file is not None:
+                        mdatatime = previous_file.mdatatime
+                        thumbnail_cache_status = previous_file.thumbnail_cache_status
+
                 if (
                     not mdatatime
                     and self.prefs.use_thumbnail_cache
@@ -1064,11 +1497,12 @@ class ScanWorker(WorkerInPublishPullPipeline):
                 ):
                     # Was there a thumbnail generated for the file?
                     # If so, get the metadata date time from that
-                    get_thumbnail = self.thumbnail_cache.get_thumbnail_path(
+                    get_thumbnail = self.thumbnail_cache.get_thumbnail(
                         full_file_name=file,
                         mtime=adjusted_mtime,
                         size=size,
                         camera_model=self.camera_model,
+                        read_thumbnail=False,
                     )
                     thumbnail_cache_status = get_thumbnail.disk_status
                     if thumbnail_cache_status in (
@@ -1077,12 +1511,14 @@ class ScanWorker(WorkerInPublishPullPipeline):
                     ):
                         mdatatime = get_thumbnail.mdatatime
 
-                if downloaded is not None:
-                    self.no_previously_downloaded += 1
-                    prev_full_name = downloaded.download_name
-                    prev_datetime = downloaded.download_datetime
-                else:
-                    prev_full_name = prev_datetime = None
+                if mdatatime and self.scan_manifest is not None:
+                    self.scan_manifest.record_file(
+                        full_file_name=file,
+                        size=size,
+                        mtime=modification_time,
+                        mdatatime=mdatatime,
+                        thumbnail_cache_status=thumbnail_cache_status,
+                    )
 
                 if self.download_from_camera:
                     camera_memory_card_identifiers = self._folder_identifers_for_file[
@@ -1099,8 +1535,8 @@ class ScanWorker(WorkerInPublishPullPipeline):
                     name=self.file_name,
                     path=self.dir_name,
                     size=size,
-                    prev_full_name=prev_full_name,
-                    prev_datetime=prev_datetime,
+                    prev_full_name=None,
+                    prev_datetime=None,
                     device_timestamp_type=self.device_timestamp_type,
                     mtime=modification_time,
                     mdatatime=mdatatime,
@@ -1167,23 +1603,55 @@ class ScanWorker(WorkerInPublishPullPipeline):
                     self.sample_video_extract_full_file_name = None
                     self.prepared_sample_video = True
 
-                if len(self.file_batch) == self.batch_size:
-                    self.content = pickle.dumps(
-                        ScanResults(
-                            rpd_files=self.file_batch,
-                            file_type_counter=self.file_type_counter,
-                            file_size_sum=self.file_size_sum,
-                            sample_photo=self.sample_photo,
-                            sample_video=self.sample_video,
-                            entire_video_required=self.entire_video_required,
-                            entire_photo_required=self.entire_photo_required,
-                        ),
-                        pickle.HIGHEST_PROTOCOL,
-                    )
-                    self.send_message_to_sink()
-                    self.file_batch = []
-                    self.sample_photo = None
-                    self.sample_video = None
+                if self.batch_sizer.due(len(self.file_batch)):
+                    self.send_file_batch()
+
+    def resolve_previously_downloaded(self) -> None:
+        """
+        Determine which files in the current batch have been downloaded before,
+        using a single batched lookup in the downloaded files database
+        """
+
+        downloaded = self.downloaded.files_downloaded(
+            files=[
+                (rpd_file.name, rpd_file.size, rpd_file.modification_time)
+                for rpd_file in self.file_batch
+            ],
+            time_zone_offset_resolution=self.time_zone_offset_resolution,
+        )
+        for rpd_file, file_downloaded in zip(self.file_batch, downloaded):
+            if file_downloaded is not None:
+                self.no_previously_downloaded += 1
+                rpd_file.prev_full_name = file_downloaded.download_name
+                rpd_file.prev_datetime = file_downloaded.download_datetime
+                rpd_file.previously_downloaded = True
+
+    def send_file_batch(self) -> None:
+        """
+        Send the files scanned so far to the sink, including the sample photo or
+        video if they are ready
+        """
+
+        self.resolve_previously_downloaded()
+        no_files = len(self.file_batch)
+        self.content = pickle.dumps(
+            ScanResults(
+                rpd_files=self.file_batch,
+                file_type_counter=self.file_type_counter,
+                file_size_sum=self.file_size_sum,
+                sample_photo=self.sample_photo,
+                sample_video=self.sample_video,
+                entire_video_required=self.entire_video_required,
+                entire_photo_required=self.entire_photo_required,
+            ),
+            pickle.HIGHEST_PROTOCOL,
+        )
+        start = time.monotonic()
+        self.send_message_to_sink()
+        self.batch_sizer.sent(no_files, time.monotonic() - start)
+        self.file_batch = []
+        self.sample_photo = None
+        self.sample_video = None
 
     def send_message_to_sink(self) -> None:
         try:
@@ -1651,10 +2119,13 @@ class ScanWorker(WorkerInPublishPullPipeline):
         ext_type: FileExtension,
         extension: str,
         file_type: FileType,
+        stat: Optional[os.stat_result] = None,
     ) -> bool:
         """
         Examine the the sample file to extract its metadata and compare it
         against the file system modification time
+
+        :param stat: result of calling stat on the file, if already known
         """
 
         logging.debug("Examining sample %s", full_file_name)
@@ -1664,7 +2135,10 @@ class ScanWorker(WorkerInPublishPullPipeline):
         if sample.datetime is not None:
             self.file_mdatatime[full_file_name] = sample.datetime.timestamp()
             try:
-                mtime = os.path.getmtime(full_file_name)
+                if stat is None:
+                    mtime = os.path.getmtime(full_file_name)
+                else:
+                    mtime = stat.st_mtime
             except (OSError, PermissionError) as e:
                 logging.warning(
                     "Could not determine modification time for %s", full_file_name
@@ -1681,7 +2155,9 @@ class ScanWorker(WorkerInPublishPullPipeline):
                 )
                 return True
 
-    def distinguish_non_camera_device_timestamp(self, path: str) -> None:
+    def distinguish_non_camera_device_timestamp(
+        self, directories: Iterator[ScannedDirectory]
+    ) -> None:
         """
         Attempt to determine the device's approach to timezones when it
         store timestamps.
@@ -1693,6 +2169,9 @@ class ScanWorker(WorkerInPublishPullPipeline):
         if not, then jpeg, if jpeg also not present, then heif / heic, if that
         not present, then video). However if a photo is found, then still need
         to create a sample file for video.
+
+        :param directories: the directories on the device, which will be read only
+         as far as is needed
         """
 
         logging.debug(
@@ -1717,7 +2196,12 @@ class ScanWorker(WorkerInPublishPullPipeline):
             extensions = (FileExtension.raw, FileExtension.jpeg, FileExtension.video)
         non_raw_extensions = extensions[1:]
 
-        for dir_name, name in self.walk_file_system(path):
+        files = (
+            (directory.path, entry.name, stat)
+            for directory in directories
+            for entry, stat in directory.files
+        )
+        for dir_name, name, stat in files:
             full_file_name = os.path.join(dir_name, name)
             extension = fileformats.extract_extension(full_file_name)
             ext_type = fileformats.extension_type(extension)
@@ -1733,12 +2217,13 @@ class ScanWorker(WorkerInPublishPullPipeline):
                         ext_type=ext_type,
                         extension=extension,
                         file_type=file_type,
+                        stat=stat,
                     ):
                         return
                 else:
                     if len(jpegs_heifs_and_videos[ext_type]) < max_attempts:
                         jpegs_heifs_and_videos[ext_type].append(
-                            (dir_name, name, full_file_name, extension)
+                            (dir_name, name, full_file_name, extension, stat)
                         )
 
                     if len(jpegs_heifs_and_videos[FileExtension.jpeg]) == max_attempts:
@@ -1747,9 +2232,13 @@ class ScanWorker(WorkerInPublishPullPipeline):
         # Couldn't locate sample raw file. Are left with up to max_attempts jpeg and
         # video files
         for ext_type in non_raw_extensions:
-            for dir_name, name, full_file_name, extension in jpegs_heifs_and_videos[
-                ext_type
-            ]:
+            for (
+                dir_name,
+                name,
+                full_file_name,
+                extension,
+                stat,
+            ) in jpegs_heifs_and_videos[ext_type]:
                 file_type = fileformats.file_type(extension)
                 if self.examine_sample_non_camera_file(
                     dirname=dir_name,
@@ -1758,6 +2247,7 @@ class ScanWorker(WorkerInPublishPullPipeline):
                     ext_type=ext_type,
                     extension=extension,
                     file_type=file_type,
+                    stat=stat,
                 ):
                     return
 
@@ -1833,13 +2323,27 @@ class ScanWorker(WorkerInPublishPullPipeline):
         else:
             return mtime
 
-    def _get_associate_file_from_camera(
-        self, base_name: str, associate_files: DefaultDict, camera_file: CameraFile
+    def _get_associate_file(
+        self,
+        base_name: str,
+        extensions_to_check: List[str],
+        camera_file: Optional[CameraFile],
     ) -> Optional[str]:
-        for path, ext in associate_files[base_name]:
-            if path in self._camera_directories_for_file[camera_file]:
-                return "{}.{}".format(os.path.join(path, base_name), ext)
-        return None
+        """
+        :param base_name: base name of file, without directory
+        :param extensions_to_check: list of extensions in lower case without leading
+         period
+        :param camera_file: if downloading from a camera, the file on the camera
+        :return: full file path if found, else None
+        """
+
+        if self.download_from_camera:
+            # The associate file must be in a directory the file itself is in
+            paths = self._camera_directories_for_file[camera_file]
+        else:
+            # The index contains only the directory being scanned
+            paths = None
+        return self.associate_files.find(base_name, extensions_to_check, paths)
 
     def get_video_THM_file(
         self, base_name: str, camera_file: CameraFile
@@ -1852,14 +2356,9 @@ class ScanWorker(WorkerInPublishPullPipeline):
         :return: filename, including path, if found, else returns None
         """
 
-        if self.download_from_camera:
-            return self._get_associate_file_from_camera(
-                base_name, self._camera_video_thumbnails, camera_file
-            )
-        else:
-            return self._get_associate_file(
-                base_name, fileformats.VIDEO_THUMBNAIL_EXTENSIONS
-            )
+        return self._get_associate_file(
+            base_name, fileformats.VIDEO_THUMBNAIL_EXTENSIONS, camera_file
+        )
 
     def get_audio_file(self, base_name: str, camera_file: CameraFile) -> Optional[str]:
         """
@@ -1870,12 +2369,9 @@ class ScanWorker(WorkerInPublishPullPipeline):
         :return: filename, including path, if found, else returns None
         """
 
-        if self.download_from_camera:
-            return self._get_associate_file_from_camera(
-                base_name, self._camera_audio_files, camera_file
-            )
-        else:
-            return self._get_associate_file(base_name, fileformats.AUDIO_EXTENSIONS)
+        return self._get_associate_file(
+            base_name, fileformats.AUDIO_EXTENSIONS, camera_file
+        )
 
     def get_log_file(self, base_name: str, camera_file: CameraFile) -> Optional[str]:
         """
@@ -1885,12 +2381,8 @@ class ScanWorker(WorkerInPublishPullPipeline):
         :param base_name: the file name without the extension
         :return: filename, including path, if found, else returns None
         """
-        if self.download_from_camera:
-            return self._get_associate_file_from_camera(
-                base_name, self._camera_log_files, camera_file
-            )
-        else:
-            return self._get_associate_file(base_name, ["log"])
+
+        return self._get_associate_file(base_name, ["log"], camera_file)
 
     def get_xmp_file(self, base_name: str, camera_file: CameraFile) -> Optional[str]:
         """
@@ -1900,32 +2392,8 @@ class ScanWorker(WorkerInPublishPullPipeline):
         :param base_name: the file name without the extension
         :return: filename, including path, if found, else returns None
         """
-        if self.download_from_camera:
-            return self._get_associate_file_from_camera(
-                base_name, self._camera_xmp_files, camera_file
-            )
-        else:
-            return self._get_associate_file(base_name, ["xmp"])
-
-    def _get_associate_file(
-        self, base_name: str, extensions_to_check: List[str]
-    ) -> Optional[str]:
-        """
-        :param base_name: base name of file, without directory
-        :param extensions_to_check: list of extensions in lower case without leading
-        period
-        :return: full file path if found, else None
-        """
 
-        full_file_name_no_ext = os.path.join(self.dir_name, base_name)
-        for e in extensions_to_check:
-            possible_file = "{}.{}".format(full_file_name_no_ext, e)
-            if os.path.exists(possible_file):
-                return possible_file
-            possible_file = "{}.{}".format(full_file_name_no_ext, e.upper())
-            if os.path.exists(possible_file):
-                return possible_file
-        return None
+        return self._get_associate_file(base_name, ["xmp"], camera_file)
 
     def cleanup_pre_stop(self):
         self.exit_exiftool()
@@ -0,0 +1,318 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""
+Record what was found when a device was scanned, so that when the same device is
+scanned again, work whose result cannot have changed is skipped.
+
+A manifest is kept for each memory card, volume, path on This Computer, or iOS
+device. For each directory it records the directory's modification time, the
+result of calling stat on every file in it, and its subdirectories. When the
+modification time of a directory is unchanged on the next scan, what was found in
+it is replayed without listing it or calling stat on its files. That is only done
+on file systems whose directory modification times can be relied on.
+
+For each file the manifest also records its metadata date time and thumbnail cache
+status, keyed by the file's size and modification time, so the thumbnail cache does
+not need to be queried again.
+
+Whether a file was previously downloaded is never recorded, because it changes
+between scans.
+
+Location: /home/USER/.cache/rapid-photo-downloader/scan_manifests/
+"""
+
+__author__ = "Damon Lynch"
+__copyright__ = "Copyright 2021, Damon Lynch"
+
+import os
+import pickle
+import logging
+import hashlib
+import time
+from collections import namedtuple
+from typing import Optional, Dict, Tuple, Sequence
+
+from raphodo.constants import DeviceType, ThumbnailCacheDiskStatus
+from raphodo.devices import Device
+from raphodo.storage.storage import get_program_cache_directory, get_volume_uuid
+
+# The parts of the result of calling stat that the scan uses. Can be used in place
+# of an os.stat_result.
+ManifestStat = namedtuple("ManifestStat", "st_size st_mtime st_mode st_uid st_gid")
+
+# A directory's modification time in nanoseconds, a dict of file name:
+# ManifestStat for the files in it, and the names of its subdirectories
+ManifestDirectory = namedtuple("ManifestDirectory", "mtime files dirs")
+
+# Stands in for the os.DirEntry of a file in a directory that is replayed from the
+# manifest
+ManifestEntry = namedtuple("ManifestEntry", "name path")
+
+# A directory modified this recently, in nanoseconds, could be modified again
+# without its modification time changing, so it is not recorded
+racy_interval = 1000000000
+
+
+def fine_grained_mtime(mtime: int) -> bool:
+    """
+    :param mtime: modification time in nanoseconds
+    :return: False if the time is a whole number of seconds, which indicates the
+     file system stores times too coarsely to detect every change, e.g. FAT
+    """
+
+    return mtime % 1000000000 != 0
+
+# Scan results for a file that remain valid as long as its size and modification
+# time do not change
+ManifestFile = namedtuple("ManifestFile", "size mtime mdatatime thumbnail_cache_status")
+
+
+def scan_manifest_key(device: Device) -> Optional[str]:
+    """
+    Identify a device in a way that survives it being removed and reinserted, or
+    mounted at a different location.
+
+    :param device: the device to be scanned
+    :return: key, or None if the device cannot be reliably identified
+    """
+
+    if device.device_type == DeviceType.volume:
+        uuid = get_volume_uuid(device.path)
+        if uuid is not None:
+            return "volume:{}".format(uuid)
+    elif device.device_type == DeviceType.path:
+        return "path:{}".format(os.path.abspath(device.path))
+    elif device.device_type == DeviceType.camera_fuse and device.idevice_udid:
+        return "idevice:{}".format(device.idevice_udid)
+    return None
+
+
+class ScanManifest:
+    """
+    What was found on a device the last time it was scanned, and what is found
+    during the current scan.
+
+    Directory paths are stored relative to the root of the device, because the
+    mount point of a device can change between scans.
+    """
+
+    version = 2
+
+    def __init__(self, key: str, root: str, reuse_stats: bool) -> None:
+        """
+        :param key: value returned by scan_manifest_key()
+        :param root: the path the device is mounted at
+        :param reuse_stats: whether to replay directories whose modification time
+         is unchanged. Editing a file in place does not change the modification
+         time of its directory, so this should be False for file systems whose
+         files might be edited in place, or whose directory modification times
+         are unreliable.
+        """
+
+        self.key = key
+        self.root = root
+        self.reuse_stats = reuse_stats
+
+        cache_dir = get_program_cache_directory(create_if_not_exist=True)
+        if cache_dir is None:
+            self.manifest_file = None
+        else:
+            self.manifest_file = os.path.join(
+                cache_dir,
+                "scan_manifests",
+                hashlib.blake2b(key.encode(), digest_size=16).hexdigest(),
+            )
+
+        # Results from the previous scan
+        self.previous_directories = {}  # type: Dict[str, ManifestDirectory]
+        self.previous_files = {}  # type: Dict[str, ManifestFile]
+        # Results from this scan
+        self.directories = {}  # type: Dict[str, ManifestDirectory]
+        self.files = {}  # type: Dict[str, ManifestFile]
+
+        self.directories_reused = 0
+
+    def _relative_path(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def load(self) -> None:
+        """
+        Load the manifest from the previous scan of the device, if there is one
+        """
+
+        if self.manifest_file is None:
+            return
+        try:
+            with open(self.manifest_file, "rb") as manifest:
+                version, key, directories, files = pickle.load(manifest)
+        except FileNotFoundError:
+            logging.debug("No scan manifest exists for %s", self.key)
+            return
+        except Exception:
+            logging.warning("Ignoring unreadable scan manifest for %s", self.key)
+            return
+
+        if version != self.version or key != self.key:
+            logging.debug("Ignoring outdated scan manifest for %s", self.key)
+            return
+
+        self.previous_directories = directories
+        self.previous_files = files
+        logging.debug(
+            "Loaded scan manifest for %s with %s directories and %s files",
+            self.key,
+            len(directories),
+            len(files),
+        )
+
+    def save(self) -> None:
+        """
+        Save what was found in this scan, replacing the previous manifest.
+
+        Only call this for a scan that completed.
+        """
+
+        if self.manifest_file is None:
+            return
+
+        logging.debug(
+            "Saving scan manifest for %s with %s directories and %s files (stat "
+            "results reused for %s directories)",
+            self.key,
+            len(self.directories),
+            len(self.files),
+            self.directories_reused,
+        )
+        temp_file = "{}.{}".format(self.manifest_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+            with open(temp_file, "wb") as manifest:
+                pickle.dump(
+                    (self.version, self.key, self.directories, self.files),
+                    manifest,
+                    pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_file, self.manifest_file)
+        except OSError as e:
+            logging.error("Unable to save scan manifest for %s: %s", self.key, e)
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+    def previous_directory(self, path: str, mtime: int) -> Optional[ManifestDirectory]:
+        """
+        Get what was found in a directory in the previous scan, if the directory is
+        unchanged.
+
+        :param path: directory path
+        :param mtime: modification time of the directory, in nanoseconds
+        :return: the directory as found in the previous scan, or None if it has
+         changed, is not in the manifest, or its modification time is too coarse
+         to show whether it has changed. If not None, the directory is recorded as
+         found in this scan.
+        """
+
+        if not self.reuse_stats or not fine_grained_mtime(mtime):
+            return None
+        relative_path = self._relative_path(path)
+        directory = self.previous_directories.get(relative_path)
+        if directory is None or directory.mtime != mtime:
+            return None
+        self.directories[relative_path] = directory
+        self.directories_reused += 1
+        return directory
+
+    def record_directory(
+        self,
+        path: str,
+        mtime: int,
+        files: Sequence[Tuple[str, os.stat_result]],
+        dirs: Sequence[str],
+    ) -> None:
+        """
+        Record the files and subdirectories found in a directory in this scan.
+
+        Safe to call from the threads listing directories.
+
+        :param path: directory path
+        :param mtime: modification time of the directory, in nanoseconds, taken
+         before it was listed
+        :param files: file names and their stat results
+        :param dirs: names of the subdirectories
+        """
+
+        if not fine_grained_mtime(mtime) or time.time() * 1e9 - mtime < racy_interval:
+            return
+
+        self.directories[self._relative_path(path)] = ManifestDirectory(
+            mtime=mtime,
+            files={
+                name: ManifestStat(
+                    st_size=stat.st_size,
+                    st_mtime=stat.st_mtime,
+                    st_mode=stat.st_mode,
+                    st_uid=stat.st_uid,
+                    st_gid=stat.st_gid,
+                )
+                for name, stat in files
+            },
+            dirs=tuple(dirs),
+        )
+
+    def previous_file(
+        self, full_file_name: str, size: int, mtime: float
+    ) -> Optional[ManifestFile]:
+        """
+        :param full_file_name: path and name of the file
+        :param size: file size
+        :param mtime: file modification time
+        :return: the scan results recorded for the file in the previous scan, if
+         the file is unchanged
+        """
+
+        file = self.previous_files.get(self._relative_path(full_file_name))
+        if file is None or file.size != size or file.mtime != mtime:
+            return None
+        return file
+
+    def record_file(
+        self,
+        full_file_name: str,
+        size: int,
+        mtime: float,
+        mdatatime: float,
+        thumbnail_cache_status: ThumbnailCacheDiskStatus,
+    ) -> None:
+        """
+        Record the scan results for a file whose metadata date time is known
+
+        :param full_file_name: path and name of the file
+        :param size: file size
+        :param mtime: file modification time
+        :param mdatatime: file metadata date time
+        :param thumbnail_cache_status: whether the file is in the thumbnail cache
+        """
+
+        self.files[self._relative_path(full_file_name)] = ManifestFile(
+            size=size,
+            mtime=mtime,
+            mdatatime=mdatatime,
+            thumbnail_cache_status=thumbnail_cache_status,
+        )
@@ -966,6 +966,28 @@ def fs_device_details(path: str) -> Tuple:
     return name, uri, root_path, fstype
 
 
+def get_volume_uuid(path: str) -> Optional[str]:
+    """
+    :param path: path on the mount
+    :return: the UUID of the file system the path is on, as listed in
+     /dev/disk/by-uuid, else None if it could not be determined
+    """
+
+    # device() returns a QByteArray
+    device = bytes(QStorageInfo(path).device()).decode()
+    if not device.startswith("/dev/"):
+        return None
+    device = os.path.realpath(device)
+    by_uuid = "/dev/disk/by-uuid"
+    try:
+        for uuid in os.listdir(by_uuid):
+            if os.path.realpath(os.path.join(by_uuid, uuid)) == device:
+                return uuid
+    except OSError:
+        pass
+    return None
+
+
 class WatchDownloadDirs(QFileSystemWatcher):
     """
     Create a file system watch to monitor if there are changes to the
@@ -0,0 +1,175 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+pytest.importorskip("PyQt5")
+cache = pytest.importorskip("raphodo.cache")
+
+from raphodo.constants import ThumbnailCacheDiskStatus
+
+
+@pytest.fixture
+def segments(tmp_path):
+    segments = cache.ThumbnailSegments(str(tmp_path / "segments"))
+    yield segments
+    segments.close()
+
+
+@pytest.fixture
+def thumbnail_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cache, "get_program_cache_directory", lambda create_if_not_exist: str(tmp_path)
+    )
+    thumbnail_cache = cache.ThumbnailCacheSql(create_table_if_not_exists=True)
+    assert thumbnail_cache.valid
+    yield thumbnail_cache
+    thumbnail_cache.segments.close()
+
+
+def test_append_and_read(segments):
+    first = segments.append(b"first thumbnail")
+    second = segments.append(b"second")
+    assert first[0] == second[0]
+    assert second[1] == first[1] + first[2]
+    assert segments.read(*first) == b"first thumbnail"
+    assert segments.read(*second) == b"second"
+    assert segments.read_many([second, first]) == [b"second", b"first thumbnail"]
+
+
+def test_read_after_append_to_mapped_segment(segments):
+    first = segments.append(b"first")
+    assert segments.read(*first) == b"first"
+    # The segment is already mapped, and must be mapped again to read past its end
+    second = segments.append(b"second")
+    assert segments.read(*second) == b"second"
+
+
+def test_read_missing(segments):
+    segment, offset, length = segments.append(b"thumbnail")
+    assert segments.read(segment, offset, length + 1) is None
+    assert segments.read("missing.segment", 0, 1) is None
+    assert segments.read_many([("missing.segment", 0, 1)]) == [None]
+
+
+def test_new_segment_when_full(segments, monkeypatch):
+    monkeypatch.setattr(segments, "max_segment_size", 4)
+    first = segments.append(b"first")
+    second = segments.append(b"second")
+    assert first[0] != second[0]
+    assert sorted(segments.segments()) == sorted((first[0], second[0]))
+
+
+def save(thumbnail_cache, mtime: float, thumbnail_jpeg: bytes) -> None:
+    assert thumbnail_cache.save_thumbnail(
+        full_file_name="/media/card/DCIM/IMG_0001.JPG",
+        size=1000,
+        mtime=mtime,
+        mdatatime=mtime,
+        generation_failed=False,
+        orientation_unknown=False,
+        thumbnail=None,
+        thumbnail_jpeg=thumbnail_jpeg,
+    )
+
+
+def cached(thumbnail_cache, mtime: float) -> bytes:
+    thumbnail = thumbnail_cache.get_thumbnail(
+        "/media/card/DCIM/IMG_0001.JPG", mtime=mtime, size=1000
+    )
+    assert thumbnail.disk_status == ThumbnailCacheDiskStatus.found
+    return thumbnail.thumbnail_bytes
+
+
+def test_compact_keeps_each_version_of_a_file(thumbnail_cache):
+    # Every version of the same file has the same md5 name. Put each version in a
+    # segment of its own, so that compacting combines the small segments.
+    save(thumbnail_cache, 1.0, b"first version")
+    thumbnail_cache.segments.close_segment()
+    save(thumbnail_cache, 2.0, b"second version")
+    thumbnail_cache.segments.close_segment()
+    before = set(thumbnail_cache.segments.segments())
+    assert len(before) == 2
+
+    thumbnail_cache.compact()
+
+    after = set(thumbnail_cache.segments.segments())
+    assert len(after) == 1
+    assert not after & before
+    assert cached(thumbnail_cache, 1.0) == b"first version"
+    assert cached(thumbnail_cache, 2.0) == b"second version"
+
+
+def test_compact_removes_unused_segments(thumbnail_cache):
+    save(thumbnail_cache, 1.0, b"thumbnail")
+    thumbnail_cache.segments.close_segment()
+    segment = thumbnail_cache.segments.segments()[0]
+    md5_name = thumbnail_cache.md5.md5_hash_name(
+        "/media/card/DCIM/IMG_0001.JPG", extension="jpg"
+    )[0]
+    thumbnail_cache.thumb_db.delete_thumbnails([md5_name])
+
+    thumbnail_cache.compact()
+
+    assert not os.path.exists(thumbnail_cache.segments.path(segment))
+
+
+def test_get_thumbnails_in_chunks(thumbnail_cache, monkeypatch):
+    monkeypatch.setattr(thumbnail_cache, "get_thumbnails_chunk_size", 2)
+    for mtime in (1.0, 2.0, 3.0):
+        save(thumbnail_cache, mtime, "version {}".format(mtime).encode())
+    files = [
+        ("/media/card/DCIM/IMG_0001.JPG", mtime, 1000, None)
+        for mtime in (3.0, 4.0, 1.0, 2.0, 1.0)
+    ]
+
+    thumbnails = list(thumbnail_cache.get_thumbnails(files))
+
+    assert [thumbnail.thumbnail_bytes for thumbnail in thumbnails] == [
+        b"version 3.0",
+        None,
+        b"version 1.0",
+        b"version 2.0",
+        b"version 1.0",
+    ]
+    assert thumbnails[1].disk_status == ThumbnailCacheDiskStatus.not_found
+
+
+def test_least_recently_read_segment_unmapped(segments, monkeypatch):
+    monkeypatch.setattr(segments, "max_maps", 2)
+    locations = []
+    for data in (b"first", b"second", b"third"):
+        locations.append(segments.append(data))
+        segments.close_segment()
+    segments.read(*locations[0])
+    segments.read(*locations[1])
+    segments.read(*locations[0])
+    assert segments.read(*locations[2]) == b"third"
+    assert list(segments.maps) == [locations[0][0], locations[2][0]]
+
+
+def test_missing_segment_unmapped(segments):
+    first = segments.append(b"first")
+    segments.close_segment()
+    second = segments.append(b"second")
+    segments.read(*first)
+    os.remove(segments.path(first[0]))
+    assert segments.read(*second) == b"second"
+    assert list(segments.maps) == [second[0]]
@@ -0,0 +1,222 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import pickle
+
+import pytest
+
+pytest.importorskip("PyQt5")
+interprocess = pytest.importorskip("raphodo.interprocess")
+
+from raphodo.constants import DownloadStatus, FileType
+from raphodo.rpdfile import RPDFile, RPDFileChanges, Photo
+from raphodo.tests.test_rpdfile import make_file
+
+
+def send(rpd_file):
+    """
+    Pickle a file as it is when sent to a worker, which unpickles it
+    """
+
+    data = pickle.dumps(rpd_file, pickle.HIGHEST_PROTOCOL)
+    track_changes = RPDFile.track_changes
+    RPDFile.track_changes = True
+    try:
+        return pickle.loads(data)
+    finally:
+        RPDFile.track_changes = track_changes
+
+
+def reply(rpd_file):
+    """
+    Pickle the changes a worker made to a file, as sent back to the main process
+    """
+
+    return pickle.loads(pickle.dumps(RPDFileChanges(rpd_file)))
+
+
+@pytest.fixture
+def photo():
+    return make_file(FileType.photo, "IMG_0001.CR2")
+
+
+def test_changes_applied(photo):
+    sent_files = interprocess.SentFiles()
+    sent_files.add(photo)
+    received = send(photo)
+    received.status = DownloadStatus.downloaded
+    received.download_name = "20200913-0001.cr2"
+
+    changes = reply(received)
+    # Besides the attributes that changed, only those that could have been
+    # modified in place are sent back
+    changed = {
+        RPDFile.wire_attributes[index]
+        for index, value in changes.changes
+        if not isinstance(value, list)
+    }
+    assert changed == {"status", "download_name"}
+
+    rpd_file = sent_files.apply(changes)
+    assert isinstance(rpd_file, Photo)
+    assert rpd_file is not photo
+    assert rpd_file.uid == photo.uid
+    assert rpd_file.status == DownloadStatus.downloaded
+    assert rpd_file.download_name == "20200913-0001.cr2"
+    assert rpd_file.full_file_name == photo.full_file_name
+    assert not sent_files.sent
+
+
+def test_changes_made_in_place(photo):
+    sent_files = interprocess.SentFiles()
+    sent_files.add(photo)
+    received = send(photo)
+    received.name_pref_list.append("Date time")
+
+    rpd_file = sent_files.apply(reply(received))
+    assert rpd_file.name_pref_list == ["Date time"]
+    # The snapshot is not modified
+    assert photo.name_pref_list == []
+
+
+def test_no_changes(photo):
+    sent_files = interprocess.SentFiles()
+    sent_files.add(photo)
+    changes = reply(send(photo))
+    # Lists could have been modified in place, so they are always sent back
+    assert all(isinstance(value, list) for _, value in changes.changes)
+    assert sent_files.apply(changes).download_name == ""
+
+
+def test_multiple_replies(photo):
+    sent_files = interprocess.SentFiles()
+    sent_files.add(photo, replies=2)
+    first = send(photo)
+    first.download_full_file_name = "/media/backup1/IMG_0001.CR2"
+    second = send(photo)
+    second.download_full_file_name = "/media/backup2/IMG_0001.CR2"
+
+    rpd_file = sent_files.apply(reply(first))
+    assert rpd_file.download_full_file_name == "/media/backup1/IMG_0001.CR2"
+    assert photo.uid in sent_files.sent
+    # Each reply is applied to the file as it was sent
+    rpd_file = sent_files.apply(reply(second))
+    assert rpd_file.download_full_file_name == "/media/backup2/IMG_0001.CR2"
+    assert not sent_files.sent
+    assert sent_files.apply(reply(second)) is None
+
+
+def test_remove(photo):
+    other = make_file(FileType.photo, "IMG_0002.CR2")
+    other.scan_id = photo.scan_id + 1
+    sent_files = interprocess.SentFiles()
+    sent_files.add(photo)
+    sent_files.add(other)
+
+    sent_files.remove(photo.scan_id)
+
+    assert list(sent_files.sent) == [other.uid]
+    assert sent_files.removed_scan_ids == {photo.scan_id}
+    assert sent_files.apply(reply(send(photo))) is None
+    assert sent_files.apply(reply(send(other))).uid == other.uid
+    assert not sent_files.sent
+
+
+def test_whole_file_returned(photo):
+    sent_files = interprocess.SentFiles()
+    assert sent_files.apply(photo) is photo
+
+
+def decide(**measured):
+    """
+    Decide how to scale, given a busy interval during which work was waiting
+    unless otherwise specified
+    """
+
+    measurements = dict(
+        work_waiting=True,
+        saturated=1.0,
+        starting=0,
+        active=4,
+        max_workers=8,
+        io_wait=0.0,
+        system_cpu=50.0,
+        mean_worker_cpu=90.0,
+        min_idle=0,
+        idle_intervals=0,
+    )
+    measurements.update(measured)
+    return interprocess.LRUQueue.scaling_decision(**measurements)
+
+
+def test_grow_when_saturated():
+    assert decide() == (2, 0)
+    assert decide(active=1) == (1, 0)
+    # No more than the most workers that can be in use
+    assert decide(active=7) == (1, 0)
+    assert decide(active=8) == (0, 0)
+
+
+def test_grow_resets_idle_intervals():
+    assert decide(idle_intervals=3) == (2, 0)
+
+
+def test_no_growth_unless_saturated():
+    assert decide(work_waiting=False) == (0, 0)
+    assert decide(saturated=0.5) == (0, 0)
+
+
+def test_no_growth_while_workers_starting():
+    assert decide(starting=1) == (0, 0)
+
+
+def test_no_growth_when_cpu_busy():
+    assert decide(system_cpu=95.0) == (0, 0)
+
+
+def test_io_wait_veto():
+    # Workers that are mostly idle while the system waits on I/O are waiting on
+    # the same devices
+    assert decide(io_wait=40.0, mean_worker_cpu=10.0) == (0, 0)
+    # Workers busy with the CPU are not
+    assert decide(io_wait=40.0, mean_worker_cpu=80.0) == (2, 0)
+
+
+def test_park_after_idle_intervals():
+    park_after = interprocess.LRUQueue.park_after
+    idle = dict(work_waiting=False, saturated=0.0, min_idle=1)
+    idle_intervals = 0
+    for _ in range(park_after - 1):
+        to_add, idle_intervals = decide(idle_intervals=idle_intervals, **idle)
+        assert to_add == 0
+    assert idle_intervals == park_after - 1
+    assert decide(idle_intervals=idle_intervals, **idle) == (-1, 0)
+
+
+def test_idle_intervals_reset_when_no_worker_idle():
+    assert decide(work_waiting=False, min_idle=0, idle_intervals=3) == (0, 0)
+
+
+def test_never_park_below_min_workers():
+    min_workers = interprocess.LRUQueue.min_workers
+    assert decide(
+        work_waiting=False,
+        min_idle=1,
+        active=min_workers,
+        idle_intervals=interprocess.LRUQueue.park_after,
+    ) == (0, 0)
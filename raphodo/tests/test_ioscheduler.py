@@ -0,0 +1,128 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import time
+
+import pytest
+
+ioscheduler = pytest.importorskip("raphodo.ioscheduler")
+
+fork = multiprocessing.get_context("fork")
+
+
+@pytest.fixture
+def device(tmp_path, monkeypatch):
+    """
+    A memory card reader attached by USB, which is used by one process at a time
+    """
+
+    device = str(tmp_path / "usb1" / "sdz")
+    monkeypatch.setattr(
+        ioscheduler, "get_program_cache_directory", lambda **kwargs: str(tmp_path)
+    )
+    monkeypatch.setattr(ioscheduler, "physical_device", lambda path: device)
+    return device
+
+
+def timed_read(scheduler: "ioscheduler.IOScheduler"):
+    """
+    :return: how long it took to get a turn to read, and whether it was a turn
+     of its own rather than reading after waiting max_read_wait
+    """
+
+    start = time.monotonic()
+    with scheduler.read("/media/card/DCIM/IMG_0001.CR2"):
+        return time.monotonic() - start, bool(scheduler.held)
+
+
+def pausing_copy(holding, pause, paused, resume, resumed) -> None:
+    scheduler = ioscheduler.IOScheduler()
+    with scheduler.copy("/media/card/DCIM/IMG_0001.CR2"):
+        holding.set()
+        pause.wait()
+        scheduler.suspend()
+        paused.set()
+        resume.wait()
+        scheduler.resume()
+        resumed.set()
+        time.sleep(0.2)
+    scheduler.close()
+
+
+def test_paused_copy_gives_up_its_turn(device):
+    holding, pause, paused, resume, resumed = (fork.Event() for _ in range(5))
+    copier = fork.Process(
+        target=pausing_copy, args=(holding, pause, paused, resume, resumed)
+    )
+    copier.start()
+    try:
+        assert holding.wait(5)
+        scheduler = ioscheduler.IOScheduler()
+        scheduler.max_read_wait = 0.3
+
+        # The copy holds the only turn
+        elapsed, own_turn = timed_read(scheduler)
+        assert not own_turn
+        assert elapsed >= 0.3
+
+        pause.set()
+        assert paused.wait(5)
+        start = time.monotonic()
+        with scheduler.read("/media/card/DCIM/IMG_0002.CR2"):
+            assert scheduler.held
+            assert time.monotonic() - start < 0.3
+            # The copy waits for the read to finish before it continues
+            resume.set()
+            assert not resumed.wait(0.3)
+        assert resumed.wait(5)
+        scheduler.close()
+    finally:
+        pause.set()
+        resume.set()
+        copier.join(5)
+    assert copier.exitcode == 0
+
+
+def back_to_back_copies(copying, stop) -> None:
+    scheduler = ioscheduler.IOScheduler()
+    while not stop.is_set():
+        with scheduler.copy("/media/card/DCIM/MVI_0001.MOV"):
+            copying.set()
+            time.sleep(0.1)
+    scheduler.close()
+
+
+def test_read_between_back_to_back_copies(device):
+    copying, stop = fork.Event(), fork.Event()
+    copier = fork.Process(target=back_to_back_copies, args=(copying, stop))
+    copier.start()
+    try:
+        assert copying.wait(5)
+        scheduler = ioscheduler.IOScheduler()
+        for _ in range(3):
+            elapsed, own_turn = timed_read(scheduler)
+            assert own_turn
+            assert elapsed < 1.0
+            scheduler.wait_for_turn("/media/card/DCIM/IMG_0001.CR2")
+            assert not scheduler.held
+        scheduler.close()
+    finally:
+        stop.set()
+        copier.join(5)
+    assert copier.exitcode == 0
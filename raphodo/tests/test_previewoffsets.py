@@ -0,0 +1,63 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+thumbnailpara = pytest.importorskip("raphodo.thumbnailpara")
+
+from raphodo.constants import FileType
+from raphodo.rpdsql import PreviewOffsetSQL
+from raphodo.tests.test_rpdfile import camera_details, make_file
+
+
+@pytest.fixture
+def preview_offsets(tmp_path, monkeypatch):
+    sql = PreviewOffsetSQL(str(tmp_path))
+    sql.add_offset("Canon EOS 5D", "cr2", 200000)
+    sql.add_offset("Canon EOS R5", "cr2", 900000)
+    monkeypatch.setattr(thumbnailpara, "PreviewOffsetSQL", lambda: sql)
+    return thumbnailpara.PreviewOffsets()
+
+
+def test_camera_looked_up_by_model(preview_offsets):
+    photo = make_file(FileType.photo, "IMG_0001.CR2", camera_details)
+    photo.size = 10000000
+    assert preview_offsets.bytes_to_read(photo) == (
+        200000 + thumbnailpara.learned_offset_margin
+    )
+
+
+def test_memory_card_uses_most_learned(preview_offsets):
+    photo = make_file(FileType.photo, "IMG_0001.CR2")
+    photo.size = 10000000
+    assert preview_offsets.bytes_to_read(photo) == (
+        900000 + thumbnailpara.learned_offset_margin
+    )
+    # Never less than would be read were nothing learned
+    assert preview_offsets.bytes_to_read(photo, 2000000) == 2000000
+    # Never more than the file
+    photo.size = 500000
+    assert preview_offsets.bytes_to_read(photo) == 500000
+
+
+def test_nothing_learned(preview_offsets):
+    photo = make_file(FileType.photo, "IMG_0001.NEF")
+    photo.size = 10000000
+    assert preview_offsets.bytes_to_read(photo) is None
+    assert preview_offsets.bytes_to_read(photo, 400000) == 400000
@@ -0,0 +1,121 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import pickle
+
+import pytest
+
+pytest.importorskip("PyQt5")
+rpdfile = pytest.importorskip("raphodo.rpdfile")
+
+from raphodo.constants import DeviceTimestampTZ, FileType, ThumbnailCacheDiskStatus
+from raphodo.storage.storage import CameraDetails
+
+
+def make_file(file_type, name, camera_details=None):
+    return rpdfile.get_rpdfile(
+        name=name,
+        path="/DCIM/100CANON",
+        size=1000,
+        prev_full_name=None,
+        prev_datetime=None,
+        device_timestamp_type=DeviceTimestampTZ.is_local,
+        mtime=1600000000.0,
+        mdatatime=1600000001.0,
+        thumbnail_cache_status=ThumbnailCacheDiskStatus.not_found,
+        thm_full_name=None,
+        audio_file_full_name=None,
+        xmp_file_full_name=None,
+        log_file_full_name=None,
+        scan_id=b"3",
+        file_type=file_type,
+        from_camera=camera_details is not None,
+        camera_details=camera_details,
+        camera_memory_card_identifiers=[1, 2] if camera_details else None,
+        never_read_mdatatime=False,
+        device_display_name="Canon EOS 5D",
+        device_uri="gphoto2://usb:001,004",
+        raw_exif_bytes=None,
+        exif_source=None,
+        problem=None,
+    )
+
+
+camera_details = CameraDetails(
+    model="Canon EOS 5D",
+    port="usb:001,004",
+    display_name="Canon EOS 5D",
+    is_mtp=True,
+    storage_desc=["SD1", "SD2"],
+)
+
+
+@pytest.mark.parametrize(
+    "file_type,name,rpd_file_class",
+    [
+        (FileType.photo, "IMG_0001.CR2", "Photo"),
+        (FileType.video, "MVI_0001.MOV", "Video"),
+    ],
+)
+def test_pickle_round_trip(file_type, name, rpd_file_class):
+    rpd_file = make_file(file_type, name, camera_details)
+    rpd_file.download_name = "20200913-0001.cr2"
+    rpd_file.name_pref_list = ["Date time", "YYYYMMDD"]
+
+    unpickled = pickle.loads(pickle.dumps(rpd_file, pickle.HIGHEST_PROTOCOL))
+
+    assert type(unpickled).__name__ == rpd_file_class
+    # Every slot set when the file is created is pickled
+    for name in rpdfile.RPDFile.__slots__:
+        if name == "received_state":
+            continue
+        assert hasattr(rpd_file, name), name
+        assert getattr(unpickled, name) == getattr(rpd_file, name), name
+    assert set(rpdfile.RPDFile.__slots__) == set(rpdfile.RPDFile.wire_attributes) | {
+        "received_state"
+    }
+    assert unpickled.received_state is None
+    # The camera details are derived from the camera details that are pickled
+    assert unpickled.camera_model == "Canon EOS 5D"
+    assert unpickled.camera_port == "usb:001,004"
+    assert unpickled.camera_display_name == "Canon EOS 5D"
+    assert unpickled.is_mtp_device
+    assert unpickled.camera_storage_descriptions == ["SD1", "SD2"]
+    assert unpickled.modification_time == rpd_file.modification_time
+    assert unpickled.ctime == rpd_file.ctime
+
+
+def test_pickle_round_trip_without_camera():
+    rpd_file = make_file(FileType.photo, "IMG_0001.JPG")
+
+    unpickled = pickle.loads(pickle.dumps(rpd_file, pickle.HIGHEST_PROTOCOL))
+
+    assert unpickled.full_file_name == "/DCIM/100CANON/IMG_0001.JPG"
+    assert unpickled.camera_model is None
+    assert unpickled.camera_port is None
+    assert not unpickled.is_mtp_device
+    assert unpickled.camera_storage_descriptions is None
+
+
+def test_received_state_kept_when_tracking_changes(monkeypatch):
+    rpd_file = make_file(FileType.photo, "IMG_0001.JPG")
+    monkeypatch.setattr(rpdfile.RPDFile, "track_changes", True)
+
+    unpickled = pickle.loads(pickle.dumps(rpd_file, pickle.HIGHEST_PROTOCOL))
+
+    assert unpickled.received_state == rpdfile.rpd_file_state(rpd_file)
@@ -0,0 +1,99 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+pytest.importorskip("PyQt5")
+rpdsql = pytest.importorskip("raphodo.rpdsql")
+
+
+def downloaded_sql(data_dir, names):
+    downloaded = rpdsql.DownloadedSQL(str(data_dir))
+    for name in names:
+        downloaded.add_downloaded_file(
+            name=name,
+            size=1000,
+            modification_time=1.0,
+            download_full_file_name="/home/user/Pictures/{}".format(name),
+        )
+    downloaded.update_filter()
+    return downloaded
+
+
+def recreate(downloaded, names):
+    """
+    Delete the database, leaving the persisted filter behind, and create it again
+    """
+
+    data_dir = os.path.dirname(downloaded.db)
+    rpdsql.sqlite_connections.close(downloaded.db)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(downloaded.db + suffix)
+        except FileNotFoundError:
+            pass
+    return downloaded_sql(data_dir, names)
+
+
+def names(start, stop):
+    return ["IMG_{:04}.JPG".format(i) for i in range(start, stop)]
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    yield tmp_path
+    rpdsql.sqlite_connections.close(str(tmp_path / "downloaded_files.sqlite"))
+
+
+def test_filter_contains_downloaded_files(data_dir):
+    downloaded = downloaded_sql(data_dir, names(0, 10))
+    downloaded.load_filter()
+    assert downloaded.filter is not None
+    for name in names(0, 10):
+        assert downloaded.filter.might_contain(name, 1000)
+        assert downloaded.file_downloaded(name, 1000, 1.0) is not None
+    assert downloaded.file_downloaded("IMG_0010.JPG", 1000, 1.0) is None
+
+
+def test_filter_is_updated(data_dir):
+    downloaded = downloaded_sql(data_dir, names(0, 10))
+    downloaded.load_filter()
+    downloaded = downloaded_sql(data_dir, names(10, 20))
+    downloaded.load_filter()
+    for name in names(0, 20):
+        assert downloaded.filter.might_contain(name, 1000)
+
+
+def test_filter_rebuilt_when_database_recreated_smaller(data_dir):
+    downloaded = downloaded_sql(data_dir, names(0, 10))
+    downloaded = recreate(downloaded, names(100, 105))
+    downloaded.load_filter()
+    for name in names(100, 105):
+        assert downloaded.filter.might_contain(name, 1000)
+        assert downloaded.file_downloaded(name, 1000, 1.0) is not None
+
+
+def test_filter_rebuilt_when_database_recreated_larger(data_dir):
+    downloaded = downloaded_sql(data_dir, names(0, 5))
+    downloaded = recreate(downloaded, names(100, 110))
+    downloaded.load_filter()
+    for name in names(100, 110):
+        assert downloaded.filter.might_contain(name, 1000)
+        assert downloaded.file_downloaded(name, 1000, 1.0) is not None
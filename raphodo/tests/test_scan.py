@@ -0,0 +1,41 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+scan = pytest.importorskip("raphodo.scan")
+
+from PyQt5.QtCore import QStorageInfo
+
+
+def test_file_system_type_is_a_byte_array(tmp_path):
+    # The reason the value must be converted before it is used as a string
+    fstype = QStorageInfo(str(tmp_path)).fileSystemType()
+    assert not isinstance(fstype, (bytes, str))
+    assert bytes(fstype).decode()
+
+
+def test_local_file_system_is_not_high_latency(tmp_path):
+    assert scan.high_latency_file_system(str(tmp_path)) is False
+
+
+def test_file_system_type_is_checked(tmp_path, monkeypatch):
+    fstype = bytes(QStorageInfo(str(tmp_path)).fileSystemType()).decode()
+    monkeypatch.setattr(scan, "high_latency_file_systems", frozenset((fstype,)))
+    assert scan.high_latency_file_system(str(tmp_path)) is True
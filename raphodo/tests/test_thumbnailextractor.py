@@ -0,0 +1,81 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("PyQt5")
+thumbnailextractor = pytest.importorskip("raphodo.thumbnailextractor")
+
+if not thumbnailextractor.have_gst:
+    pytest.skip("GStreamer is not available", allow_module_level=True)
+
+from gi.repository import GLib, Gst
+
+
+def make_video(path: str, width: int, height: int) -> None:
+    """
+    Create a short sample video using GStreamer
+    """
+
+    try:
+        pipeline = Gst.parse_launch(
+            "videotestsrc num-buffers=5 ! video/x-raw,width={},height={} ! "
+            "jpegenc ! avimux ! filesink location={}".format(width, height, path)
+        )
+    except GLib.Error as e:
+        pytest.skip("Cannot create sample video: {}".format(e))
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(
+        10 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR
+    )
+    pipeline.set_state(Gst.State.NULL)
+    assert message is not None and message.type == Gst.MessageType.EOS
+
+
+@pytest.fixture
+def video_frames():
+    video_frames = thumbnailextractor.VideoFrameExtractor()
+    yield video_frames
+    video_frames.close()
+
+
+def test_frame_large_enough_for_fdo_thumbnail(tmp_path, video_frames):
+    video = str(tmp_path / "sample.avi")
+    make_video(video, 640, 360)
+    frame = video_frames.get_frame(video, 256)
+    assert frame is not None
+    assert frame.width() == 256
+    assert frame.height() == 144
+    assert thumbnailextractor.image_large_enough_fdo(frame.size())
+
+
+def test_pipeline_reused_for_next_video(tmp_path, video_frames):
+    first = str(tmp_path / "first.avi")
+    second = str(tmp_path / "second.avi")
+    make_video(first, 640, 480)
+    make_video(second, 320, 240)
+    assert video_frames.get_frame(first, 160).size() == video_frames.get_frame(
+        second, 160
+    ).size()
+    pipeline = video_frames.pipeline
+    assert video_frames.get_frame(first, 256).width() == 256
+    assert video_frames.pipeline is pipeline
+
+
+def test_missing_video(tmp_path, video_frames):
+    assert video_frames.get_frame(str(tmp_path / "missing.avi"), 256) is None
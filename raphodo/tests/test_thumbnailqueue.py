@@ -0,0 +1,68 @@
+# Copyright (C) 2021 Damon Lynch <damonlynch@gmail.com>
+
+# This file is part of Rapid Photo Downloader.
+#
+# Rapid Photo Downloader is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Rapid Photo Downloader is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Rapid Photo Downloader.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("PyQt5")
+thumbnailpara = pytest.importorskip("raphodo.thumbnailpara")
+
+
+def files(*uids):
+    # The queue only uses the uid of each file
+    return [SimpleNamespace(uid=uid) for uid in uids]
+
+
+def pop_all(queue):
+    uids = []
+    while queue:
+        uids.append(queue.pop().uid)
+    return uids
+
+
+def test_temporal_order():
+    queue = thumbnailpara.ThumbnailQueue()
+    queue.extend(files(b"a", b"b"))
+    queue.extend(files(b"c"))
+    assert len(queue) == 3
+    assert pop_all(queue) == [b"a", b"b", b"c"]
+
+
+def test_priority_then_temporal_order():
+    queue = thumbnailpara.ThumbnailQueue()
+    queue.extend(files(b"a", b"b", b"c", b"d", b"e"))
+    queue.prioritize([b"d", b"b", b"unknown"])
+    assert pop_all(queue) == [b"d", b"b", b"a", b"c", b"e"]
+
+
+def test_priority_skips_files_already_taken():
+    queue = thumbnailpara.ThumbnailQueue()
+    queue.extend(files(b"a", b"b", b"c"))
+    assert queue.pop().uid == b"a"
+    queue.prioritize([b"a", b"c"])
+    assert pop_all(queue) == [b"c", b"b"]
+
+
+def test_priority_replaced():
+    queue = thumbnailpara.ThumbnailQueue()
+    queue.extend(files(b"a", b"b", b"c", b"d", b"e"))
+    queue.prioritize([b"e", b"d"])
+    assert queue.pop().uid == b"e"
+    queue.prioritize([b"c"])
+    assert pop_all(queue) == [b"c", b"a", b"b", b"d"]
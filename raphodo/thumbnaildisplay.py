@@ -21,7 +21,10 @@ __copyright__ = "Copyright 2015-2022, Damon Lynch"
 
 import os
 import datetime
-from collections import defaultdict, deque
+import itertools
+import tempfile
+import zlib
+from collections import defaultdict, deque, OrderedDict
 import logging
 from typing import Optional, Dict, List, Set, Tuple, Sequence, NamedTuple, DefaultDict
 
@@ -46,6 +49,8 @@ from PyQt5.QtCore import (
     QItemSelection,
     QTimeLine,
     QPointF,
+    QObject,
+    QTimer,
 )
 from PyQt5.QtWidgets import (
     QListView,
@@ -79,6 +84,9 @@ from raphodo.rpdfile import RPDFile, FileTypeCounter
 from raphodo.metadata.fileformats import ALL_USER_VISIBLE_EXTENSIONS
 from raphodo.interprocess import (
     Device,
+    RawThumbnail,
+    raw_thumbnail,
+    thumbnail_to_pixmap,
 )
 from raphodo.constants import (
     DownloadStatus,
@@ -196,9 +204,221 @@ class AddBuffer:
         del self.buffer[scan_id]
 
 
+class SpilledThumbnail(NamedTuple):
+    offset: int
+    length: int
+    width: int
+    height: int
+    bytes_per_line: int
+    format: int
+
+
+class ThumbnailStore(QObject):
+    """
+    Thumbnails for the files in the thumbnail model, by uid.
+
+    Only the most recently displayed thumbnails are kept in memory. Once they use
+    more than max_memory, the least recently displayed are spilled to a temporary
+    file for the session. A spilled thumbnail is read back in when it is next
+    displayed, and until then its placeholder icon is shown.
+
+    Each file has a placeholder icon. These are shared, so they use no memory of
+    their own.
+    """
+
+    # Emitted with the uids of thumbnails that have been read back in
+    thumbnailsReloaded = pyqtSignal(list)
+
+    # How much memory thumbnails kept in memory can use, in bytes
+    max_memory = 96 * 1024 * 1024
+
+    def __init__(self, parent: QObject = None) -> None:
+        super().__init__(parent)
+        # uid: placeholder icon
+        self.placeholders = {}  # type: Dict[bytes, QPixmap]
+        # Shared by files whose thumbnail is set without a placeholder having been
+        # added first
+        self.default_placeholder = QPixmap()
+        # uid: thumbnail, least recently displayed first
+        self.pixmaps = OrderedDict()  # type: OrderedDict[bytes, QPixmap]
+        self.memory = 0
+        # uid: location in the spill file. A thumbnail that has been read back in
+        # keeps its location, so that spilling it again costs nothing.
+        self.spilled = {}  # type: Dict[bytes, SpilledThumbnail]
+        self.spill_file = None
+        # Spilled thumbnails to read back in. Values are unused.
+        self.to_reload = OrderedDict()  # type: OrderedDict[bytes, None]
+
+    def __len__(self) -> int:
+        return len(self.placeholders)
+
+    def __contains__(self, uid: bytes) -> bool:
+        return uid in self.placeholders
+
+    def __getitem__(self, uid: bytes) -> QPixmap:
+        """
+        :return: the file's thumbnail, reading it back in if it was spilled,
+         else its placeholder icon
+        """
+
+        if uid in self.pixmaps:
+            self.pixmaps.move_to_end(uid)
+            return self.pixmaps[uid]
+        if uid in self.spilled:
+            pixmap = self._read(uid)
+            if not pixmap.isNull():
+                self._add(uid, pixmap, displayed=True)
+                return pixmap
+        return self.placeholders[uid]
+
+    def __setitem__(self, uid: bytes, thumbnail: QPixmap) -> None:
+        self.set(uid, thumbnail, displayed=True)
+
+    def __delitem__(self, uid: bytes) -> None:
+        del self.placeholders[uid]
+        self._discard(uid)
+        if not self.placeholders and self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def get(self, uid: bytes, default: Optional[QPixmap] = None) -> Optional[QPixmap]:
+        if uid in self.placeholders:
+            return self[uid]
+        return default
+
+    def add_placeholder(self, uid: bytes, placeholder: QPixmap) -> None:
+        self.placeholders[uid] = placeholder
+
+    def set(self, uid: bytes, thumbnail: QPixmap, displayed: bool) -> None:
+        """
+        Add or replace a file's thumbnail.
+
+        :param uid: the file's uid
+        :param thumbnail: the thumbnail
+        :param displayed: whether the thumbnail is being displayed now. If not, it
+         is the first to be spilled.
+        """
+
+        # Never the thumbnail itself, which would keep it in memory when spilled
+        self.placeholders.setdefault(uid, self.default_placeholder)
+        self._discard(uid)
+        self._add(uid, thumbnail, displayed)
+
+    def display(self, uid: bytes) -> QPixmap:
+        """
+        Get a thumbnail to display it.
+
+        A spilled thumbnail is not read back in immediately. Instead, its
+        placeholder is returned, and it is read back in once control returns to the
+        event loop, after which thumbnailsReloaded is emitted.
+
+        :return: the thumbnail if it is in memory, else the placeholder
+        """
+
+        if uid in self.pixmaps:
+            self.pixmaps.move_to_end(uid)
+            return self.pixmaps[uid]
+        if uid in self.spilled:
+            if not self.to_reload:
+                QTimer.singleShot(0, self._reload)
+            self.to_reload[uid] = None
+        return self.placeholders[uid]
+
+    @staticmethod
+    def _memory(thumbnail: QPixmap) -> int:
+        return thumbnail.width() * thumbnail.height() * thumbnail.depth() // 8
+
+    def _add(self, uid: bytes, thumbnail: QPixmap, displayed: bool) -> None:
+        self.pixmaps[uid] = thumbnail
+        self.memory += self._memory(thumbnail)
+        if not displayed:
+            self.pixmaps.move_to_end(uid, last=False)
+        while self.memory > self.max_memory and len(self.pixmaps) > 1:
+            self._spill()
+
+    def _discard(self, uid: bytes) -> None:
+        thumbnail = self.pixmaps.pop(uid, None)
+        if thumbnail is not None:
+            self.memory -= self._memory(thumbnail)
+        self.spilled.pop(uid, None)
+        self.to_reload.pop(uid, None)
+
+    def _spill(self) -> None:
+        """
+        Spill the least recently displayed thumbnail
+        """
+
+        uid, thumbnail = self.pixmaps.popitem(last=False)
+        self.memory -= self._memory(thumbnail)
+        if uid in self.spilled:
+            return
+
+        raw = raw_thumbnail(thumbnail.toImage())
+        data = zlib.compress(raw.data, 1)
+        try:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(
+                    prefix="rpd-thumbnails-",
+                    dir=get_program_cache_directory(create_if_not_exist=True),
+                    buffering=0,
+                )
+            offset = self.spill_file.seek(0, os.SEEK_END)
+            self.spill_file.write(data)
+        except OSError as e:
+            logging.error("Unable to spill thumbnail to disk: %s", e)
+            # Keep it in memory instead
+            self.pixmaps[uid] = thumbnail
+            self.pixmaps.move_to_end(uid, last=False)
+            self.memory += self._memory(thumbnail)
+            self.max_memory = self.memory
+            return
+
+        self.spilled[uid] = SpilledThumbnail(
+            offset=offset,
+            length=len(data),
+            width=raw.width,
+            height=raw.height,
+            bytes_per_line=raw.bytes_per_line,
+            format=raw.format,
+        )
+
+    def _read(self, uid: bytes) -> QPixmap:
+        spilled = self.spilled[uid]
+        try:
+            data = os.pread(self.spill_file.fileno(), spilled.length, spilled.offset)
+        except OSError as e:
+            logging.error("Unable to read spilled thumbnail: %s", e)
+            return QPixmap()
+        return thumbnail_to_pixmap(
+            RawThumbnail(
+                width=spilled.width,
+                height=spilled.height,
+                bytes_per_line=spilled.bytes_per_line,
+                format=spilled.format,
+                data=zlib.decompress(data),
+            )
+        )
+
+    @pyqtSlot()
+    def _reload(self) -> None:
+        reloaded = []
+        while self.to_reload:
+            uid = self.to_reload.popitem(last=False)[0]
+            if uid in self.spilled and uid not in self.pixmaps:
+                pixmap = self._read(uid)
+                if not pixmap.isNull():
+                    self._add(uid, pixmap, displayed=True)
+                    reloaded.append(uid)
+        if reloaded:
+            self.thumbnailsReloaded.emit(reloaded)
+
+
 class ThumbnailListModel(QAbstractListModel):
     selectionReset = pyqtSignal()
 
+    # The most thumbnails to ask the thumbnail extractors to work on next
+    max_prioritized_thumbnails = 1000
+
     def __init__(self, parent, logging_port: int, log_gphoto2: bool) -> None:
         super().__init__(parent)
         self.rapidApp = parent
@@ -242,7 +462,8 @@ class ThumbnailListModel(QAbstractListModel):
 
     def initialize(self) -> None:
         # uid: QPixmap
-        self.thumbnails = {}  # type: Dict[bytes, QPixmap]
+        self.thumbnails = ThumbnailStore(self)
+        self.thumbnails.thumbnailsReloaded.connect(self.thumbnailsReloaded)
 
         self.add_buffer = AddBuffer()
 
@@ -273,6 +494,7 @@ class ThumbnailListModel(QAbstractListModel):
         size = QSize(106, 106)
         self.photo_icon = scaledIcon(":/thumbnail/photo.svg").pixmap(size)
         self.video_icon = scaledIcon(":/thumbnail/video.svg").pixmap(size)
+        self.thumbnails.default_placeholder = self.photo_icon
 
         self.total_thumbs_to_generate = 0
         self.thumbnails_generated = 0
@@ -310,6 +532,7 @@ class ThumbnailListModel(QAbstractListModel):
     @pyqtSlot(int)
     def thumbnailWorkerStopped(self, scan_id: int) -> None:
         self.generating_thumbnails.remove(scan_id)
+        self.thumbnailer.remove_sent_files(scan_id)
         self.rapidApp.thumbnailGenerationStopped(scan_id=scan_id)
 
     def logState(self) -> None:
@@ -494,7 +717,7 @@ class ThumbnailListModel(QAbstractListModel):
                     return 0
             return 0
         elif role == Qt.DecorationRole:
-            return self.thumbnails[uid]
+            return self.thumbnails.display(uid)
         elif role == Qt.CheckStateRole:
             if self.rows[row][1]:
                 return Qt.Checked
@@ -817,9 +1040,9 @@ class ThumbnailListModel(QAbstractListModel):
             self.rpd_files[uid] = rpd_file
 
             if rpd_file.file_type == FileType.photo:
-                self.thumbnails[uid] = self.photo_icon
+                self.thumbnails.add_placeholder(uid, self.photo_icon)
             else:
-                self.thumbnails[uid] = self.video_icon
+                self.thumbnails.add_placeholder(uid, self.video_icon)
 
             if generate_thumbnail:
                 self.total_thumbs_to_generate += 1
@@ -948,9 +1171,14 @@ class ThumbnailListModel(QAbstractListModel):
             self.rpd_files[uid] = rpd_file
 
         if not thumbnail.isNull():
-            self.thumbnails[uid] = thumbnail
             # The thumbnail may or may not be displayed at this moment
             row = self.uid_to_row.get(uid)
+            self.thumbnails.set(
+                uid,
+                thumbnail,
+                displayed=row is not None
+                and self.rapidApp.thumbnailView.rowIsVisible(row),
+            )
             if row is not None:
                 # logging.debug("Updating thumbnail row %s with new thumbnail", row)
                 self.dataChanged.emit(self.index(row, 0), self.index(row, 0))
@@ -993,6 +1221,12 @@ class ThumbnailListModel(QAbstractListModel):
         else:
             self.rapidApp.thumbnailGeneratedPostDownload(rpd_file=rpd_file)
 
+    @pyqtSlot(list)
+    def thumbnailsReloaded(self, uids: List[bytes]) -> None:
+        rows = sorted(self.uid_to_row[uid] for uid in uids if uid in self.uid_to_row)
+        for first, last in runs(rows):
+            self.dataChanged.emit(self.index(first, 0), self.index(last, 0))
+
     def addCtimeDisparity(self, rpd_file: RPDFile) -> None:
         """
         Track the fact that there was a disparity between the creation time and
@@ -1093,6 +1327,46 @@ class ThumbnailListModel(QAbstractListModel):
                 device.entire_photo_required,
             )
             self.thumbnailer.generateThumbnails(*gen_args)
+            self.rapidApp.thumbnailView.scheduleThumbnailPrioritization()
+
+    def prioritizeThumbnails(self, first_row: int, last_row: int) -> None:
+        """
+        Have the thumbnail extractors work next on the thumbnails the user is
+        most likely to look at: those in the rows being displayed, then those in
+        the rows that follow, and then the rest of those in the Timeline selection
+        and those marked for download.
+
+        :param first_row: first row being displayed
+        :param last_row: last row being displayed
+        """
+
+        if not self.generating_thumbnails:
+            return
+
+        visible = last_row - first_row + 1
+        rows = self.rows[first_row : last_row + 1 + visible]
+        if self.proximity_col1 or self.proximity_col2:
+            rows = itertools.chain(rows, self.rows)
+        rows = itertools.chain(rows, (row for row in self.rows if row[1]))
+
+        # scan_id: uids, as the keys of a dict to keep them in order
+        uids = {scan_id: {} for scan_id in self.generating_thumbnails}
+        no_uids = 0
+        for uid, marked in rows:
+            rpd_file = self.rpd_files[uid]
+            scan_uids = uids.get(rpd_file.scan_id)
+            if (
+                scan_uids is not None
+                and uid not in scan_uids
+                and rpd_file.thumbnail_status == ThumbnailCacheStatus.not_ready
+            ):
+                scan_uids[uid] = None
+                no_uids += 1
+                if no_uids == self.max_prioritized_thumbnails:
+                    break
+
+        for scan_id, scan_uids in uids.items():
+            self.thumbnailer.prioritizeThumbnails(scan_id, list(scan_uids))
 
     def resetThumbnailTracking(self):
         self.thumbnails_generated = 0
@@ -1994,6 +2268,37 @@ class ThumbnailView(QListView):
         # QListView IconMode indexes are always set to column 0
         self.user_visible_columns = 0
 
+        # Wait for scrolling to pause before telling the thumbnail extractors which
+        # thumbnails are being displayed
+        self.prioritizeTimer = QTimer(self)
+        self.prioritizeTimer.setSingleShot(True)
+        self.prioritizeTimer.setInterval(200)
+        self.prioritizeTimer.timeout.connect(self.prioritizeThumbnails)
+        sbv.valueChanged.connect(self.scheduleThumbnailPrioritization)
+
+    def setModel(self, model: QAbstractItemModel) -> None:
+        super().setModel(model)
+        model.layoutChanged.connect(self.scheduleThumbnailPrioritization)
+        model.modelReset.connect(self.scheduleThumbnailPrioritization)
+
+    @pyqtSlot()
+    def scheduleThumbnailPrioritization(self) -> None:
+        self.prioritizeTimer.start()
+
+    @pyqtSlot()
+    def prioritizeThumbnails(self) -> None:
+        index = self.indexAt(QPoint(self.spacing(), self.spacing()))  # type: QModelIndex
+        if not index.isValid():
+            return
+        item_height = self.itemDelegate().fixedSizeHint.height() + self.spacing()
+        visible_rows = int(self.viewport().height() // item_height) + 2
+        first_row = index.row()
+        last_row = min(
+            first_row + visible_rows * max(self.user_visible_columns, 1) - 1,
+            self.model().rowCount() - 1,
+        )
+        self.model().prioritizeThumbnails(first_row, last_row)
+
     def setScrollTogether(self, on: bool) -> None:
         """
         Turn on or off the linking of scrolling the Timeline with the Thumbnail display.
@@ -2107,6 +2412,10 @@ class ThumbnailView(QListView):
             return indicies[index_min]
         return None
 
+    def rowIsVisible(self, row: int) -> bool:
+        rect = self.visualRect(self.model().index(row, 0))
+        return rect.isValid() and rect.intersects(self.viewport().rect())
+
     def topRowUid(self) -> Optional[bytes]:
         index = self.topRowIndex()
         if index:
@@ -2143,6 +2452,7 @@ class ThumbnailView(QListView):
         item_width = self.itemDelegate().fixedSizeHint.width() + self.spacing()
         view_width = self.viewport().contentsRect().width() - self.spacing() - 1
         self.user_visible_columns = view_width // item_width
+        self.scheduleThumbnailPrioritization()
 
     def scrollToUids(self, uids: List[bytes]) -> None:
         """
@@ -20,20 +20,22 @@ __author__ = "Damon Lynch"
 __copyright__ = "Copyright 2015-2022, Damon Lynch"
 
 import pickle
-from typing import Optional
+from typing import Optional, List
 import logging
 
 import zmq
 from PyQt5.QtCore import QThread, QTimer, pyqtSignal, pyqtBoundSignal, pyqtSlot, QObject
-from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtGui import QPixmap
 
 from raphodo.interprocess import (
     LoadBalancerManager,
     PublishPullPipelineManager,
     GenerateThumbnailsArguments,
     GenerateThumbnailsResults,
+    SentFiles,
     ThreadNames,
     create_inproc_msg,
+    thumbnail_to_pixmap,
 )
 from raphodo.rpdfile import RPDFile
 from raphodo.utilities import CacheDirs
@@ -57,20 +59,17 @@ class ThumbnailManagerPara(PublishPullPipelineManager):
         self._process_name = "Thumbnail Manager"
         self._process_to_run = "thumbnailpara.py"
         self._worker_id = 0
+        self.sent_files = SentFiles()
 
     def process_sink_data(self) -> None:
         data = pickle.loads(self.content)  # type: GenerateThumbnailsResults
         if data.rpd_file is not None:
-            if data.thumbnail_bytes is None:
-                thumbnail = QPixmap()
-            else:
-                thumbnail = QImage.fromData(data.thumbnail_bytes)
-                if thumbnail.isNull():
-                    thumbnail = QPixmap()
-                else:
-                    thumbnail = QPixmap.fromImage(thumbnail)
-
-            self.message.emit(data.rpd_file, thumbnail)
+            # Files thumbnailed by the thumbnail daemon arrive whole
+            rpd_file = self.sent_files.apply(data.rpd_file)
+            if rpd_file is None:
+                return
+            thumbnail = thumbnail_to_pixmap(data.thumbnail_bytes)
+            self.message.emit(rpd_file, thumbnail)
         elif data.camera_removed:
             assert data.scan_id is not None
             self.cameraRemoved.emit(data.scan_id)
@@ -167,6 +166,8 @@ class Thumbnailer(QObject):
         :param entire_photo_required: if the entire photo is required
          to extract the thumbnail
         """
+        for rpd_file in rpd_files:
+            self.thumbnail_manager.sent_files.add(rpd_file)
         self.thumbnailer_controller.send_multipart(
             create_inproc_msg(
                 b"START_WORKER",
@@ -190,6 +191,19 @@ class Thumbnailer(QObject):
             )
         )
 
+    def prioritizeThumbnails(self, scan_id: int, uids: List[bytes]) -> None:
+        """
+        Have the thumbnails of these files generated before any others from the
+        same device. Replaces any previous request for the device.
+
+        :param scan_id: worker id of the scan
+        :param uids: the files, most important first
+        """
+
+        self.thumbnailer_controller.send_multipart(
+            create_inproc_msg(b"PRIORITIZE", worker_id=scan_id, data=uids)
+        )
+
     @property
     def thumbnailReceived(self) -> pyqtBoundSignal:
         return self.thumbnail_manager.message
@@ -276,3 +290,13 @@ class Thumbnailer(QObject):
         self.thumbnailer_controller.send_multipart(
             create_inproc_msg(b"STOP_WORKER", worker_id=scan_id)
         )
+
+    def remove_sent_files(self, scan_id: int) -> None:
+        """
+        Stop tracking the files of a device whose thumbnails will no longer be
+        received, e.g. because its worker was stopped or the device was removed
+
+        :param scan_id: the device's scan id
+        """
+
+        self.thumbnail_manager.sent_files.remove(scan_id)
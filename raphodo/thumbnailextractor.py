@@ -26,15 +26,22 @@ import logging
 from urllib.request import pathname2url
 import pickle
 import os
+import fcntl
+import mmap
+import time
+import contextlib
 from collections import namedtuple
-from typing import Optional, Set, Union, Tuple
+from typing import Optional, Set, Union, Tuple, List, Dict
+
+import psutil
+import zmq
 
 import gi
 
 gi.require_version("Gst", "1.0")
 from gi.repository import Gst
 
-from PyQt5.QtGui import QImage, QTransform
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader, QTransform
 from PyQt5.QtCore import QSize, Qt, QIODevice, QBuffer
 
 
@@ -42,6 +49,7 @@ from raphodo.interprocess import (
     LoadBalancerWorker,
     ThumbnailExtractorArgument,
     GenerateThumbnailsResults,
+    raw_thumbnail,
 )
 
 from raphodo.constants import (
@@ -50,14 +58,25 @@ from raphodo.constants import (
     ExtractionProcessing,
     ThumbnailCacheStatus,
     ThumbnailCacheDiskStatus,
+    ThumbnailTransport,
+    thumbnail_transport,
 )
-from raphodo.rpdfile import RPDFile, Video, Photo
+from raphodo.rpdfile import RPDFile, RPDFileChanges, Video, Photo
 from raphodo.constants import FileType
 from raphodo.utilities import stdchannel_redirected, show_errors, image_large_enough_fdo
 from raphodo.ui.filmstrip import add_filmstrip
-from raphodo.cache import ThumbnailCacheSql, FdoCacheLarge, FdoCacheNormal
+from raphodo.cache import (
+    ThumbnailCacheSql,
+    FdoCacheLarge,
+    FdoCacheNormal,
+    thumbnail_to_jpeg,
+)
 import raphodo.metadata.exiftool as exiftool
-from raphodo.heif import have_heif_module, load_heif
+import raphodo.metadata.metadataphoto as metadataphoto
+from raphodo.heif import have_heif_module, load_heif, heif_image_size
+from raphodo.storage.storage import get_program_cache_directory
+from raphodo.rpdsql import PreviewOffsetSQL
+from raphodo.ioscheduler import IOScheduler
 
 
 have_gst = Gst.init_check(None)
@@ -134,9 +153,215 @@ def get_video_frame(
         return None
 
 
+class VideoFrameExtractor:
+    """
+    Extract the first frame of videos, scaled to thumbnail size.
+
+    One GStreamer pipeline is built and then reused for each video, by giving it a
+    new URI. Frames are scaled by GStreamer and received as raw pixels, so they
+    need not be encoded and decoded again.
+
+    If a video cannot be decoded within the timeout, the pipeline is discarded and
+    a new one is built for the next video.
+    """
+
+    # How long to wait for the frame of any one video, in seconds
+    timeout = 10
+
+    def __init__(self) -> None:
+        self.pipeline = None  # type: Optional[Gst.Pipeline]
+        self.appsink = None  # type: Optional[Gst.Element]
+        self.capsfilter = None  # type: Optional[Gst.Element]
+        # Gives the pixel layout of QImage.Format_RGB32
+        self.format = "BGRx" if sys.byteorder == "little" else "xRGB"
+
+    def _build_pipeline(self) -> None:
+        pipeline = Gst.ElementFactory.make("playbin", None)
+        # Decode video only: no audio or subtitles
+        pipeline.props.flags = 1
+        pipeline.props.audio_sink = Gst.ElementFactory.make("fakesink", None)
+
+        video_sink = Gst.Bin.new(None)
+        convert = Gst.ElementFactory.make("videoconvert", None)
+        scale = Gst.ElementFactory.make("videoscale", None)
+        self.capsfilter = Gst.ElementFactory.make("capsfilter", None)
+        self.appsink = Gst.ElementFactory.make("appsink", None)
+        self.appsink.props.sync = False
+        for element in (convert, scale, self.capsfilter, self.appsink):
+            video_sink.add(element)
+        convert.link(scale)
+        scale.link(self.capsfilter)
+        self.capsfilter.link(self.appsink)
+        video_sink.add_pad(Gst.GhostPad.new("sink", convert.get_static_pad("sink")))
+        pipeline.props.video_sink = video_sink
+
+        # Nothing reads the messages, so don't let them accumulate
+        pipeline.get_bus().set_flushing(True)
+        self.pipeline = pipeline
+
+    def _discard_pipeline(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = self.appsink = self.capsfilter = None
+
+    def get_frame(self, full_file_name: str, width: int) -> Optional[QImage]:
+        """
+        :param full_file_name: file and path of the video
+        :param width: the width to scale the frame to. Its height is scaled to keep
+         the frame's aspect ratio.
+        :return: the frame, or None if it could not be extracted
+        """
+
+        logging.debug("Using gstreamer to generate thumbnail from %s", full_file_name)
+
+        if self.pipeline is None:
+            self._build_pipeline()
+
+        self.capsfilter.props.caps = Gst.Caps.from_string(
+            "video/x-raw,format={},width={},pixel-aspect-ratio=1/1".format(
+                self.format, width
+            )
+        )
+        self.pipeline.props.uri = "file://{}".format(
+            pathname2url(os.path.abspath(full_file_name))
+        )
+
+        self.pipeline.set_state(Gst.State.PAUSED)
+        result = self.pipeline.get_state(self.timeout * Gst.SECOND)[0]
+        if result != Gst.StateChangeReturn.SUCCESS:
+            logging.warning(
+                "GStreamer could not open %s within %s seconds. Is the necessary "
+                "gstreamer plugin installed for this file format?",
+                full_file_name,
+                self.timeout,
+            )
+            self._discard_pipeline()
+            return None
+
+        sample = self.appsink.emit("try-pull-preroll", self.timeout * Gst.SECOND)
+        if sample is None:
+            self._discard_pipeline()
+            return None
+
+        structure = sample.get_caps().get_structure(0)
+        frame_width = structure.get_value("width")
+        frame_height = structure.get_value("height")
+        buffer = sample.get_buffer()
+        data = buffer.extract_dup(0, buffer.get_size())
+        # Ready the pipeline for the next video
+        self.pipeline.set_state(Gst.State.READY)
+
+        # Rows of four byte pixels need no padding
+        frame = QImage(
+            data, frame_width, frame_height, frame_width * 4, QImage.Format_RGB32
+        )
+        # Copy the pixels, because the image does not own them
+        return frame.copy()
+
+    def close(self) -> None:
+        self._discard_pipeline()
+
+
 PhotoDetails = namedtuple("PhotoDetails", "thumbnail, orientation")
 
 
+class DecodeMemoryBudget:
+    """
+    Throttle the decoding of large images, using a memory budget shared by every
+    thumbnail extractor process.
+
+    The budget is divided into slots, each of which is one byte of a lock file. A
+    decode holds a record lock on as many slots as the memory it needs, which the
+    kernel releases should the process holding it terminate.
+
+    The first byte of the lock file is the queue. Only the process holding it
+    acquires slots, keeping those it has while it waits for the rest, so that a
+    large decode is not starved by a succession of smaller ones. Processes waiting
+    for the queue block in the kernel rather than polling the slots.
+    """
+
+    slot_size = 32 * 1024 * 1024
+    lock_file_name = "decode_budget.lock"
+    # How long to wait before trying again to acquire the slots needed, in seconds
+    retry_delay = 0.05
+
+    def __init__(self) -> None:
+        # A quarter of physical memory, which is the same for every process
+        self.no_slots = max(1, psutil.virtual_memory().total // 4 // self.slot_size)
+        self.fd = None  # type: Optional[int]
+        cache_directory = get_program_cache_directory(create_if_not_exist=True)
+        if cache_directory is not None:
+            try:
+                self.fd = os.open(
+                    os.path.join(cache_directory, self.lock_file_name),
+                    os.O_RDWR | os.O_CREAT,
+                    0o600,
+                )
+            except OSError:
+                logging.error(
+                    "Unable to open the decode memory budget lock file in %s",
+                    cache_directory,
+                )
+
+    def _try_acquire(self, slots: List[int], no_slots: int) -> None:
+        """
+        Try to acquire the free slots not already held, until enough are held
+
+        :param slots: the slots held, to which those acquired are added
+        :param no_slots: how many slots are needed
+        """
+
+        for slot in range(1, self.no_slots + 1):
+            if len(slots) == no_slots:
+                return
+            if slot in slots:
+                continue
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+            except OSError:
+                continue
+            slots.append(slot)
+
+    def _release(self, slots: List[int]) -> None:
+        for slot in slots:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+
+    @contextlib.contextmanager
+    def reserve(self, size: int):
+        """
+        Wait until the memory is available in the budget, and hold it until the
+        context exits. A decode larger than the entire budget holds all of it.
+
+        :param size: memory needed, in bytes
+        """
+
+        if self.fd is None:
+            yield
+            return
+
+        no_slots = min(self.no_slots, max(1, -(-size // self.slot_size)))
+        slots = []  # type: List[int]
+        try:
+            # Wait for a turn to acquire slots. Holding slots while waiting cannot
+            # deadlock, because no other process is acquiring any.
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                self._try_acquire(slots, no_slots)
+                while len(slots) < no_slots:
+                    time.sleep(self.retry_delay)
+                    self._try_acquire(slots, no_slots)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+            yield
+        finally:
+            self._release(slots)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 def qimage_to_png_buffer(image: QImage) -> QBuffer:
     """
     Save the image data in PNG format in a QBuffer, whose data can then
@@ -152,6 +377,47 @@ def qimage_to_png_buffer(image: QImage) -> QBuffer:
     return buffer
 
 
+def load_reduced_image(source: Union[str, bytes, bytearray], min_size: int) -> QImage:
+    """
+    Load an image from a file or from memory. If the image is a JPEG, decode it
+    directly at the greatest power-of-two reduction (up to 1/8) whose longest side
+    remains larger than min_size, avoiding a full resolution decode when all that
+    is needed is a thumbnail.
+
+    libjpeg performs the reduction while decoding using DCT scaling, so the result
+    is still a full quality image, ready to be smoothly resized to its final size.
+
+    :param source: full path of the file, or the image data
+    :param min_size: the longest side of the image must remain larger than this
+    :return: the image, which will be null if it could not be loaded
+    """
+
+    if isinstance(source, str):
+        reader = QImageReader(source)
+    else:
+        buffer = QBuffer()
+        buffer.setData(source)
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+
+    if bytes(reader.format()) == b"jpeg" and reader.supportsOption(
+        QImageIOHandler.ScaledSize
+    ):
+        size = reader.size()
+        width, height = size.width(), size.height()
+        denominator = 1
+        while denominator < 8 and max(width, height) // (denominator * 2) > min_size:
+            denominator *= 2
+        if denominator > 1:
+            # Match libjpeg's own rounding, so the decoded image needs no further
+            # scaling by Qt
+            reader.setScaledSize(
+                QSize(-(-width // denominator), -(-height // denominator))
+            )
+
+    return reader.read()
+
+
 def crop_160x120_thumbnail(thumbnail: QImage, vertical_space: int = 8) -> QImage:
     """
     Remove black bands from the top and bottom of thumbnail
@@ -180,11 +446,26 @@ class ThumbnailExtractor(LoadBalancerWorker):
         max(ThumbnailSize.width, ThumbnailSize.height),
     )
 
+    # Size assumed for an image that must be fully decoded when its size cannot be
+    # determined without decoding it: 100 megapixels
+    unknown_image_width = 12288
+    unknown_image_height = 8192
+
     def __init__(self) -> None:
         self.thumbnailSizeNeeded = QSize(ThumbnailSize.width, ThumbnailSize.height)
         self.thumbnail_cache = ThumbnailCacheSql(create_table_if_not_exists=False)
         self.fdo_cache_large = FdoCacheLarge()
         self.fdo_cache_normal = FdoCacheNormal()
+        self.video_frames = VideoFrameExtractor()
+        self.decode_budget = DecodeMemoryBudget()
+        self.io_scheduler = IOScheduler()
+        self.preview_offsets = PreviewOffsetSQL()
+        # Camera models and extensions whose preview offset has already been
+        # learned by this process
+        self.preview_offsets_learned = set()  # type: Set[Tuple[str, str]]
+        # Key is the port of the process waiting to hear whether the previews were
+        # found in the exif buffers it sent
+        self.preview_reply_sockets = {}  # type: Dict[int, zmq.Socket]
 
         super().__init__("Thumbnail Extractor")
 
@@ -204,6 +485,60 @@ class ThumbnailExtractor(LoadBalancerWorker):
             thumbnail = thumbnail.transformed(QTransform().rotate(180))
         return thumbnail
 
+    def thumbnail_min_size(self, rpd_file: RPDFile) -> int:
+        """
+        :param rpd_file: file whose thumbnail will be generated
+        :return: size the longest side of a decoded image must remain larger than
+         to generate all the thumbnails needed for the file
+        """
+
+        if rpd_file.should_write_fdo():
+            return 256
+        return self.maxStandardSize.width()
+
+    def load_large_image(
+        self, rpd_file: RPDFile, full_file_name: str
+    ) -> Optional[QImage]:
+        """
+        Load a HEIF / HEIC or TIFF, which must be fully decoded, once the memory
+        needed to do so is available in the budget shared by all thumbnail extractors.
+
+        :param rpd_file: file details
+        :param full_file_name: full name of the file to load
+        :return: the image, or None if it could not be loaded
+        """
+
+        if rpd_file.is_heif():
+            size = heif_image_size(full_file_name)
+            # The decoded image is copied into Pillow and then into Qt
+            copies = 3
+        else:
+            size = QImageReader(full_file_name).size()
+            size = (size.width(), size.height()) if size.isValid() else None
+            # The decoded image and its converted or resized copy
+            copies = 2
+        if size is None:
+            # The file size says little about how large the decoded image is, given
+            # how well HEIF and TIFF can compress, so assume a very large image
+            size = (self.unknown_image_width, self.unknown_image_height)
+        required = size[0] * size[1] * 4 * copies
+
+        with self.decode_budget.reserve(required):
+            if required > psutil.virtual_memory().available:
+                logging.warning(
+                    "Not enough memory to generate a thumbnail for %s",
+                    rpd_file.full_file_name,
+                )
+                return None
+            if rpd_file.is_heif():
+                return load_heif(full_file_name, process_name=self.identity.decode())
+            thumbnail = load_reduced_image(
+                full_file_name, self.thumbnail_min_size(rpd_file)
+            )
+            if thumbnail.isNull():
+                return None
+            return thumbnail
+
     def image_large_enough(self, size: QSize) -> bool:
         """Check if image is equal or bigger than thumbnail size."""
 
@@ -222,7 +557,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
         thumbnail = None
         data = rpd_file.metadata.get_preview_256()
         if isinstance(data, bytes):
-            thumbnail = QImage.fromData(data)
+            thumbnail = load_reduced_image(data, 256)
             if thumbnail.isNull():
                 thumbnail = None
             else:
@@ -259,7 +594,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
 
         preview = rpd_file.metadata.get_small_thumbnail_or_first_indexed_preview()
         if preview:
-            thumbnail = QImage.fromData(preview)
+            thumbnail = load_reduced_image(preview, self.thumbnail_min_size(rpd_file))
             if thumbnail.isNull():
                 thumbnail = None
             else:
@@ -281,6 +616,85 @@ class ThumbnailExtractor(LoadBalancerWorker):
 
         return PhotoDetails(thumbnail, orientation)
 
+    def learn_preview_offset(self, rpd_file: Photo, full_file_name: str) -> None:
+        """
+        Record how much of the start of the file must be read to get both its
+        metadata and the preview used for its thumbnail, so that no more than that
+        need be read from other files of the same format from the same camera.
+
+        Only recorded if GExiv2 can get the same metadata and preview from that
+        much of the file alone.
+
+        Files on a camera are learned for the camera's model, as known to gPhoto2,
+        which is how they are looked up. Other files are learned for the camera
+        model in their metadata.
+
+        Learned once per camera model and extension, unless the file was cached in
+        its entirety from a camera, which is done when the preview was not in the
+        part of the file read using the offset learned so far.
+
+        :param rpd_file: file details, with its metadata loaded
+        :param full_file_name: the complete file on disk
+        """
+
+        metadata = rpd_file.metadata
+        if not isinstance(metadata, metadataphoto.MetaData):
+            return
+        if rpd_file.from_camera and rpd_file.camera_model:
+            key = (rpd_file.camera_model, rpd_file.extension)
+        else:
+            key = (metadata.camera_model(), rpd_file.extension)
+        relearn = full_file_name == rpd_file.cache_full_file_name
+        if key in self.preview_offsets_learned and not relearn:
+            return
+        self.preview_offsets_learned.add(key)
+
+        previews = [metadata.get_small_thumbnail_or_first_indexed_preview()]
+        if self.write_fdo_thumbnail and rpd_file.fdo_thumbnail_256 is None:
+            previews.append(metadata.get_preview_256())
+
+        offset = 0
+        try:
+            with open(full_file_name, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for preview in previews:
+                        if not preview:
+                            return
+                        # Previews that GExiv2 assembled from several parts of the
+                        # file will not be found
+                        position = data.find(preview[:1024])
+                        if (
+                            position < 0
+                            or data[position : position + len(preview)] != preview
+                        ):
+                            return
+                        offset = max(offset, position + len(preview))
+                    extract = bytearray(data[:offset])
+        except (OSError, ValueError):
+            return
+
+        try:
+            partial = metadataphoto.MetaData(
+                et_process=self.exiftool_process, raw_bytes=extract
+            )
+            usable = (
+                partial.orientation() == metadata.orientation()
+                and partial.timestamp(missing=None) == metadata.timestamp(missing=None)
+                and partial.get_small_thumbnail_or_first_indexed_preview()
+                == previews[0]
+            )
+        except Exception:
+            usable = False
+
+        if usable:
+            logging.debug(
+                "Learned that %s bytes are needed for %s files from camera %s",
+                offset,
+                rpd_file.extension,
+                key[0] or "unknown",
+            )
+            self.preview_offsets.add_offset(key[0], key[1], offset)
+
     def get_disk_photo_thumb(
         self,
         rpd_file: Photo,
@@ -311,16 +725,30 @@ class ThumbnailExtractor(LoadBalancerWorker):
 
             photo_details = self._extract_metadata(rpd_file, processing)
             thumbnail = photo_details.thumbnail
+            if (
+                thumbnail is not None
+                and rpd_file.is_tiff()
+                and not self.image_large_enough(thumbnail.size())
+            ):
+                # Better to decode the TIFF itself than to use a tiny preview
+                thumbnail = None
+            elif thumbnail is not None and not rpd_file.is_tiff():
+                self.learn_preview_offset(rpd_file, full_file_name)
 
         if thumbnail is not None:
             return photo_details
 
         if rpd_file.is_loadable():
-            thumbnail = QImage(full_file_name)
+            if rpd_file.is_tiff():
+                thumbnail = self.load_large_image(rpd_file, full_file_name)
+            else:
+                thumbnail = load_reduced_image(
+                    full_file_name, self.thumbnail_min_size(rpd_file)
+                )
             processing.add(ExtractionProcessing.resize)
             if not rpd_file.from_camera:
                 processing.remove(ExtractionProcessing.orient)
-            if thumbnail.isNull():
+            if thumbnail is None or thumbnail.isNull():
                 thumbnail = None
                 logging.warning(
                     "Unable to create a thumbnail out of the file: {}".format(
@@ -508,7 +936,14 @@ class ThumbnailExtractor(LoadBalancerWorker):
             ExtractionTask.load_file_and_exif_directly,
             ExtractionTask.load_file_directly_metadata_from_secondary,
         ):
-            thumbnail = QImage(data.full_file_name_to_work_on)
+            if rpd_file.is_tiff():
+                thumbnail = self.load_large_image(
+                    rpd_file, data.full_file_name_to_work_on
+                )
+            else:
+                thumbnail = load_reduced_image(
+                    data.full_file_name_to_work_on, self.thumbnail_min_size(rpd_file)
+                )
 
             if task == ExtractionTask.load_file_and_exif_directly:
                 self.assign_photo_mdatatime(
@@ -541,7 +976,9 @@ class ThumbnailExtractor(LoadBalancerWorker):
                     "Thumbnail bytes not extracted for %s (value is None)",
                     rpd_file.get_current_full_file_name(),
                 )
-            thumbnail = QImage.fromData(data.thumbnail_bytes)
+            thumbnail = load_reduced_image(
+                data.thumbnail_bytes, self.thumbnail_min_size(rpd_file)
+            )
             if (
                 thumbnail.width() > self.thumbnailSizeNeeded.width()
                 or thumbnail.height() > self.thumbnailSizeNeeded.height()
@@ -577,9 +1014,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
             ExtractionTask.load_heif_and_exif_directly,
         ):
             assert have_heif_module
-            thumbnail = load_heif(
-                data.full_file_name_to_work_on, process_name=self.identity.decode()
-            )
+            thumbnail = self.load_large_image(rpd_file, data.full_file_name_to_work_on)
 
             if task == ExtractionTask.load_heif_and_exif_directly:
                 self.assign_photo_mdatatime(
@@ -609,7 +1044,9 @@ class ThumbnailExtractor(LoadBalancerWorker):
                     rpd_file.metadata.get_small_thumbnail_or_first_indexed_preview()
                 )
                 if thumbnail_bytes:
-                    thumbnail = QImage.fromData(thumbnail_bytes)
+                    thumbnail = load_reduced_image(
+                        thumbnail_bytes, self.thumbnail_min_size(rpd_file)
+                    )
                     orientation = rpd_file.metadata.orientation()
             else:
                 assert rpd_file.file_type == FileType.video
@@ -621,28 +1058,52 @@ class ThumbnailExtractor(LoadBalancerWorker):
                 if not have_gst:
                     thumbnail = None
                 else:
-                    png = get_video_frame(data.full_file_name_to_work_on, 1.0)
-                    if not png:
+                    # Large enough for the freedesktop.org thumbnail too, if needed
+                    thumbnail = self.video_frames.get_frame(
+                        data.full_file_name_to_work_on,
+                        self.thumbnail_min_size(rpd_file),
+                    )
+                    if thumbnail is None or thumbnail.isNull():
                         thumbnail = None
                         logging.warning(
                             "Could not extract video thumbnail from %s",
                             data.rpd_file.get_display_full_name(),
                         )
                     else:
-                        thumbnail = QImage.fromData(png)
-                        if thumbnail.isNull():
-                            thumbnail = None
-                        else:
-                            processing.add(ExtractionProcessing.add_film_strip)
-                            orientation = self.get_video_rotation(
-                                rpd_file, data.full_file_name_to_work_on
-                            )
-                            if orientation is not None:
-                                processing.add(ExtractionProcessing.orient)
-                            processing.add(ExtractionProcessing.resize)
+                        processing.add(ExtractionProcessing.add_film_strip)
+                        orientation = self.get_video_rotation(
+                            rpd_file, data.full_file_name_to_work_on
+                        )
+                        if orientation is not None:
+                            processing.add(ExtractionProcessing.orient)
+                        processing.add(ExtractionProcessing.resize)
 
         return thumbnail, orientation
 
+    def report_preview(self, data: ThumbnailExtractorArgument, found: bool) -> None:
+        """
+        Report whether the photo's preview was found in the exif buffer to the
+        process that sent it, once per photo
+
+        :param data: the extraction task, which has the port to report on
+        :param found: whether the preview was found
+        """
+
+        port = data.preview_reply_port
+        data.preview_reply_port = None
+        socket = self.preview_reply_sockets.get(port)
+        if socket is None:
+            socket = self.context.socket(zmq.PUSH)
+            socket.connect("tcp://localhost:{}".format(port))
+            self.preview_reply_sockets[port] = socket
+        try:
+            socket.send_multipart(
+                [data.rpd_file.uid, b"1" if found else b"0"], zmq.NOBLOCK
+            )
+        except zmq.Again:
+            # The process is no longer receiving, e.g. because it was stopped
+            pass
+
     def process_files(self):
         """
         Loop continuously processing photo and video thumbnails
@@ -657,10 +1118,13 @@ class ThumbnailExtractor(LoadBalancerWorker):
 
             data = pickle.loads(content)  # type: ThumbnailExtractorArgument
 
-            thumbnail_256 = png_data = None
+            thumbnail_256 = thumbnail_data = None
             task = data.task
             processing = data.processing
             rpd_file = data.rpd_file
+            if data.received_state is not None:
+                # Report changes relative to the file the main process sent
+                rpd_file.received_state = data.received_state
 
             logging.debug(
                 "Working on task %s for %s",
@@ -683,13 +1147,26 @@ class ThumbnailExtractor(LoadBalancerWorker):
                     )
                     orientation_unknown = False
                 else:
+                    if data.full_file_name_to_work_on:
+                        # Read between the files being downloaded from or to the
+                        # same device
+                        self.io_scheduler.wait_for_turn(data.full_file_name_to_work_on)
                     thumbnail, orientation = self.extract_thumbnail(
                         task, rpd_file, processing, data
                     )
+                    if data.preview_reply_port is not None:
+                        preview_found = thumbnail is not None
+                        self.report_preview(data, preview_found)
+                        if not preview_found:
+                            # The photo will be sent again in its entirety
+                            continue
                     if data.file_to_work_on_is_temporary:
                         os.remove(data.full_file_name_to_work_on)
                         rpd_file.temp_cache_full_file_chunk = ""
 
+                    # Whether the orientation has already been applied to the
+                    # thumbnails
+                    oriented = False
                     if thumbnail is not None:
                         if ExtractionProcessing.strip_bars_photo in processing:
                             thumbnail = crop_160x120_thumbnail(thumbnail)
@@ -712,17 +1189,31 @@ class ThumbnailExtractor(LoadBalancerWorker):
                                 if (
                                     rpd_file.should_write_fdo()
                                     and image_large_enough_fdo(thumbnail.size())
-                                    and max(thumbnail.height(), thumbnail.width()) > 256
+                                    and max(thumbnail.height(), thumbnail.width())
+                                    >= 256
                                 ):
                                     thumbnail_256 = thumbnail.scaled(
                                         QSize(256, 256),
                                         Qt.KeepAspectRatio,
                                         Qt.SmoothTransformation,
                                     )
+                                    if orientation is not None:
+                                        # Orient only once: the smaller thumbnails
+                                        # are scaled from the oriented one
+                                        thumbnail_256 = self.rotate_thumb(
+                                            thumbnail_256, orientation
+                                        )
+                                        oriented = True
                                     thumbnail = thumbnail_256
                                 if data.send_thumb_to_main:
+                                    size = self.thumbnailSizeNeeded
+                                    if oriented and orientation in (
+                                        self.rotate_90,
+                                        self.rotate_270,
+                                    ):
+                                        size = size.transposed()
                                     thumbnail = thumbnail.scaled(
-                                        self.thumbnailSizeNeeded,
+                                        size,
                                         Qt.KeepAspectRatio,
                                         Qt.SmoothTransformation,
                                     )
@@ -732,7 +1223,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
                             if not thumbnail is None and thumbnail.isNull():
                                 thumbnail = None
 
-                    if orientation is not None:
+                    if orientation is not None and not oriented:
                         if thumbnail is not None:
                             thumbnail = self.rotate_thumb(thumbnail, orientation)
                         if thumbnail_256 is not None:
@@ -746,21 +1237,30 @@ class ThumbnailExtractor(LoadBalancerWorker):
                         if thumbnail_256 is not None:
                             thumbnail = add_filmstrip(thumbnail_256)
 
-                    if thumbnail is not None:
-                        buffer = qimage_to_png_buffer(thumbnail)
-                        png_data = buffer.data()
+                    save_to_cache = (
+                        data.send_thumb_to_main
+                        and data.use_thumbnail_cache
+                        and rpd_file.thumbnail_cache_status
+                        == ThumbnailCacheDiskStatus.not_found
+                    )
+
+                    thumbnail_jpeg = None
+                    if thumbnail is not None and data.send_thumb_to_main:
+                        # Encode the thumbnail at most once
+                        if thumbnail_transport == ThumbnailTransport.jpeg:
+                            thumbnail_jpeg = thumbnail_to_jpeg(thumbnail)
+                            thumbnail_data = thumbnail_jpeg
+                        else:
+                            thumbnail_data = raw_thumbnail(thumbnail)
+                            if save_to_cache:
+                                thumbnail_jpeg = thumbnail_to_jpeg(thumbnail)
 
                     orientation_unknown = (
                         ExtractionProcessing.orient in processing
                         and orientation is None
                     )
 
-                    if (
-                        data.send_thumb_to_main
-                        and data.use_thumbnail_cache
-                        and rpd_file.thumbnail_cache_status
-                        == ThumbnailCacheDiskStatus.not_found
-                    ):
+                    if save_to_cache:
                         self.thumbnail_cache.save_thumbnail(
                             full_file_name=rpd_file.full_file_name,
                             size=rpd_file.size,
@@ -770,6 +1270,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
                             orientation_unknown=orientation_unknown,
                             thumbnail=thumbnail,
                             camera_model=rpd_file.camera_model,
+                            thumbnail_jpeg=thumbnail_jpeg,
                         )
 
                 if (
@@ -835,6 +1336,9 @@ class ThumbnailExtractor(LoadBalancerWorker):
                 self.exiftool_process.terminate()
                 sys.exit(e)
             except:
+                if data.preview_reply_port is not None:
+                    # Don't keep the process that sent the photo waiting
+                    self.report_preview(data, True)
                 logging.error("Exception working on file %s", rpd_file.full_file_name)
                 logging.error("Task: %s", task)
                 logging.error("Processing tasks: %s", processing)
@@ -842,15 +1346,17 @@ class ThumbnailExtractor(LoadBalancerWorker):
 
             # Purge metadata, as it cannot be pickled
             if not data.send_thumb_to_main:
-                png_data = None
+                thumbnail_data = None
             rpd_file.metadata = None
+            if data.received_state is not None:
+                rpd_file = RPDFileChanges(rpd_file)
             self.sender.send_multipart(
                 [
                     b"0",
                     b"data",
                     pickle.dumps(
                         GenerateThumbnailsResults(
-                            rpd_file=rpd_file, thumbnail_bytes=png_data
+                            rpd_file=rpd_file, thumbnail_bytes=thumbnail_data
                         ),
                         pickle.HIGHEST_PROTOCOL,
                     ),
@@ -874,6 +1380,9 @@ class ThumbnailExtractor(LoadBalancerWorker):
             self.exiftool_process = exiftool.ExifTool()
             self.exiftool_process.start()
             self.process_files()
+            self.video_frames.close()
+            self.decode_budget.close()
+            self.io_scheduler.close()
             self.exit()
 
     def cleanup_pre_stop(self) -> None:
@@ -882,6 +1391,7 @@ class ThumbnailExtractor(LoadBalancerWorker):
             self.identity.decode(),
         )
         self.exiftool_process.terminate()
+        self.video_frames.close()
 
 
 if __name__ == "__main__":
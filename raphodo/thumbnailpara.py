@@ -52,16 +52,17 @@ import os
 import sys
 import logging
 import pickle
+import time
+import contextlib
 from collections import deque
 from operator import attrgetter
-from typing import Optional, Tuple, Set
+from typing import Optional, Tuple, Set, List, Dict, Deque, Iterator
 
 import zmq
-from PyQt5.QtGui import QImage
 from PyQt5.QtCore import QSize
 import psutil
 
-from raphodo.rpdfile import RPDFile
+from raphodo.rpdfile import RPDFile, RPDFileChanges
 from raphodo.interprocess import (
     WorkerInPublishPullPipeline,
     GenerateThumbnailsArguments,
@@ -83,12 +84,14 @@ from raphodo.constants import (
     thumbnail_offset_exiftool,
 )
 from raphodo.camera import Camera, CameraProblemEx, gphoto2_python_logging
-from raphodo.cache import ThumbnailCacheSql, FdoCacheLarge
+from raphodo.cache import ThumbnailCacheSql, FdoCacheLarge, GetCachedThumbnail
 from raphodo.utilities import GenerateRandomFileName, create_temp_dir, CacheDirs
 from raphodo.prefs.preferences import Preferences
 from raphodo.rescan import RescanCamera
 from raphodo.metadata.fileformats import use_exiftool_on_photo
 from raphodo.heif import have_heif_module
+from raphodo.rpdsql import PreviewOffsetSQL
+from raphodo.ioscheduler import IOScheduler
 
 
 def cache_dir_name(device_name: str) -> str:
@@ -172,6 +175,46 @@ def get_temporal_gaps_and_sequences(rpd_files, temporal_span):
     return None
 
 
+class ThumbnailQueue:
+    """
+    Files whose thumbnails are yet to be extracted.
+
+    Files are taken in the order they were added, except for those the main
+    process has asked be done first, e.g. because they are being displayed.
+    """
+
+    def __init__(self) -> None:
+        self.order = deque()  # type: Deque[RPDFile]
+        # uid: RPDFile
+        self.remaining = {}  # type: Dict[bytes, RPDFile]
+        self.priority = deque()  # type: Deque[bytes]
+
+    def __len__(self) -> int:
+        return len(self.remaining)
+
+    def extend(self, rpd_files: List[RPDFile]) -> None:
+        self.order.extend(rpd_files)
+        self.remaining.update((rpd_file.uid, rpd_file) for rpd_file in rpd_files)
+
+    def prioritize(self, uids: List[bytes]) -> None:
+        """
+        :param uids: files to take next, most important first. Replaces any
+         previous list.
+        """
+
+        self.priority = deque(uids)
+
+    def pop(self) -> RPDFile:
+        while self.priority:
+            rpd_file = self.remaining.pop(self.priority.popleft(), None)
+            if rpd_file is not None:
+                return rpd_file
+        while True:
+            rpd_file = self.order.popleft()
+            if self.remaining.pop(rpd_file.uid, None) is not None:
+                return rpd_file
+
+
 class GetThumbnailFromCache:
     """
     Try to get thumbnail from Rapid Photo Downloader's thumbnail cache
@@ -197,6 +240,63 @@ class GetThumbnailFromCache:
             or size.height() >= self.thumbnail_size_needed.height()
         )
 
+    @staticmethod
+    def apply_thumbnail_cache_status(
+        rpd_file: RPDFile, get_thumbnail: GetCachedThumbnail
+    ) -> bool:
+        """
+        Record in the file the result of looking for its thumbnail in the
+        Rapid Photo Downloader thumbnail cache.
+
+        :param rpd_file: file whose thumbnail was looked for
+        :param get_thumbnail: the result of the lookup
+        :return: True if the thumbnail was found or is known to have failed,
+         else False
+        """
+
+        rpd_file.thumbnail_cache_status = get_thumbnail.disk_status
+        if get_thumbnail.disk_status == ThumbnailCacheDiskStatus.failure:
+            rpd_file.thumbnail_status = ThumbnailCacheStatus.generation_failed
+        elif get_thumbnail.disk_status == ThumbnailCacheDiskStatus.found:
+            if get_thumbnail.orientation_unknown:
+                rpd_file.thumbnail_status = ThumbnailCacheStatus.orientation_unknown
+            else:
+                rpd_file.thumbnail_status = ThumbnailCacheStatus.ready
+        return get_thumbnail.disk_status != ThumbnailCacheDiskStatus.not_found
+
+    def get_from_thumbnail_cache(
+        self, rpd_files: List[RPDFile]
+    ) -> Iterator[GetCachedThumbnail]:
+        """
+        Look up the thumbnails of all the files in the Rapid Photo Downloader
+        thumbnail cache in bulk, recording the result in each file.
+
+        The thumbnails are read in chunks as they are iterated over, so only a few
+        are in memory at once.
+
+        :param rpd_files: files whose thumbnails are needed
+        :return: for each file, in the order passed, the result of the lookup
+        """
+
+        if self.thumbnail_cache is None:
+            yield from [ThumbnailCacheSql.not_found] * len(rpd_files)
+            return
+
+        get_thumbnails = self.thumbnail_cache.get_thumbnails(
+            [
+                (
+                    rpd_file.full_file_name,
+                    rpd_file.modification_time,
+                    rpd_file.size,
+                    rpd_file.camera_model,
+                )
+                for rpd_file in rpd_files
+            ]
+        )
+        for rpd_file, get_thumbnail in zip(rpd_files, get_thumbnails):
+            self.apply_thumbnail_cache_status(rpd_file, get_thumbnail)
+            yield get_thumbnail
+
     def get_from_cache(
         self, rpd_file: RPDFile, use_thumbnail_cache: bool = True
     ) -> Tuple[ExtractionTask, bytes, str, ThumbnailCacheOrigin]:
@@ -205,7 +305,9 @@ class GetThumbnailFromCache:
         thumbnail cache or from the FreeDesktop.org 256x256 thumbnail cache.
 
         :param rpd_file:
-        :param use_thumbnail_cache: whether to use the
+        :param use_thumbnail_cache: whether to use the Rapid Photo Downloader
+         thumbnail cache, e.g. False if get_from_thumbnail_cache() has already
+         looked for the thumbnail there
         :return:
         """
 
@@ -217,50 +319,37 @@ class GetThumbnailFromCache:
         # Attempt to get thumbnail from Thumbnail Cache
         # (see cache.py for definitions of various caches)
         if self.thumbnail_cache is not None and use_thumbnail_cache:
-            get_thumbnail = self.thumbnail_cache.get_thumbnail_path(
+            get_thumbnail = self.thumbnail_cache.get_thumbnail(
                 full_file_name=rpd_file.full_file_name,
                 mtime=rpd_file.modification_time,
                 size=rpd_file.size,
                 camera_model=rpd_file.camera_model,
             )
-            rpd_file.thumbnail_cache_status = get_thumbnail.disk_status
-            if get_thumbnail.disk_status != ThumbnailCacheDiskStatus.not_found:
+            if self.apply_thumbnail_cache_status(rpd_file, get_thumbnail):
                 origin = ThumbnailCacheOrigin.thumbnail_cache
                 task = ExtractionTask.bypass
-                if get_thumbnail.disk_status == ThumbnailCacheDiskStatus.failure:
-                    rpd_file.thumbnail_status = ThumbnailCacheStatus.generation_failed
-                    rpd_file.thumbnail_cache_status = ThumbnailCacheDiskStatus.failure
-                elif get_thumbnail.disk_status == ThumbnailCacheDiskStatus.found:
-                    rpd_file.thumbnail_cache_status = ThumbnailCacheDiskStatus.found
-                    if get_thumbnail.orientation_unknown:
-                        rpd_file.thumbnail_status = (
-                            ThumbnailCacheStatus.orientation_unknown
-                        )
-                    else:
-                        rpd_file.thumbnail_status = ThumbnailCacheStatus.ready
-                    with open(get_thumbnail.path, "rb") as thumbnail:
-                        thumbnail_bytes = thumbnail.read()
+                thumbnail_bytes = get_thumbnail.thumbnail_bytes
 
         # Attempt to get thumbnail from large FDO Cache if not found in Thumbnail Cache
         # and it's not being downloaded directly from a camera (if it's from a camera,
         # it's not going to be in the FDO cache)
 
         if task == ExtractionTask.undetermined and not rpd_file.from_camera:
+            # Only the thumbnail's size is needed here: the extractor loads it
             get_thumbnail = self.fdo_cache_large.get_thumbnail(
                 full_file_name=rpd_file.full_file_name,
                 modification_time=rpd_file.modification_time,
                 size=rpd_file.size,
                 camera_model=rpd_file.camera_model,
+                read_thumbnail=False,
             )
             if get_thumbnail.disk_status == ThumbnailCacheDiskStatus.found:
                 rpd_file.fdo_thumbnail_256_name = get_thumbnail.path
-                thumb = get_thumbnail.thumbnail  # type: QImage
-                if thumb is not None:
-                    if self.image_large_enough(thumb.size()):
-                        task = ExtractionTask.load_file_directly
-                        full_file_name_to_work_on = get_thumbnail.path
-                        origin = ThumbnailCacheOrigin.fdo_cache
-                        rpd_file.thumbnail_status = ThumbnailCacheStatus.fdo_256_ready
+                if self.image_large_enough(get_thumbnail.size):
+                    task = ExtractionTask.load_file_directly
+                    full_file_name_to_work_on = get_thumbnail.path
+                    origin = ThumbnailCacheOrigin.fdo_cache
+                    rpd_file.thumbnail_status = ThumbnailCacheStatus.fdo_256_ready
 
         return task, thumbnail_bytes, full_file_name_to_work_on, origin
 
@@ -269,9 +358,72 @@ class GetThumbnailFromCache:
 # by they kernel
 cached_read = dict(cr2=260 * 1024, dng=504 * 1024, nef=400 * 1024)
 
+# Extra to read beyond a learned preview offset, because the position of the preview
+# varies a little from file to file
+learned_offset_margin = 64 * 1024
+
+
+class PreviewOffsets:
+    """
+    How much of the start of a photo must be read to get both its metadata and its
+    preview, as learned by the thumbnail extractors from previous files of the same
+    format from the same camera.
+
+    Files on a camera are looked up by the camera's model. The model of the camera
+    that took a file on a memory card or in a folder is not known until its
+    metadata is read, so those files use the most learned for any camera.
+    """
+
+    # Minimum time between reloading the offsets when one is missing, in seconds
+    reload_interval = 2.0
+
+    def __init__(self) -> None:
+        self.sql = PreviewOffsetSQL()
+        self.load()
+
+    def load(self) -> None:
+        self.offsets = self.sql.get_offsets()
+        # The most learned for each extension, for any camera
+        self.largest = {}  # type: Dict[str, int]
+        for (camera, extension), offset in self.offsets.items():
+            self.largest[extension] = max(offset, self.largest.get(extension, 0))
+        self.loaded = time.monotonic()
+
+    def learned(self, rpd_file: RPDFile) -> Optional[int]:
+        if rpd_file.from_camera and rpd_file.camera_model:
+            return self.offsets.get((rpd_file.camera_model, rpd_file.extension))
+        return self.largest.get(rpd_file.extension)
+
+    def bytes_to_read(
+        self, rpd_file: RPDFile, fixed: Optional[int] = None
+    ) -> Optional[int]:
+        """
+        :param rpd_file: photo whose preview is needed
+        :param fixed: how many bytes would be read were nothing learned
+        :return: how many bytes to read from the start of the file, which is never
+         less than the fixed amount, or None if nothing has been learned and there
+         is no fixed amount
+        """
+
+        offset = self.learned(rpd_file)
+        if offset is None and time.monotonic() - self.loaded > self.reload_interval:
+            # An extractor may have learned it since the offsets were loaded
+            self.load()
+            offset = self.learned(rpd_file)
+        if offset is None:
+            if fixed is None:
+                return None
+            offset = fixed
+        else:
+            offset = max(offset + learned_offset_margin, fixed or 0)
+        return min(rpd_file.size, offset)
+
 
 def preprocess_thumbnail_from_disk(
-    rpd_file: RPDFile, processing: Set[ExtractionProcessing]
+    rpd_file: RPDFile,
+    processing: Set[ExtractionProcessing],
+    preview_offsets: Optional[PreviewOffsets] = None,
+    io_scheduler: Optional[IOScheduler] = None,
 ) -> ExtractionTask:
     """
     Determine how to get a thumbnail from a photo or video that is not on a camera
@@ -282,13 +434,22 @@ def preprocess_thumbnail_from_disk(
 
     :param rpd_file: details about file from which to get thumbnail from
     :param processing: set that holds processing tasks for the extractors to perform
+    :param preview_offsets: if specified, how much of the file has been learned to
+     be needed to get its preview
+    :param io_scheduler: if specified, used to take turns reading from the device
+     the file is on
     :return: extraction task required
     """
 
     if rpd_file.file_type == FileType.photo:
         if rpd_file.is_heif():
             if have_heif_module:
-                bytes_to_read = rpd_file.size
+                # The entire file must be decoded. The extractor waits until there is
+                # enough memory to do so.
+                if rpd_file.size <= psutil.virtual_memory().available:
+                    bytes_to_read = rpd_file.size
+                else:
+                    bytes_to_read = 0
                 if rpd_file.mdatatime:
                     task = ExtractionTask.load_heif_directly
                 else:
@@ -301,20 +462,12 @@ def preprocess_thumbnail_from_disk(
                 task = ExtractionTask.bypass
                 bytes_to_read = 0
         elif rpd_file.is_tiff():
-            available = psutil.virtual_memory().available
-            if rpd_file.size <= available:
-                bytes_to_read = rpd_file.size
-                if rpd_file.mdatatime:
-                    task = ExtractionTask.load_file_directly
-                else:
-                    task = ExtractionTask.load_file_and_exif_directly
-                processing.add(ExtractionProcessing.resize)
-            else:
-                # Don't try to extract a thumbnail from
-                # a file that is larger than available
-                # memory
-                task = ExtractionTask.bypass
-                bytes_to_read = 0
+            # Use a preview in the TIFF's metadata if it has one large enough. Only
+            # if it does not will the extractor decode the TIFF itself, once there
+            # is enough memory to do so.
+            task = ExtractionTask.load_from_exif
+            processing.add(ExtractionProcessing.orient)
+            bytes_to_read = cached_read.get(rpd_file.extension, 400 * 1024)
         else:
             if rpd_file.is_jpeg() and rpd_file.from_camera and rpd_file.is_mtp_device:
                 # jpeg photos from smartphones don't have embedded thumbnails
@@ -324,11 +477,17 @@ def preprocess_thumbnail_from_disk(
                 task = ExtractionTask.load_from_exif
             processing.add(ExtractionProcessing.orient)
             bytes_to_read = cached_read.get(rpd_file.extension, 400 * 1024)
+            if preview_offsets is not None:
+                bytes_to_read = preview_offsets.bytes_to_read(rpd_file, bytes_to_read)
 
         if bytes_to_read:
             if not rpd_file.download_full_file_name:
+                if io_scheduler is None:
+                    turn = contextlib.suppress()
+                else:
+                    turn = io_scheduler.read(rpd_file.full_file_name)
                 try:
-                    with open(rpd_file.full_file_name, "rb") as photo:
+                    with turn, open(rpd_file.full_file_name, "rb") as photo:
                         # Bring the file into the operating system's disk cache
                         photo.read(bytes_to_read)
                 except FileNotFoundError:
@@ -357,8 +516,27 @@ def preprocess_thumbnail_from_disk(
 
 
 class GenerateThumbnails(WorkerInPublishPullPipeline):
+    # How many extraction tasks to queue before waiting, so that those not yet sent
+    # can still be reprioritized
+    frontend_hwm = 10
+    # How often to check for commands while waiting to send an extraction task, in
+    # milliseconds
+    send_poll_interval = 100
+    # How long to wait for the thumbnail extractors to report whether they found
+    # the previews in the parts of photos read from the camera, in seconds
+    preview_reply_timeout = 60.0
+
     def __init__(self) -> None:
         self.random_file_name = GenerateRandomFileName()
+        self.queue = ThumbnailQueue()
+        # Files sent to the extractors with only the start of the file, keyed by
+        # uid, and the uids of those whose preview was not in it
+        self.awaiting_preview = {}  # type: Dict[bytes, RPDFile]
+        self.preview_missing = set()  # type: Set[bytes]
+        self.preview_replies = None  # type: Optional[zmq.Socket]
+        self.preview_reply_port = None  # type: Optional[int]
+        # Send back only what changed in the files received from the main process
+        RPDFile.track_changes = True
         super().__init__("Thumbnails")
 
     def cache_full_size_file_from_camera(self, rpd_file: RPDFile) -> bool:
@@ -382,7 +560,6 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
                 dest_full_filename=cache_full_file_name,
                 progress_callback=None,
                 check_for_command=self.check_for_controller_directive,
-                return_file_bytes=False,
             )
         except CameraProblemEx as e:
             # TODO report error
@@ -474,6 +651,85 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
 
         return task, full_file_name_to_work_on, file_to_work_on_is_temporary
 
+    def prioritize(self, data: bytes) -> None:
+        self.queue.prioritize(pickle.loads(data))
+
+    def wait_to_send(self) -> None:
+        """
+        Wait until the load balancer can take another extraction task, handling
+        any commands from the controller while waiting.
+
+        Sending blocks while the load balancer's queue is full, during which the
+        process could be neither paused, stopped nor told to do other files first.
+        """
+
+        while True:
+            self.check_for_controller_directive()
+            self.check_preview_replies()
+            if self.frontend.poll(self.send_poll_interval, zmq.POLLOUT):
+                return
+
+    def check_preview_replies(self, timeout: int = 0) -> bool:
+        """
+        Handle the extractors' reports of whether they found the previews in the
+        parts of photos sent to them. Photos whose preview was missing are queued
+        again, to be copied from the camera in their entirety.
+
+        :param timeout: how long to wait for a report, in milliseconds
+        :return: True if any report was received
+        """
+
+        if not self.awaiting_preview:
+            return False
+        received = False
+        while self.preview_replies.poll(timeout):
+            uid, found = self.preview_replies.recv_multipart()
+            received = True
+            timeout = 0
+            rpd_file = self.awaiting_preview.pop(uid, None)
+            if rpd_file is not None and found != b"1":
+                logging.debug(
+                    "Preview not in the part of %s that was read",
+                    rpd_file.full_file_name,
+                )
+                self.preview_missing.add(uid)
+                self.queue.extend([rpd_file])
+        return received
+
+    def wait_for_preview_replies(self) -> None:
+        """
+        Wait for the extractors to report on every photo sent to them with only
+        the start of the file, or until they have not reported for a while
+        """
+
+        deadline = time.monotonic() + self.preview_reply_timeout
+        while self.awaiting_preview and not self.queue:
+            self.check_for_controller_directive()
+            if self.check_preview_replies(self.send_poll_interval):
+                deadline = time.monotonic() + self.preview_reply_timeout
+            elif time.monotonic() >= deadline:
+                logging.warning(
+                    "No report from the thumbnail extractors for %s photos from %s",
+                    len(self.awaiting_preview),
+                    self.device_name,
+                )
+                self.awaiting_preview.clear()
+
+    def expect_preview_reply(self, rpd_file: RPDFile) -> int:
+        """
+        :param rpd_file: photo being sent to an extractor with only the start of
+         the file
+        :return: the port the extractor reports on whether the preview was found
+        """
+
+        if self.preview_replies is None:
+            self.preview_replies = self.context.socket(zmq.PULL)
+            self.preview_reply_port = self.preview_replies.bind_to_random_port(
+                "tcp://*"
+            )
+        self.awaiting_preview[rpd_file.uid] = rpd_file
+        return self.preview_reply_port
+
     def do_work(self) -> None:
         try:
             self.generate_thumbnails()
@@ -499,6 +755,7 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
             self.gphoto2_logging = gphoto2_python_logging()
 
         self.frontend = self.context.socket(zmq.PUSH)
+        self.frontend.set_hwm(self.frontend_hwm)
         self.frontend.connect("tcp://localhost:{}".format(arguments.frontend_port))
 
         self.prefs = Preferences()
@@ -518,6 +775,8 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
         thumbnail_caches = GetThumbnailFromCache(
             use_thumbnail_cache=use_thumbnail_cache
         )
+        self.preview_offsets = PreviewOffsets()
+        self.io_scheduler = IOScheduler()
 
         photo_cache_dir = video_cache_dir = None
         cache_file_from_camera = force_exiftool
@@ -626,17 +885,48 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
                 for rpd_file in rescan.missing_rpd_files:  # type: RPDFile
                     self.content = pickle.dumps(
                         GenerateThumbnailsResults(
-                            rpd_file=rpd_file, thumbnail_bytes=None
+                            rpd_file=RPDFileChanges(rpd_file), thumbnail_bytes=None
                         ),
                         pickle.HIGHEST_PROTOCOL,
                     )
                     self.send_message_to_sink()
 
-        for rpd_file in rpd_files:  # type: RPDFile
-            # Check to see if the process has received a command
-            self.check_for_controller_directive()
+        no_rpd_files = len(rpd_files)
+
+        if use_thumbnail_cache:
+            # Look up every file in the thumbnail cache in bulk, and send all the
+            # thumbnails found there, as they are read, before extracting any others
+            get_thumbnails = thumbnail_caches.get_from_thumbnail_cache(rpd_files)
+            not_in_thumbnail_cache = []
+            for rpd_file, get_thumbnail in zip(rpd_files, get_thumbnails):
+                if get_thumbnail.disk_status == ThumbnailCacheDiskStatus.not_found:
+                    not_in_thumbnail_cache.append(rpd_file)
+                    continue
+                self.check_for_controller_directive()
+                from_thumb_cache += 1
+                self.content = pickle.dumps(
+                    GenerateThumbnailsResults(
+                        rpd_file=RPDFileChanges(rpd_file),
+                        thumbnail_bytes=get_thumbnail.thumbnail_bytes,
+                    ),
+                    pickle.HIGHEST_PROTOCOL,
+                )
+                self.send_message_to_sink()
+            rpd_files = not_in_thumbnail_cache
+
+        self.queue.extend(rpd_files)
+        while self.queue or self.awaiting_preview:
+            if not self.queue:
+                self.wait_for_preview_replies()
+                continue
+            # Decide which file is next only once its extraction task can be sent,
+            # so that files not yet sent stay in the queue, where commands can still
+            # change which file is next
+            self.wait_to_send()
+            rpd_file = self.queue.pop()  # type: RPDFile
 
             exif_buffer = None
+            preview_reply_port = None
             file_to_work_on_is_temporary = False
             secondary_full_file_name = ""
             processing = set()  # type: Set[ExtractionProcessing]
@@ -644,7 +934,9 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
             # Attempt to get thumbnail from Thumbnail Cache
             # (see cache.py for definitions of various caches)
 
-            cache_search = thumbnail_caches.get_from_cache(rpd_file)
+            cache_search = thumbnail_caches.get_from_cache(
+                rpd_file, use_thumbnail_cache=False
+            )
             task, thumbnail_bytes, full_file_name_to_work_on, origin = cache_search
             if task != ExtractionTask.undetermined:
                 if origin == ThumbnailCacheOrigin.thumbnail_cache:
@@ -761,14 +1053,26 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
                             # try to extract the jpeg preview from it (which probably
                             # doesn't exist!). This is fast.
 
-                            if not rpd_file.is_jpeg():
-                                bytes_to_read = thumbnail_offset.get(rpd_file.extension)
+                            if (
+                                not rpd_file.is_jpeg()
+                                and rpd_file.uid not in self.preview_missing
+                            ):
+                                bytes_to_read = self.preview_offsets.bytes_to_read(
+                                    rpd_file, thumbnail_offset.get(rpd_file.extension)
+                                )
                                 if bytes_to_read:
                                     exif_buffer = self.camera.get_exif_extract(
                                         rpd_file.path, rpd_file.name, bytes_to_read
                                     )
                                     task = ExtractionTask.load_from_exif_buffer
                                     processing.add(ExtractionProcessing.orient)
+                                    # Should the preview not be in the buffer, the
+                                    # extractor says so, and the file is queued again
+                                    # to be cached in its entirety, from which the
+                                    # extractor learns the offset again
+                                    preview_reply_port = self.expect_preview_reply(
+                                        rpd_file
+                                    )
                             if (
                                 task == ExtractionTask.undetermined
                                 and self.cache_full_size_file_from_camera(rpd_file)
@@ -845,7 +1149,10 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
                 else:
                     # File is not on a camera
                     task = preprocess_thumbnail_from_disk(
-                        rpd_file=rpd_file, processing=processing
+                        rpd_file=rpd_file,
+                        processing=processing,
+                        preview_offsets=self.preview_offsets,
+                        io_scheduler=self.io_scheduler,
                     )
                     if task != ExtractionTask.bypass:
                         if rpd_file.thm_full_name is not None:
@@ -861,7 +1168,8 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
             if task == ExtractionTask.bypass:
                 self.content = pickle.dumps(
                     GenerateThumbnailsResults(
-                        rpd_file=rpd_file, thumbnail_bytes=thumbnail_bytes
+                        rpd_file=RPDFileChanges(rpd_file),
+                        thumbnail_bytes=thumbnail_bytes,
                     ),
                     pickle.HIGHEST_PROTOCOL,
                 )
@@ -885,10 +1193,24 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
                         write_fdo_thumbnail=False,
                         send_thumb_to_main=True,
                         force_exiftool=force_exiftool,
+                        received_state=rpd_file.received_state,
+                        preview_reply_port=preview_reply_port,
                     ),
                     pickle.HIGHEST_PROTOCOL,
                 )
-                self.frontend.send_multipart([b"data", self.content])
+                while True:
+                    try:
+                        self.frontend.send_multipart(
+                            [b"data", self.content], zmq.NOBLOCK
+                        )
+                    except zmq.Again:
+                        self.wait_to_send()
+                    else:
+                        break
+
+        if self.preview_replies is not None:
+            self.preview_replies.close()
+            self.preview_replies = None
 
         if arguments.camera:
             self.camera.free_camera()
@@ -906,13 +1228,13 @@ class GenerateThumbnails(WorkerInPublishPullPipeline):
         if from_thumb_cache:
             logging.info(
                 "{} of {} thumbnails for {} came from thumbnail cache".format(
-                    from_thumb_cache, len(rpd_files), self.device_name
+                    from_thumb_cache, no_rpd_files, self.device_name
                 )
             )
         if from_fdo_cache:
             logging.info(
                 "{} of {} thumbnails of for {} came from Free Desktop cache".format(
-                    from_fdo_cache, len(rpd_files), self.device_name
+                    from_fdo_cache, no_rpd_files, self.device_name
                 )
             )
 
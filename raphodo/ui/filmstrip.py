@@ -26,6 +26,8 @@ same
 __author__ = "Damon Lynch"
 __copyright__ = "Copyright 2011-2021, Damon Lynch"
 
+from typing import Optional, Tuple
+
 from PyQt5.QtGui import QImage, QPainter
 
 xpm_data = [
@@ -70,6 +72,33 @@ xpm_data = [
 ]
 
 
+# Filmstrips tall enough for the thumbnails seen so far, built once per process
+_filmstrips = None  # type: Optional[Tuple[QImage, QImage]]
+
+
+def _get_filmstrips(height: int) -> Tuple[QImage, QImage]:
+    """
+    :param height: minimum height of the filmstrips
+    :return: the left and right filmstrips, repeated vertically to be at least
+     the height
+    """
+
+    global _filmstrips
+
+    if _filmstrips is None or _filmstrips[0].height() < height:
+        filmstrip = QImage(xpm_data)
+        filmstrip_width = filmstrip.width()
+        filmstrip_height = filmstrip.height()
+        repeats = -(-height // filmstrip_height)
+        left = QImage(filmstrip_width, filmstrip_height * repeats, QImage.Format_RGB32)
+        painter = QPainter(left)
+        for i in range(repeats):
+            painter.drawImage(0, i * filmstrip_height, filmstrip)
+        painter.end()
+        _filmstrips = (left, left.mirrored(horizontal=True, vertical=False))
+    return _filmstrips
+
+
 def add_filmstrip(thumbnail: QImage) -> QImage:
     """
     Overlays a filmstrip onto the thumbnail.
@@ -80,34 +109,14 @@ def add_filmstrip(thumbnail: QImage) -> QImage:
     :return a copy of the thumbnail
 
     """
-    format = thumbnail.format()
 
-    filmstrip = QImage(xpm_data)
-    filmstrip_width = filmstrip.width()
-    filmstrip_height = filmstrip.height()
-    filmstrip_right = filmstrip.mirrored(horizontal=True, vertical=False)
-
-    thumbnail_right_col = thumbnail.width() - filmstrip_width
+    left, right = _get_filmstrips(thumbnail.height())
 
+    # Drawing is clipped to the thumbnail, so the bottom of the filmstrips is
+    # simply cut off
     painter = QPainter(thumbnail)
-
-    # add filmstrips to left and right
-    for i in range(thumbnail.height() // filmstrip_height):
-        painter.drawImage(0, i * filmstrip_height, filmstrip)
-        painter.drawImage(thumbnail_right_col, i * filmstrip_height, filmstrip_right)
-
-    # now do the remainder, at the bottom
-    remaining_height = thumbnail.height() % filmstrip_height
-    if remaining_height:
-        painter.drawImage(
-            0,
-            thumbnail.height() - remaining_height,
-            filmstrip.copy(0, 0, filmstrip_width, remaining_height),
-        )
-        painter.drawImage(
-            thumbnail_right_col,
-            thumbnail.height() - remaining_height,
-            filmstrip_right.copy(0, 0, filmstrip_width, remaining_height),
-        )
+    painter.drawImage(0, 0, left)
+    painter.drawImage(thumbnail.width() - left.width(), 0, right)
+    painter.end()
 
     return thumbnail
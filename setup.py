@@ -300,6 +300,9 @@ setup(
         "progress_bar": [
             "pyprind",
         ],
+        "fast_verification": [
+            "xxhash",
+        ],
     },
     include_package_data=False,
     data_files=[